@@ -1,26 +1,2332 @@
-from flask import Flask, render_template_string, request, jsonify, send_file
+from flask import Flask, Response, request, jsonify, send_file
+from werkzeug.exceptions import RequestedRangeNotSatisfiable, RequestEntityTooLarge
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NeedData
 from werkzeug.utils import secure_filename
+import werkzeug.utils
+import werkzeug.wsgi
 import os
+import base64
+import bz2
+import codecs
+import csv
+import gzip
+import hashlib
+import io
 import json
-from datetime import datetime
+import mimetypes
+import multiprocessing
+import queue
+import re
+import shutil
+import struct
+import sqlite3
+import tempfile
+import threading
+import time
+import unicodedata
+import uuid
+import zipfile
+import zlib
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from collections import Counter
+from contextlib import contextmanager
+from functools import lru_cache
+from datetime import datetime, timedelta
+from urllib.parse import quote as url_quote
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Text extraction for the search index; a format whose library is missing is
+# indexed by file name only.
+try:
+    import docx
+except ImportError:
+    docx = None
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+try:
+    import PyPDF2
+except ImportError:
+    PyPDF2 = None
+# Columnar cache for spreadsheet previews
+try:
+    import numpy as np
+except ImportError:
+    np = None
+# Image thumbnails and PNG optimisation; without Pillow the file list shows
+# names only and images are stored as uploaded
+try:
+    from PIL import Image, ImageChops, ImageOps, PngImagePlugin
+except ImportError:
+    Image = ImageChops = ImageOps = PngImagePlugin = None
 
 app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024
 app.config['BASE_UPLOAD_FOLDER'] = 'clinic_uploads'
+# Metadata writes are funnelled through one writer thread per worker, which
+# commits every mutation queued so far in a single transaction (group commit).
+app.config['METADATA_GROUP_COMMIT_MAX'] = 256
+# The compactor folds the SQLite write-ahead log back into metadata.db.
+app.config['METADATA_COMPACT_INTERVAL'] = 30
+app.config['METADATA_COMPACT_WAL_BYTES'] = 4 * 1024 * 1024
+# Optimistic concurrency: how often a conflicting exam-group update is re-read
+# and re-applied before giving up.
+app.config['METADATA_CAS_RETRIES'] = 5
+# Resumable uploads: clients send files in chunks of this size (each well under
+# MAX_CONTENT_LENGTH); unfinished staging files are dropped once no chunk has
+# arrived for the TTL. UPLOAD_MAX_SIZE caps the size a session may announce,
+# since its staging file is allocated up front.
+app.config['UPLOAD_CHUNK_SIZE'] = 8 * 1024 * 1024
+app.config['UPLOAD_MAX_SIZE'] = 4 * 1024 * 1024 * 1024
+app.config['UPLOAD_STAGING_TTL'] = 24 * 3600
+# Read/write buffer for streaming multipart uploads straight to disk
+app.config['UPLOAD_STREAM_BUFFER'] = 1024 * 1024
+# Let a fronting web server send download bodies: None (Python streams the
+# file), 'x-accel-redirect' (nginx) or 'x-sendfile' (Apache/lighttpd). For
+# nginx, map DOWNLOAD_ACCEL_PREFIX to BASE_UPLOAD_FOLDER, e.g.
+#     location /_protected_uploads/ { internal; alias /srv/app/clinic_uploads/; }
+app.config['DOWNLOAD_OFFLOAD'] = None
+app.config['DOWNLOAD_ACCEL_PREFIX'] = '/_protected_uploads/'
+# Formats that are already compressed are stored as-is in folder ZIPs
+ZIP_STORED_EXTENSIONS = {'jpg', 'jpeg', 'png', 'zip', 'rar', 'docx', 'xlsx'}
+# Page size for the exam-group list (/get_folders?limit=)
+app.config['FOLDERS_PAGE_SIZE'] = 50
+app.config['FOLDERS_PAGE_MAX'] = 500
+# Page size for file lists (/get_files/<folder>?limit=)
+app.config['FILES_PAGE_SIZE'] = 100
+app.config['FILES_PAGE_MAX'] = 1000
+# Change feed (/changes): how long events are kept for reconnecting clients,
+# how often a stream looks for events written by other worker processes, the
+# keep-alive interval for idle streams, and how long one stream stays open
+# before the browser is made to reconnect (seconds). Keep the last well under
+# the server's request timeout (see gunicorn.conf.py).
+app.config['CHANGES_RETENTION'] = 24 * 3600
+app.config['CHANGES_POLL_INTERVAL'] = 2
+app.config['CHANGES_HEARTBEAT'] = 5
+app.config['CHANGES_STREAM_MAX_AGE'] = 15
+# Negotiated gzip/brotli for JSON API responses between these sizes (bytes),
+# at levels chosen for latency rather than ratio
+app.config['COMPRESS_MIN_SIZE'] = 1024
+app.config['COMPRESS_MAX_SIZE'] = 8 * 1024 * 1024
+app.config['COMPRESS_GZIP_LEVEL'] = 5
+app.config['COMPRESS_BROTLI_QUALITY'] = 4
+# Full-text search: characters of extracted text indexed per file, and the
+# number of hits /search returns by default / at most
+app.config['SEARCH_MAX_TEXT'] = 500 * 1000
+app.config['SEARCH_RESULTS'] = 20
+app.config['SEARCH_RESULTS_MAX'] = 100
+# Background jobs (post-upload processing): worker processes per web process,
+# how long a claimed job is reserved before another process may take it over
+# (renewed while it runs), attempts before a job is marked failed, the base of
+# the exponential retry delay, how often idle dispatchers look for due jobs,
+# and how long finished jobs are kept for /jobs (seconds)
+app.config['JOBS_WORKERS'] = 2
+app.config['JOBS_LEASE'] = 60
+app.config['JOBS_MAX_ATTEMPTS'] = 3
+app.config['JOBS_RETRY_DELAY'] = 30
+app.config['JOBS_POLL_INTERVAL'] = 2
+app.config['JOBS_RETENTION'] = 24 * 3600
+# Spreadsheet previews: rows and columns converted from the first sheet,
+# characters kept per cell, and the row window /preview returns by default /
+# at most
+app.config['PREVIEW_MAX_ROWS'] = 200 * 1000
+app.config['PREVIEW_MAX_COLUMNS'] = 256
+app.config['PREVIEW_MAX_CELL'] = 1000
+app.config['PREVIEW_PAGE_SIZE'] = 100
+app.config['PREVIEW_PAGE_MAX'] = 1000
+# PDF previews: most pages /pdf/.../pages sends in one document, and
+# characters of text kept per page
+app.config['PDF_PAGES_MAX'] = 50
+app.config['PDF_MAX_PAGE_TEXT'] = 100 * 1000
+# ZIP browsing: members /zip/<folder>/<file> lists by default / at most
+app.config['ZIP_PAGE_SIZE'] = 500
+app.config['ZIP_PAGE_MAX'] = 5000
+# Thumbnails: disk budget of the thumbnail cache (least recently used are
+# evicted beyond it), how often it is checked, how often a served thumbnail
+# is marked as used (seconds), and JPEG quality
+app.config['THUMBNAIL_CACHE_BYTES'] = 1024 * 1024 * 1024
+app.config['THUMBNAIL_EVICT_INTERVAL'] = 60
+app.config['THUMBNAIL_TOUCH_INTERVAL'] = 3600
+app.config['THUMBNAIL_QUALITY'] = 80
+# PNG uploads are recompressed losslessly in the background; the result
+# replaces the stored file when it saves at least this fraction of its size.
+# Originals are dropped unless IMAGE_KEEP_ORIGINALS (then they can still be
+# downloaded with /download/<folder>/<file>?original=1).
+app.config['IMAGE_OPTIMIZE'] = True
+app.config['IMAGE_OPTIMIZE_MIN_SAVING'] = 0.05
+app.config['IMAGE_KEEP_ORIGINALS'] = False
+# Cold storage: exam groups whose exam date and latest upload are older than
+# TIERING_COLD_AFTER days are packed into one archive each. The packer looks
+# for them every TIERING_INTERVAL seconds (None: only `flask pack-folders`).
+app.config['TIERING_COLD_AFTER'] = 90
+app.config['TIERING_INTERVAL'] = 3600
 
 os.makedirs(app.config['BASE_UPLOAD_FOLDER'], exist_ok=True)
 
 METADATA_FILE = os.path.join(app.config['BASE_UPLOAD_FOLDER'], 'metadata.json')
+DB_FILE = os.path.join(app.config['BASE_UPLOAD_FOLDER'], 'metadata.db')
+# Content-addressed store: one copy of every distinct file, keyed by SHA-256.
+# Files inside exam-group folders are hard links to these blobs.
+BLOB_FOLDER = os.path.join(app.config['BASE_UPLOAD_FOLDER'], '.blobs')
+# Data derived from a blob (previews, indexes), kept under the same hash and
+# removed together with it
+CACHE_FOLDER = os.path.join(app.config['BASE_UPLOAD_FOLDER'], '.cache')
+# Thumbnails of images, also by content hash, in a size-bounded LRU cache
+THUMBNAIL_FOLDER = os.path.join(app.config['BASE_UPLOAD_FOLDER'], '.thumbnails')
+
+DB_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS exam_groups (
+    name TEXT PRIMARY KEY,
+    company_name TEXT NOT NULL,
+    exam_date TEXT NOT NULL,
+    notes TEXT NOT NULL DEFAULT '',
+    created_at TEXT NOT NULL,
+    version INTEGER NOT NULL DEFAULT 1,
+    search_name TEXT,
+    file_count INTEGER NOT NULL DEFAULT 0,
+    total_bytes INTEGER NOT NULL DEFAULT 0,
+    archive TEXT,
+    archived_at TEXT,
+    archive_stale INTEGER NOT NULL DEFAULT 0
+);
+DROP INDEX IF EXISTS idx_exam_groups_exam_date;
+CREATE INDEX IF NOT EXISTS idx_exam_groups_exam_date_name ON exam_groups(exam_date, name);
+CREATE INDEX IF NOT EXISTS idx_exam_groups_company_name ON exam_groups(company_name);
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    folder TEXT NOT NULL REFERENCES exam_groups(name) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    upload_time TEXT NOT NULL,
+    description TEXT NOT NULL DEFAULT '',
+    sha256 TEXT,
+    original_size INTEGER,
+    original_sha256 TEXT,
+    original_kept INTEGER NOT NULL DEFAULT 0
+);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_files_folder_name ON files(folder, name);
+CREATE INDEX IF NOT EXISTS idx_files_folder_size ON files(folder, size, id);
+CREATE INDEX IF NOT EXISTS idx_files_folder_upload_time ON files(folder, upload_time, id);
+CREATE TABLE IF NOT EXISTS name_counters (
+    folder TEXT NOT NULL REFERENCES exam_groups(name) ON DELETE CASCADE,
+    base TEXT NOT NULL,
+    ext TEXT NOT NULL,
+    next INTEGER NOT NULL,
+    PRIMARY KEY (folder, base, ext)
+);
+CREATE TABLE IF NOT EXISTS allocated_names (
+    folder TEXT NOT NULL REFERENCES exam_groups(name) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    PRIMARY KEY (folder, name)
+);
+CREATE TABLE IF NOT EXISTS uploads (
+    id TEXT PRIMARY KEY,
+    folder TEXT NOT NULL REFERENCES exam_groups(name) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL
+);
+DROP INDEX IF EXISTS idx_uploads_created_at;
+CREATE TABLE IF NOT EXISTS upload_chunks (
+    upload_id TEXT NOT NULL REFERENCES uploads(id) ON DELETE CASCADE,
+    start INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    PRIMARY KEY (upload_id, start)
+);
+CREATE TABLE IF NOT EXISTS blobs (
+    sha256 TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    refcount INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    data TEXT NOT NULL,
+    created_at REAL NOT NULL DEFAULT ((julianday('now') - 2440587.5) * 86400.0)
+);
+CREATE INDEX IF NOT EXISTS idx_changes_created_at ON changes(created_at);
+CREATE INDEX IF NOT EXISTS idx_files_sha256 ON files(sha256);
+CREATE TABLE IF NOT EXISTS file_text (
+    file_id INTEGER PRIMARY KEY REFERENCES files(id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    body TEXT NOT NULL,
+    text TEXT NOT NULL
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS file_search USING fts5(
+    name, body,
+    content='file_text', content_rowid='file_id',
+    tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+);
+CREATE TRIGGER IF NOT EXISTS file_text_after_insert AFTER INSERT ON file_text BEGIN
+    INSERT INTO file_search (rowid, name, body) VALUES (NEW.file_id, NEW.name, NEW.body);
+END;
+CREATE TRIGGER IF NOT EXISTS file_text_after_delete AFTER DELETE ON file_text BEGIN
+    INSERT INTO file_search (file_search, rowid, name, body) VALUES ('delete', OLD.file_id, OLD.name, OLD.body);
+END;
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    file_id INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+    status TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    run_after REAL NOT NULL,
+    owner TEXT,
+    lease_until REAL,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_status_run_after ON jobs(status, run_after);
+CREATE INDEX IF NOT EXISTS idx_jobs_status_lease_until ON jobs(status, lease_until);
+CREATE INDEX IF NOT EXISTS idx_jobs_file_id ON jobs(file_id, status);
+CREATE TABLE IF NOT EXISTS archived_files (
+    file_id INTEGER PRIMARY KEY REFERENCES files(id) ON DELETE CASCADE,
+    offset INTEGER NOT NULL,
+    compressed_size INTEGER NOT NULL,
+    method TEXT NOT NULL,
+    crc INTEGER NOT NULL
+);
+'''
+
+# Columns added after metadata.db was first released; init_db adds them to
+# databases created by older versions.
+DB_ADDED_COLUMNS = [
+    ('exam_groups', 'version', 'INTEGER NOT NULL DEFAULT 1'),
+    ('files', 'sha256', 'TEXT'),
+    ('exam_groups', 'search_name', 'TEXT'),
+    ('exam_groups', 'file_count', 'INTEGER NOT NULL DEFAULT 0'),
+    ('exam_groups', 'total_bytes', 'INTEGER NOT NULL DEFAULT 0'),
+    ('files', 'original_size', 'INTEGER'),
+    ('files', 'original_sha256', 'TEXT'),
+    ('files', 'original_kept', 'INTEGER NOT NULL DEFAULT 0'),
+    ('exam_groups', 'archive', 'TEXT'),
+    ('exam_groups', 'archived_at', 'TEXT'),
+    ('exam_groups', 'archive_stale', 'INTEGER NOT NULL DEFAULT 0'),
+    ('uploads', 'updated_at', 'REAL'),
+]
+
+# Indexes and triggers on columns from DB_ADDED_COLUMNS, created once the
+# columns exist. The triggers keep exam_groups.file_count/total_bytes in step
+# with the files table and append to the change feed, inside the same
+# transaction as the change. Files removed by deleting their exam group are
+# covered by its folder_deleted event.
+DB_POST_MIGRATION_SCHEMA = '''
+CREATE INDEX IF NOT EXISTS idx_exam_groups_search_name ON exam_groups(search_name);
+CREATE INDEX IF NOT EXISTS idx_files_original_sha256 ON files(original_sha256);
+CREATE INDEX IF NOT EXISTS idx_uploads_updated_at ON uploads(updated_at);
+DROP TRIGGER IF EXISTS files_totals_insert;
+DROP TRIGGER IF EXISTS files_totals_delete;
+CREATE TRIGGER IF NOT EXISTS files_after_insert AFTER INSERT ON files BEGIN
+    UPDATE exam_groups SET file_count = file_count + 1, total_bytes = total_bytes + NEW.size
+    WHERE name = NEW.folder;
+    INSERT INTO changes (kind, data)
+    SELECT 'file_added', json_object('folder', NEW.folder, 'name', NEW.name, 'size', NEW.size,
+                                     'upload_time', NEW.upload_time, 'description', NEW.description,
+                                     'file_count', file_count, 'total_bytes', total_bytes)
+    FROM exam_groups WHERE name = NEW.folder;
+END;
+CREATE TRIGGER IF NOT EXISTS files_after_delete AFTER DELETE ON files BEGIN
+    UPDATE exam_groups SET file_count = file_count - 1, total_bytes = total_bytes - OLD.size
+    WHERE name = OLD.folder;
+    INSERT INTO changes (kind, data)
+    SELECT 'file_removed', json_object('folder', OLD.folder, 'name', OLD.name,
+                                       'file_count', file_count, 'total_bytes', total_bytes)
+    FROM exam_groups WHERE name = OLD.folder;
+END;
+CREATE TRIGGER IF NOT EXISTS exam_groups_after_insert AFTER INSERT ON exam_groups BEGIN
+    INSERT INTO changes (kind, data)
+    VALUES ('folder_created', json_object('folder', NEW.name, 'company_name', NEW.company_name,
+                                          'exam_date', NEW.exam_date, 'notes', NEW.notes,
+                                          'file_count', NEW.file_count, 'total_bytes', NEW.total_bytes));
+END;
+CREATE TRIGGER IF NOT EXISTS exam_groups_after_update AFTER UPDATE OF company_name, exam_date, notes ON exam_groups BEGIN
+    INSERT INTO changes (kind, data)
+    VALUES ('folder_updated', json_object('folder', NEW.name, 'company_name', NEW.company_name,
+                                          'exam_date', NEW.exam_date, 'notes', NEW.notes,
+                                          'file_count', NEW.file_count, 'total_bytes', NEW.total_bytes));
+END;
+CREATE TRIGGER IF NOT EXISTS exam_groups_after_delete AFTER DELETE ON exam_groups BEGIN
+    INSERT INTO changes (kind, data) VALUES ('folder_deleted', json_object('folder', OLD.name));
+END;
+CREATE TRIGGER IF NOT EXISTS jobs_after_finish AFTER UPDATE OF status ON jobs
+WHEN NEW.status IN ('done', 'failed') BEGIN
+    INSERT INTO changes (kind, data)
+    SELECT 'file_processed', json_object('folder', f.folder, 'name', f.name, 'processing', json(
+        CASE WHEN EXISTS (SELECT 1 FROM jobs j WHERE j.file_id = f.id AND j.status IN ('queued', 'running'))
+        THEN 'true' ELSE 'false' END))
+    FROM files f WHERE f.id = NEW.file_id;
+END;
+CREATE TRIGGER IF NOT EXISTS files_before_delete_archived BEFORE DELETE ON files
+WHEN EXISTS (SELECT 1 FROM archived_files a WHERE a.file_id = OLD.id) BEGIN
+    UPDATE exam_groups SET archive_stale = 1 WHERE name = OLD.folder;
+END;
+CREATE TRIGGER IF NOT EXISTS files_totals_update AFTER UPDATE OF folder, size ON files BEGIN
+    UPDATE exam_groups SET file_count = file_count - 1, total_bytes = total_bytes - OLD.size
+    WHERE name = OLD.folder;
+    UPDATE exam_groups SET file_count = file_count + 1, total_bytes = total_bytes + NEW.size
+    WHERE name = NEW.folder;
+END;
+'''
+
+def recount_exam_groups(conn):
+    conn.execute('''
+        UPDATE exam_groups SET
+            file_count = (SELECT COUNT(*) FROM files f WHERE f.folder = exam_groups.name),
+            total_bytes = (SELECT COALESCE(SUM(f.size), 0) FROM files f WHERE f.folder = exam_groups.name)
+    ''')
+
+def fold_text(text):
+    # Lower-case and strip Vietnamese diacritics, so "cong ty dong a"
+    # matches "Công Ty Đông Á".
+    text = unicodedata.normalize('NFD', (text or '').casefold().replace('đ', 'd'))
+    return ''.join(c for c in text if not unicodedata.combining(c))
+
+def open_db():
+    conn = sqlite3.connect(DB_FILE, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA foreign_keys = ON')
+    return conn
+
+# One read connection per thread; gunicorn workers each open their own.
+_db_local = threading.local()
+
+def get_db():
+    conn = getattr(_db_local, 'conn', None)
+    if conn is None:
+        conn = _db_local.conn = open_db()
+    return conn
+
+@contextmanager
+def db_transaction():
+    conn = get_db()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+
+@contextmanager
+def db_snapshot():
+    # Several reads that must see the same committed state
+    conn = get_db()
+    conn.execute('BEGIN')
+    try:
+        yield conn
+    finally:
+        conn.execute('COMMIT')
+
+def file_row_to_dict(row):
+    return {
+        'name': row['name'],
+        'size': row['size'],
+        'upload_time': row['upload_time'],
+        'description': row['description']
+    }
+
+def get_exam_group(folder_name):
+    conn = get_db()
+    row = conn.execute('SELECT * FROM exam_groups WHERE name = ?', (folder_name,)).fetchone()
+    if row is None:
+        return None
+    files = conn.execute('SELECT * FROM files WHERE folder = ? ORDER BY id', (folder_name,)).fetchall()
+    return {
+        'company_name': row['company_name'],
+        'exam_date': row['exam_date'],
+        'notes': row['notes'],
+        'created_at': row['created_at'],
+        'version': row['version'],
+        'files': [file_row_to_dict(f) for f in files]
+    }
+
+def get_group_version(folder_name):
+    row = get_db().execute('SELECT version FROM exam_groups WHERE name = ?', (folder_name,)).fetchone()
+    return row['version'] if row else None
+
+class VersionConflict(Exception):
+    def __init__(self, folder_name, current_version):
+        super().__init__(f'Đoàn khám {folder_name} đã được người khác cập nhật, vui lòng tải lại')
+        self.folder_name = folder_name
+        self.current_version = current_version
+
+# ---- Mutations. Each runs inside the writer thread's batch transaction. ----
+
+def bump_version(conn, folder_name, expected_version=None):
+    # Compare-and-swap on the exam group's version. Returns the new version,
+    # None if the group does not exist, or raises VersionConflict.
+    if expected_version is None:
+        cur = conn.execute('UPDATE exam_groups SET version = version + 1 WHERE name = ?', (folder_name,))
+    else:
+        cur = conn.execute('UPDATE exam_groups SET version = version + 1 WHERE name = ? AND version = ?',
+                           (folder_name, expected_version))
+    row = conn.execute('SELECT version FROM exam_groups WHERE name = ?', (folder_name,)).fetchone()
+    if row is None:
+        return None
+    if cur.rowcount == 0:
+        raise VersionConflict(folder_name, row['version'])
+    return row['version']
+
+def release_blob(conn, sha256):
+    # Drop one reference; True if the blob is no longer referenced at all
+    conn.execute('UPDATE blobs SET refcount = refcount - 1 WHERE sha256 = ?', (sha256,))
+    return conn.execute('DELETE FROM blobs WHERE sha256 = ? AND refcount <= 0', (sha256,)).rowcount > 0
+
+def release_blobs(conn, folder_name, filename=None):
+    # Drop the blob references held by one file, or by every file of the exam
+    # group (kept originals of optimised images included), and return the
+    # hashes that are no longer referenced at all.
+    query = '''
+        SELECT f.sha256, f.original_sha256, f.original_kept, a.file_id IS NOT NULL AS archived
+        FROM files f LEFT JOIN archived_files a ON a.file_id = f.id WHERE f.folder = ?
+    '''
+    if filename is None:
+        rows = conn.execute(query, (folder_name,)).fetchall()
+    else:
+        rows = conn.execute(query + ' AND f.name = ?', (folder_name, filename)).fetchall()
+    hashes = [row['sha256'] for row in rows if row['sha256'] and not row['archived']]
+    hashes += [row['original_sha256'] for row in rows if row['original_kept']]
+    freed = [sha256 for sha256 in hashes if release_blob(conn, sha256)]
+    # Files packed into an archive hold no blob reference; their derived data
+    # (previews, thumbnails) goes with the last file of the same content
+    packed = Counter(row['sha256'] for row in rows if row['sha256'] and row['archived'])
+    for sha256, count in packed.items():
+        total = conn.execute('SELECT COUNT(*) FROM files WHERE sha256 = ?', (sha256,)).fetchone()[0]
+        if (total == count and sha256 not in freed
+                and conn.execute('SELECT 1 FROM blobs WHERE sha256 = ?', (sha256,)).fetchone() is None):
+            freed.append(sha256)
+    return freed
+
+def add_blob_ref(conn, sha256, size):
+    conn.execute('''
+        INSERT INTO blobs (sha256, size, refcount) VALUES (?, ?, 1)
+        ON CONFLICT (sha256) DO UPDATE SET refcount = refcount + 1
+    ''', (sha256, size))
+
+def insert_file(conn, folder_name, file_info):
+    freed = release_blobs(conn, folder_name, file_info['name'])
+    conn.execute('DELETE FROM files WHERE folder = ? AND name = ?', (folder_name, file_info['name']))
+    cursor = conn.execute('''
+        INSERT INTO files (folder, name, size, upload_time, description, sha256, original_size, original_sha256)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (folder_name, file_info['name'], file_info['size'], file_info['upload_time'],
+          file_info.get('description', ''), file_info.get('sha256'),
+          file_info.get('original_size'), file_info.get('original_sha256')))
+    # A file linked to an optimised copy is not optimised again
+    kinds = [kind for kind in file_jobs(file_info['name'])
+             if kind != 'optimize_image' or not file_info.get('original_sha256')]
+    enqueue_file_jobs(conn, cursor.lastrowid, kinds)
+    if file_info.get('sha256'):
+        add_blob_ref(conn, file_info['sha256'], file_info['size'])
+        freed = [sha for sha in freed if sha != file_info['sha256']]
+    return freed
+
+def create_exam_group(conn, folder_name, company_name, exam_date, notes, files):
+    freed = release_blobs(conn, folder_name)
+    conn.execute('DELETE FROM exam_groups WHERE name = ?', (folder_name,))
+    conn.execute(
+        'INSERT INTO exam_groups (name, company_name, exam_date, notes, created_at, search_name) VALUES (?, ?, ?, ?, ?, ?)',
+        (folder_name, company_name, exam_date, notes, datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+         fold_text(company_name))
+    )
+    return freed + insert_files(conn, folder_name, files)
+
+def insert_files(conn, folder_name, files, expected_version=None):
+    # Returns the blob hashes freed by files that were replaced
+    bump_version(conn, folder_name, expected_version)
+    freed = []
+    for file_info in files:
+        freed += insert_file(conn, folder_name, file_info)
+    return freed
+
+def update_exam_group(conn, folder_name, company_name, exam_date, notes, expected_version=None):
+    version = bump_version(conn, folder_name, expected_version)
+    if version is None:
+        return None
+    conn.execute(
+        'UPDATE exam_groups SET company_name = ?, exam_date = ?, notes = ?, search_name = ? WHERE name = ?',
+        (company_name, exam_date, notes, fold_text(company_name), folder_name)
+    )
+    return version
+
+def allocate_filenames(conn, folder_name, filenames):
+    # Hand out unique names: the first scan.jpg stays scan.jpg, later ones
+    # become scan_1.jpg, scan_2.jpg... from a per-basename counter, so there
+    # is no probing of the directory. Every name handed out is recorded in
+    # allocated_names with the counter, in the same write, so a later call
+    # never repeats it even before its file row is inserted (a literal
+    # scan_1.jpg then pushes the next scan.jpg on to scan_2.jpg). The
+    # files-table check covers names stored before the table existed.
+    names = []
+    for filename in filenames:
+        base_name, ext = os.path.splitext(filename)
+        while True:
+            n = conn.execute('''
+                INSERT INTO name_counters (folder, base, ext, next) VALUES (?, ?, ?, 1)
+                ON CONFLICT (folder, base, ext) DO UPDATE SET next = next + 1
+                RETURNING next
+            ''', (folder_name, base_name, ext)).fetchone()['next']
+            name = filename if n == 1 else f"{base_name}_{n - 1}{ext}"
+            taken = conn.execute('SELECT 1 FROM files WHERE folder = ? AND name = ?', (folder_name, name)).fetchone()
+            if not taken and conn.execute('INSERT OR IGNORE INTO allocated_names (folder, name) VALUES (?, ?)',
+                                          (folder_name, name)).rowcount:
+                break
+        names.append(name)
+    return names
+
+def delete_exam_group(conn, folder_name):
+    freed = release_blobs(conn, folder_name)
+    conn.execute('DELETE FROM exam_groups WHERE name = ?', (folder_name,))
+    return freed
+
+def remove_file(conn, folder_name, filename, expected_version=None):
+    bump_version(conn, folder_name, expected_version)
+    freed = release_blobs(conn, folder_name, filename)
+    conn.execute('DELETE FROM files WHERE folder = ? AND name = ?', (folder_name, filename))
+    return freed
+
+def adopt_file_blob(conn, folder_name, filename, sha256, size):
+    conn.execute('UPDATE files SET sha256 = ? WHERE folder = ? AND name = ?', (sha256, folder_name, filename))
+    add_blob_ref(conn, sha256, size)
+
+def archive_exam_group(conn, folder_name, expected_version, archive, members):
+    # Point the exam group at its new archive and record where each file sits
+    # in it; members: (name, offset, compressed size, method, CRC-32). Raises
+    # VersionConflict if files came or went while it was being packed.
+    # Returns (blobs no longer referenced, previous archive), or None if the
+    # group was deleted.
+    if bump_version(conn, folder_name, expected_version) is None:
+        return None
+    previous = conn.execute('SELECT archive FROM exam_groups WHERE name = ?', (folder_name,)).fetchone()['archive']
+    freed = []
+    for name, offset, compressed_size, method, crc in members:
+        row = conn.execute('''
+            SELECT f.id, f.sha256, a.file_id IS NOT NULL AS archived
+            FROM files f LEFT JOIN archived_files a ON a.file_id = f.id WHERE f.folder = ? AND f.name = ?
+        ''', (folder_name, name)).fetchone()
+        if row['sha256'] and not row['archived'] and release_blob(conn, row['sha256']):
+            freed.append(row['sha256'])
+        conn.execute('''
+            INSERT OR REPLACE INTO archived_files (file_id, offset, compressed_size, method, crc)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (row['id'], offset, compressed_size, method, crc))
+    conn.execute('UPDATE exam_groups SET archive = ?, archived_at = ?, archive_stale = 0 WHERE name = ?',
+                 (archive, datetime.now().strftime('%Y-%m-%d %H:%M:%S') if archive else None, folder_name))
+    return freed, previous
+
+def create_upload(conn, upload_id, folder_name, filename, size):
+    now = time.time()
+    conn.execute('INSERT INTO uploads (id, folder, name, size, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)',
+                 (upload_id, folder_name, filename, size, now, now))
+
+def record_upload_chunk(conn, upload_id, start, length):
+    conn.execute('INSERT OR REPLACE INTO upload_chunks (upload_id, start, length) VALUES (?, ?, ?)',
+                 (upload_id, start, length))
+    # Expiry counts from the last chunk, so a slow batch resumed later keeps
+    # what it already sent
+    conn.execute('UPDATE uploads SET updated_at = ? WHERE id = ?', (time.time(), upload_id))
+
+def complete_upload(conn, upload_id, folder_name, file_info):
+    freed = insert_files(conn, folder_name, [file_info])
+    conn.execute('DELETE FROM uploads WHERE id = ?', (upload_id,))
+    return freed
+
+def store_file_texts(conn, folder_name, entries):
+    # entries: (filename, sha256, text). A file replaced since its text was
+    # extracted (different hash) is skipped; its own indexing follows.
+    for filename, sha256, text in entries:
+        row = conn.execute('SELECT id, sha256 FROM files WHERE folder = ? AND name = ?',
+                           (folder_name, filename)).fetchone()
+        if row is None or row['sha256'] != sha256:
+            continue
+        conn.execute('DELETE FROM file_text WHERE file_id = ?', (row['id'],))
+        conn.execute('INSERT INTO file_text (file_id, name, body, text) VALUES (?, ?, ?, ?)',
+                     (row['id'], fold_text(filename), fold_aligned(text), text))
+
+def delete_uploads(conn, upload_ids):
+    conn.executemany('DELETE FROM uploads WHERE id = ?', [(i,) for i in upload_ids])
+
+def prune_changes(conn, before):
+    conn.execute('DELETE FROM changes WHERE created_at < ?', (before,))
+
+def enqueue_file_jobs(conn, file_id, kinds):
+    now = time.time()
+    conn.executemany('INSERT INTO jobs (kind, file_id, run_after, created_at, updated_at) VALUES (?, ?, ?, ?, ?)',
+                     [(kind, file_id, now, now, now) for kind in kinds])
+    # The dispatcher's claim is queued behind this batch, so it sees the jobs
+    _jobs_wakeup.set()
+
+def claim_jobs(conn, owner, limit, lease):
+    # Due jobs, and jobs whose owner stopped renewing the lease (it crashed or
+    # was restarted). Reclaiming counts as an attempt, so a job that keeps
+    # killing its worker ends up failed.
+    now = time.time()
+    rows = conn.execute('''
+        UPDATE jobs SET status = 'running', owner = ?, lease_until = ?, attempts = attempts + 1, updated_at = ?
+        WHERE id IN (
+            SELECT id FROM jobs WHERE status = 'queued' AND run_after <= ?
+            UNION ALL
+            SELECT id FROM jobs WHERE status = 'running' AND lease_until < ?
+            LIMIT ?
+        )
+        RETURNING id, kind, file_id, attempts
+    ''', (owner, now + lease, now, now, now, limit)).fetchall()
+    return [dict(row) for row in rows]
+
+def renew_job_leases(conn, owner, job_ids, lease):
+    conn.executemany(
+        "UPDATE jobs SET lease_until = ? WHERE id = ? AND owner = ? AND status = 'running'",
+        [(time.time() + lease, job_id, owner) for job_id in job_ids]
+    )
+
+def finish_job(conn, job_id, owner, apply=None, *args):
+    # Ignored if the lease was lost meanwhile: the new owner finishes the job.
+    # Returns what apply returns (blobs it freed, if any).
+    row = conn.execute("SELECT 1 FROM jobs WHERE id = ? AND owner = ? AND status = 'running'",
+                       (job_id, owner)).fetchone()
+    if row is None:
+        return None
+    result = apply(conn, *args) if apply else None
+    conn.execute("UPDATE jobs SET status = 'done', lease_until = NULL, error = NULL, updated_at = ? WHERE id = ?",
+                 (time.time(), job_id))
+    return result
+
+def fail_job(conn, job_id, owner, error, max_attempts, retry_delay):
+    row = conn.execute("SELECT attempts FROM jobs WHERE id = ? AND owner = ? AND status = 'running'",
+                       (job_id, owner)).fetchone()
+    if row is None:
+        return
+    now = time.time()
+    if row['attempts'] >= max_attempts:
+        conn.execute("UPDATE jobs SET status = 'failed', lease_until = NULL, error = ?, updated_at = ? WHERE id = ?",
+                     (error, now, job_id))
+    else:
+        conn.execute('''
+            UPDATE jobs SET status = 'queued', lease_until = NULL, error = ?, run_after = ?, updated_at = ?
+            WHERE id = ?
+        ''', (error, now + retry_delay * 2 ** (row['attempts'] - 1), now, job_id))
+
+def prune_jobs(conn, before):
+    conn.execute("DELETE FROM jobs WHERE status = 'done' AND updated_at < ?", (before,))
+
+# ---- Group commit ----
+
+_write_queue = queue.Queue()
+# Notified after every commit so change-feed streams wake up immediately
+_changes_cond = threading.Condition()
+_background_lock = threading.Lock()
+_background_pid = None
+
+def run_write(mutation, *args, **kwargs):
+    # Queue a mutation for the writer thread and wait until its batch is
+    # durable. Exceptions raised by the mutation are re-raised here.
+    start_background_services()
+    future = Future()
+    _write_queue.put((mutation, args, kwargs, future))
+    return future.result()
+
+def run_write_cas(folder_name, mutation, *args):
+    # Optimistic update of one exam group: read its version without locking,
+    # apply the mutation only if nobody bumped it meanwhile, otherwise retry.
+    # File adds/removes don't need this: they are row-level and bump the
+    # version atomically in the same transaction.
+    for attempt in range(app.config['METADATA_CAS_RETRIES']):
+        version = get_group_version(folder_name)
+        try:
+            return run_write(mutation, folder_name, *args, expected_version=version)
+        except VersionConflict:
+            if attempt == app.config['METADATA_CAS_RETRIES'] - 1:
+                raise
+            time.sleep(0.005 * (attempt + 1))
+
+def _writer_loop():
+    conn = open_db()
+    # FULL makes every COMMIT fsync the WAL; batching makes that one fsync
+    # per group instead of one per request. Checkpoints belong to the compactor.
+    conn.execute('PRAGMA synchronous = FULL')
+    conn.execute('PRAGMA wal_autocheckpoint = 0')
+    while True:
+        batch = [_write_queue.get()]
+        while len(batch) < app.config['METADATA_GROUP_COMMIT_MAX']:
+            try:
+                batch.append(_write_queue.get_nowait())
+            except queue.Empty:
+                break
+        
+        results = []
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            for mutation, args, kwargs, future in batch:
+                conn.execute('SAVEPOINT mutation')
+                try:
+                    result = mutation(conn, *args, **kwargs)
+                except Exception as e:
+                    conn.execute('ROLLBACK TO mutation')
+                    conn.execute('RELEASE mutation')
+                    results.append((future, None, e))
+                else:
+                    conn.execute('RELEASE mutation')
+                    results.append((future, result, None))
+            conn.execute('COMMIT')
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            for *_, future in batch:
+                future.set_exception(e)
+            continue
+        
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+        with _changes_cond:
+            _changes_cond.notify_all()
+
+def compact_metadata(conn=None):
+    # Fold the WAL into metadata.db and truncate it so restarts only replay
+    # what was written since the last compaction.
+    conn = conn or get_db()
+    return tuple(conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone())
+
+def _compactor_loop():
+    conn = open_db()
+    conn.execute('PRAGMA busy_timeout = 1000')
+    last_run = time.monotonic()
+    while True:
+        time.sleep(1)
+        try:
+            wal_size = os.path.getsize(DB_FILE + '-wal')
+        except OSError:
+            wal_size = 0
+        if wal_size == 0:
+            continue
+        if (wal_size >= app.config['METADATA_COMPACT_WAL_BYTES']
+                or time.monotonic() - last_run >= app.config['METADATA_COMPACT_INTERVAL']):
+            try:
+                run_write(prune_changes, time.time() - app.config['CHANGES_RETENTION'])
+                run_write(prune_jobs, time.time() - app.config['JOBS_RETENTION'])
+                compact_metadata(conn)
+            except sqlite3.Error:
+                pass
+            last_run = time.monotonic()
+
+def start_background_services():
+    # Threads are started lazily (and again after a fork) so that importing
+    # the module, e.g. from gunicorn's master, does not start them.
+    global _background_pid
+    if _background_pid == os.getpid():
+        return
+    with _background_lock:
+        if _background_pid == os.getpid():
+            return
+        threading.Thread(target=_writer_loop, name='metadata-writer', daemon=True).start()
+        threading.Thread(target=_compactor_loop, name='metadata-compactor', daemon=True).start()
+        _background_pid = os.getpid()
+
+def import_metadata_json(path=METADATA_FILE):
+    # One-shot migration of the legacy metadata.json layout. The JSON file is
+    # left in place as a backup; a marker in `meta` stops it being re-imported.
+    with db_transaction() as conn:
+        if conn.execute("SELECT 1 FROM meta WHERE key = 'json_imported'").fetchone():
+            return 0
+        count = 0
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                metadata = json.load(f)
+            for folder_name, info in metadata.items():
+                conn.execute('DELETE FROM exam_groups WHERE name = ?', (folder_name,))
+                conn.execute(
+                    'INSERT INTO exam_groups (name, company_name, exam_date, notes, created_at) VALUES (?, ?, ?, ?, ?)',
+                    (folder_name, info.get('company_name', folder_name), info.get('exam_date', ''),
+                     info.get('notes', ''), info.get('created_at', ''))
+                )
+                for f in info.get('files', []):
+                    conn.execute(
+                        'INSERT OR REPLACE INTO files (folder, name, size, upload_time, description) VALUES (?, ?, ?, ?, ?)',
+                        (folder_name, f.get('name', ''), f.get('size', 0),
+                         f.get('upload_time', ''), f.get('description', ''))
+                    )
+                count += 1
+        conn.execute("INSERT INTO meta (key, value) VALUES ('json_imported', ?)",
+                     (datetime.now().strftime('%Y-%m-%d %H:%M:%S'),))
+        return count
+
+def init_db():
+    conn = get_db()
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.executescript(DB_SCHEMA)
+    added = set()
+    for table, column, ddl in DB_ADDED_COLUMNS:
+        columns = [r['name'] for r in conn.execute(f'PRAGMA table_info({table})')]
+        if column not in columns:
+            conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {ddl}')
+            added.add((table, column))
+    conn.executescript(DB_POST_MIGRATION_SCHEMA)
+    import_metadata_json()
+    
+    with db_transaction() as conn:
+        if ('exam_groups', 'file_count') in added:
+            recount_exam_groups(conn)
+        if ('uploads', 'updated_at') in added:
+            conn.execute('UPDATE uploads SET updated_at = created_at')
+        rows = conn.execute('SELECT name, company_name FROM exam_groups WHERE search_name IS NULL').fetchall()
+        conn.executemany('UPDATE exam_groups SET search_name = ? WHERE name = ?',
+                         [(fold_text(r['company_name']), r['name']) for r in rows])
+
+init_db()
+
+# ---- Resumable chunked uploads ----
+
+def upload_staging_path(upload):
+    return os.path.join(app.config['BASE_UPLOAD_FOLDER'], upload['folder'], f".upload-{upload['id']}.part")
+
+def get_upload(upload_id):
+    return get_db().execute('SELECT * FROM uploads WHERE id = ?', (upload_id,)).fetchone()
+
+def upload_received_ranges(upload_id):
+    # Merge the recorded chunks into sorted, non-overlapping [start, end) ranges
+    ranges = []
+    rows = get_db().execute('SELECT start, length FROM upload_chunks WHERE upload_id = ? ORDER BY start',
+                            (upload_id,))
+    for row in rows:
+        start, end = row['start'], row['start'] + row['length']
+        if ranges and start <= ranges[-1][1]:
+            ranges[-1][1] = max(ranges[-1][1], end)
+        else:
+            ranges.append([start, end])
+    return ranges
+
+def upload_status(upload):
+    ranges = upload_received_ranges(upload['id'])
+    return {
+        'upload_id': upload['id'],
+        'folder_name': upload['folder'],
+        'filename': upload['name'],
+        'size': upload['size'],
+        'chunk_size': app.config['UPLOAD_CHUNK_SIZE'],
+        # Bytes received contiguously from the start of the file
+        'offset': ranges[0][1] if ranges and ranges[0][0] == 0 else 0,
+        'received': sum(end - start for start, end in ranges),
+        'ranges': ranges
+    }
+
+def expire_stale_uploads():
+    cutoff = time.time() - app.config['UPLOAD_STAGING_TTL']
+    stale = get_db().execute('SELECT * FROM uploads WHERE updated_at < ?', (cutoff,)).fetchall()
+    if not stale:
+        return
+    for upload in stale:
+        try:
+            os.remove(upload_staging_path(upload))
+        except FileNotFoundError:
+            pass
+    run_write(delete_uploads, [u['id'] for u in stale])
+
+# ---- Content-addressed blob store ----
+
+def blob_path(sha256):
+    return os.path.join(BLOB_FOLDER, sha256[:2], sha256)
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for buf in iter(lambda: f.read(app.config['UPLOAD_STREAM_BUFFER']), b''):
+            digest.update(buf)
+    return digest.hexdigest()
+
+def link_blob(sha256, dest_path, source_path=None):
+    # Make dest_path a hard link to the blob. source_path holds the same bytes
+    # and becomes the blob if the store doesn't have it yet; otherwise it is
+    # deleted, which is where the deduplication happens. Returns True if
+    # source_path became the blob.
+    path = blob_path(sha256)
+    tmp_path = f"{dest_path}.{uuid.uuid4().hex}.link"
+    created = False
+    while True:
+        if source_path is not None and not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(source_path, path)
+            source_path = None
+            created = True
+        try:
+            os.link(path, tmp_path)
+            break
+        except FileNotFoundError:
+            # The blob was garbage-collected meanwhile; move ours in instead
+            if source_path is None:
+                raise
+        except OSError:
+            # No hard links on this filesystem: keep a private copy
+            shutil.copyfile(path, tmp_path)
+            break
+    os.replace(tmp_path, dest_path)
+    if source_path is not None:
+        os.remove(source_path)
+    return created
+
+def discard_linked_files(paths, new_blobs):
+    # Undo a request whose metadata write failed: remove the files it linked
+    # and the blobs it moved into the store, unless something else has
+    # recorded a reference to them meanwhile
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    conn = get_db()
+    for sha256 in new_blobs:
+        if conn.execute('SELECT 1 FROM blobs WHERE sha256 = ?', (sha256,)).fetchone() is None:
+            try:
+                os.remove(blob_path(sha256))
+            except FileNotFoundError:
+                pass
+
+def remove_blob_files(sha256_list):
+    for sha256 in sha256_list or []:
+        try:
+            os.remove(blob_path(sha256))
+        except FileNotFoundError:
+            pass
+        shutil.rmtree(file_cache_dir(sha256), ignore_errors=True)
+        for size in THUMBNAIL_SIZES:
+            try:
+                os.remove(thumbnail_path(sha256, size))
+            except FileNotFoundError:
+                pass
+
+def file_cache_dir(sha256):
+    return os.path.join(CACHE_FOLDER, sha256[:2], sha256)
+
+def cached_file_source(folder_name, filename, entry):
+    # (path, content hash) of a stored file. The path is None when the cache
+    # already has `entry` (if given) for the content, so files packed into an
+    # archive stay viewable from what was cached. Files from before the blob
+    # store (see `flask adopt-blobs`) are hashed on the spot.
+    row = get_db().execute('SELECT sha256 FROM files WHERE folder = ? AND name = ?',
+                           (folder_name, filename)).fetchone()
+    if entry and row and row['sha256'] and os.path.exists(os.path.join(file_cache_dir(row['sha256']), entry)):
+        return None, row['sha256']
+    path = stored_file_path(folder_name, filename)
+    return path, row['sha256'] if row and row['sha256'] else hash_file(path)
+
+def write_cache_entry(sha256, name, build):
+    # build(tmp_path) writes a file or directory that is then moved into
+    # place, so readers never see a half-written entry. Two builders racing
+    # produce the same content; the loser's copy is dropped.
+    cache_dir = file_cache_dir(sha256)
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, name)
+    tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    try:
+        build(tmp_path)
+        os.replace(tmp_path, path)
+    except OSError:
+        if not os.path.exists(path):
+            raise
+    finally:
+        if os.path.isdir(tmp_path):
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        elif os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return path
+
+# ---- Streaming multipart uploads ----
+
+def stream_multipart_form(staging_dir_for):
+    # Parse the multipart body straight from the request stream instead of
+    # letting Werkzeug spool it. Every file part is written once, in large
+    # buffered chunks, to a temp file in staging_dir_for(form_so_far) while its
+    # size and SHA-256 are computed. Callers os.replace the temp files into
+    # place (same filesystem, so no copy) or discard them.
+    boundary = request.mimetype_params.get('boundary')
+    if request.mimetype != 'multipart/form-data' or not boundary:
+        return request.form.to_dict(), []
+    
+    buffer_size = app.config['UPLOAD_STREAM_BUFFER']
+    # The decoder's own limit also counts buffered file bytes, so field sizes
+    # are checked below instead.
+    max_field_size = request.max_form_memory_size
+    decoder = MultipartDecoder(boundary.encode('latin-1'), max_parts=request.max_form_parts)
+    form, parts = {}, []
+    part = None
+    
+    try:
+        while True:
+            data = request.stream.read(buffer_size)
+            decoder.receive_data(data or None)
+            event = decoder.next_event()
+            while not isinstance(event, (Epilogue, NeedData)):
+                if isinstance(event, Field):
+                    part = {'field': event.name, 'value': bytearray()}
+                elif isinstance(event, File):
+                    fd, temp_path = tempfile.mkstemp(prefix='.upload-', suffix='.part',
+                                                     dir=staging_dir_for(form))
+                    part = {
+                        'field': event.name,
+                        'filename': event.filename or '',
+                        'temp_path': temp_path,
+                        'size': 0,
+                        'out': os.fdopen(fd, 'wb', buffering=buffer_size),
+                        'hash': hashlib.sha256()
+                    }
+                    parts.append(part)
+                elif isinstance(event, Data):
+                    if 'value' in part:
+                        part['value'] += event.data
+                        if max_field_size is not None and len(part['value']) > max_field_size:
+                            raise RequestEntityTooLarge()
+                        if not event.more_data:
+                            form[part['field']] = part['value'].decode('utf-8', 'replace')
+                    else:
+                        part['out'].write(event.data)
+                        part['hash'].update(event.data)
+                        part['size'] += len(event.data)
+                        if not event.more_data:
+                            part.pop('out').close()
+                            part['sha256'] = part.pop('hash').hexdigest()
+                event = decoder.next_event()
+            if not data:
+                break
+        
+        if any('out' in p for p in parts):
+            raise ValueError('Dữ liệu upload bị gián đoạn')
+    except BaseException:
+        discard_streamed_files(parts)
+        raise
+    
+    return form, parts
+
+def discard_streamed_files(parts):
+    for part in parts:
+        if 'out' in part:
+            part.pop('out').close()
+        try:
+            os.remove(part['temp_path'])
+        except FileNotFoundError:
+            pass
+
+def streamed_file_info(part, filename):
+    return {
+        'name': filename,
+        'size': part['size'],
+        'upload_time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'description': '',
+        'sha256': part['sha256']
+    }
+
+# ---- Full-text search ----
+# Every stored file gets a file_text row: its name and extracted text folded
+# (fold_text) for the FTS5 index, and the original text for snippets. The
+# folded text is kept character-aligned with the original, so a match
+# position in one is a snippet position in the other.
+
+_fold_table = {}
+
+def fold_aligned(text):
+    # fold_text one character at a time: same length as the input
+    for c in set(text):
+        if ord(c) not in _fold_table:
+            folded = fold_text(c)
+            _fold_table[ord(c)] = folded if len(folded) == 1 else c
+    return text.translate(_fold_table)
+
+def extract_docx_text(path):
+    document = docx.Document(path)
+    yield from (p.text for p in document.paragraphs)
+    for table in document.tables:
+        for row in table.rows:
+            yield from (cell.text for cell in row.cells)
+
+def extract_xlsx_text(path):
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        for sheet in workbook.worksheets:
+            for row in sheet.iter_rows(values_only=True):
+                yield ' '.join(str(v) for v in row if v is not None)
+    finally:
+        workbook.close()
+
+def extract_pdf_text(path):
+    for page in PyPDF2.PdfReader(path).pages:
+        yield page.extract_text() or ''
+
+def extract_csv_text(path):
+    with open(path, 'rb') as f:
+        raw = f.read(app.config['SEARCH_MAX_TEXT'] * 4)
+    try:
+        # Not final: the cap may cut a multi-byte character in two
+        yield codecs.getincrementaldecoder('utf-8-sig')().decode(raw, final=False)
+    except UnicodeDecodeError:
+        # Excel on Vietnamese Windows saves CSV as cp1258
+        yield raw.decode('cp1258', errors='replace')
+
+TEXT_EXTRACTORS = {
+    'docx': lambda: docx and extract_docx_text,
+    'xlsx': lambda: openpyxl and extract_xlsx_text,
+    'pdf': lambda: PyPDF2 and extract_pdf_text,
+    'csv': lambda: extract_csv_text
+}
+
+def extract_text(path):
+    # Whitespace-collapsed NFC text, capped at SEARCH_MAX_TEXT characters;
+    # '' for formats we can't read (images, archives, .doc/.xls).
+    ext = path.rsplit('.', 1)[-1].lower()
+    extractor = TEXT_EXTRACTORS.get(ext, lambda: None)()
+    if not extractor:
+        return ''
+    
+    limit = app.config['SEARCH_MAX_TEXT']
+    chunks, length = [], 0
+    for chunk in extractor(path):
+        chunk = ' '.join(chunk.split())
+        if chunk:
+            chunks.append(chunk)
+            length += len(chunk) + 1
+            if length >= limit:
+                break
+    return unicodedata.normalize('NFC', ' '.join(chunks))[:limit]
+
+def cached_file_text(file_row):
+    # Text known without extracting: content already indexed under the same
+    # hash, or a format we can't read (indexed by name only).
+    if file_row['name'].rsplit('.', 1)[-1].lower() not in TEXT_EXTRACTORS:
+        return ''
+    if not file_row['sha256']:
+        return None
+    row = get_db().execute('''
+        SELECT t.text FROM file_text t JOIN files f ON f.id = t.file_id
+        WHERE f.sha256 = ? LIMIT 1
+    ''', (file_row['sha256'],)).fetchone()
+    return row['text'] if row else None
+
+def read_file_text(path, sha256=None):
+    # A missing file is retried (e.g. storage not mounted yet); a damaged
+    # document won't read better on retry, so it is indexed by name only.
+    os.stat(path)
+    try:
+        return extract_text(path)
+    except OSError:
+        raise
+    except Exception:
+        return ''
+
+def apply_file_text(conn, file_row, text):
+    store_file_texts(conn, file_row['folder'], [(file_row['name'], file_row['sha256'], text)])
+
+def search_tokens(query):
+    return re.findall(r'\w+', fold_text(query))
+
+def search_match_expression(tokens):
+    # Every token must occur; the last one may be a prefix (search as you type)
+    return ' '.join(f'"{t}"' for t in tokens[:-1]) + f' "{tokens[-1]}"*'
+
+def search_snippet(snippet, start, tokens):
+    # Highlight ranges of the query tokens inside the snippet
+    folded = fold_aligned(snippet)
+    highlights = []
+    for token in tokens:
+        for match in re.finditer(re.escape(token), folded):
+            highlights.append([match.start(), match.end()])
+    highlights.sort()
+    prefix = '…' if start > 1 else ''
+    return prefix + snippet, [[a + len(prefix), b + len(prefix)] for a, b in highlights]
+
+# ---- Spreadsheet previews ----
+# The first sheet of an xlsx or csv file is converted once into a columnar
+# cache entry: table.json (column names, types and stats) plus one .npy
+# array per numeric column, and utf-8 bytes with row offsets per text
+# column. Row windows are sliced from memory-mapped arrays, so a page of a
+# large sheet costs about as much as a page of a small one.
+
+PREVIEW_EXTENSIONS = {'xlsx', 'csv'}
+
+def read_xlsx_rows(path):
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        yield from workbook.worksheets[0].iter_rows(values_only=True)
+    finally:
+        workbook.close()
+
+def csv_encoding(path):
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    try:
+        with open(path, 'rb') as f:
+            for buf in iter(lambda: f.read(app.config['UPLOAD_STREAM_BUFFER']), b''):
+                decoder.decode(buf)
+        decoder.decode(b'', final=True)
+        return 'utf-8-sig'
+    except UnicodeDecodeError:
+        # Excel on Vietnamese Windows saves CSV as cp1258
+        return 'cp1258'
+
+def read_csv_rows(path):
+    with open(path, encoding=csv_encoding(path), errors='replace', newline='') as f:
+        try:
+            dialect = csv.Sniffer().sniff(f.read(64 * 1024), delimiters=',;\t')
+        except csv.Error:
+            dialect = csv.excel
+        f.seek(0)
+        yield from csv.reader(f, dialect)
+
+def table_number(value):
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            return float(value.strip())
+        except ValueError:
+            return None
+    return None
+
+def table_text(value):
+    if value is None:
+        return ''
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d') if value.time() == datetime.min.time() else value.isoformat(' ')
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)[:app.config['PREVIEW_MAX_CELL']]
+
+def table_column_stats(values, numbers):
+    filled = [v for v in values if v not in (None, '')]
+    stats = {'count': len(filled), 'empty': len(values) - len(filled)}
+    if numbers is not None:
+        present = numbers[~np.isnan(numbers)]
+        if present.size:
+            stats.update(min=float(present.min()), max=float(present.max()),
+                         mean=float(present.mean()), sum=float(present.sum()))
+    else:
+        counts = {}
+        for v in filled:
+            text = table_text(v)
+            counts[text] = counts.get(text, 0) + 1
+        stats['distinct'] = len(counts)
+        stats['top'] = sorted(counts.items(), key=lambda item: -item[1])[:5]
+    return stats
+
+def build_table_preview(path, tmp_path):
+    ext = path.rsplit('.', 1)[-1].lower()
+    max_rows = app.config['PREVIEW_MAX_ROWS']
+    max_columns = app.config['PREVIEW_MAX_COLUMNS']
+    header, columns, truncated = None, [], False
+    for row in (read_xlsx_rows if ext == 'xlsx' else read_csv_rows)(path):
+        row = list(row[:max_columns])
+        if not any(v not in (None, '') for v in row):
+            continue
+        if header is None:
+            header = row
+            columns = [[] for _ in header]
+            continue
+        if columns and len(columns[0]) >= max_rows:
+            truncated = True
+            break
+        while len(columns) < len(row):
+            header.append(None)
+            columns.append([None] * (len(columns[0]) if columns else 0))
+        for i, column in enumerate(columns):
+            column.append(row[i] if i < len(row) else None)
+    
+    os.makedirs(tmp_path)
+    meta = {'total_rows': len(columns[0]) if columns else 0, 'truncated': truncated, 'columns': []}
+    for i, values in enumerate(columns):
+        name = table_text(header[i]).strip() or f'Cột {i + 1}'
+        numbers = [table_number(v) for v in values]
+        numeric = all(n is not None or v in (None, '') for n, v in zip(numbers, values)) and any(
+            n is not None for n in numbers)
+        if numeric:
+            array = np.array([np.nan if n is None else n for n in numbers], dtype=np.float64)
+            np.save(os.path.join(tmp_path, f'{i}.npy'), array)
+        else:
+            array = None
+            encoded = [table_text(v).encode('utf-8') for v in values]
+            offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+            np.cumsum([len(b) for b in encoded], out=offsets[1:])
+            np.save(os.path.join(tmp_path, f'{i}.offsets.npy'), offsets)
+            np.save(os.path.join(tmp_path, f'{i}.data.npy'), np.frombuffer(b''.join(encoded), dtype=np.uint8))
+        meta['columns'].append({'name': name, 'type': 'number' if numeric else 'text',
+                                'stats': table_column_stats(values, array)})
+    with open(os.path.join(tmp_path, 'table.json'), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False)
+
+def table_preview_path(sha256):
+    return os.path.join(file_cache_dir(sha256), 'table')
+
+def ensure_table_preview(path, sha256):
+    # Runs in a job worker after upload; requests build it themselves for
+    # files stored before previews existed.
+    if not os.path.exists(table_preview_path(sha256)):
+        write_cache_entry(sha256, 'table', lambda tmp_path: build_table_preview(path, tmp_path))
+
+def cached_table_preview(file_row):
+    # Nothing to do for other formats, or files without a hash (their
+    # preview is built on the first request)
+    if file_row['name'].rsplit('.', 1)[-1].lower() not in PREVIEW_EXTENSIONS or not file_row['sha256']:
+        return False
+    return True if os.path.exists(table_preview_path(file_row['sha256'])) else None
+
+class PreviewNotReady(Exception):
+    def __init__(self):
+        super().__init__('Đang chuẩn bị bản xem trước, vui lòng thử lại sau giây lát')
+
+def stored_file_path(folder_name, filename):
+    path = os.path.abspath(os.path.join(app.config['BASE_UPLOAD_FOLDER'], folder_name, filename))
+    if not os.path.exists(path):
+        if archived_files(get_db(), folder_name, filename):
+            raise ValueError('File đã được chuyển vào kho lưu trữ, vui lòng tải về để xem')
+        raise ValueError('File không tồn tại')
+    return path
+
+def check_job_pending(folder_name, filename, kind):
+    # A cache entry missing while its job is queued will exist shortly;
+    # otherwise (older files, failed jobs) the caller builds it itself.
+    pending = get_db().execute('''
+        SELECT 1 FROM jobs j JOIN files f ON f.id = j.file_id
+        WHERE f.folder = ? AND f.name = ? AND j.kind = ? AND j.status IN ('queued', 'running')
+    ''', (folder_name, filename, kind)).fetchone()
+    if pending:
+        raise PreviewNotReady()
 
-def load_metadata():
-    if os.path.exists(METADATA_FILE):
-        with open(METADATA_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    return {}
+def load_table_preview(folder_name, filename):
+    # (cache path, table.json, content hash) of a stored xlsx/csv file
+    ext = filename.rsplit('.', 1)[-1].lower()
+    if ext not in PREVIEW_EXTENSIONS:
+        raise ValueError('Chỉ xem trước được file xlsx và csv')
+    if np is None or (ext == 'xlsx' and openpyxl is None):
+        raise ValueError('Máy chủ chưa cài thư viện để xem trước file này')
+    path, sha256 = cached_file_source(folder_name, filename, 'table')
+    preview_path = table_preview_path(sha256)
+    if path is not None:
+        check_job_pending(folder_name, filename, 'table_preview')
+        ensure_table_preview(path, sha256)
+    with open(os.path.join(preview_path, 'table.json'), encoding='utf-8') as f:
+        return preview_path, json.load(f), sha256
 
-def save_metadata(data):
-    with open(METADATA_FILE, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+def read_table_rows(preview_path, meta, offset, limit):
+    end = min(offset + limit, meta['total_rows'])
+    columns = []
+    for i, column in enumerate(meta['columns']):
+        if column['type'] == 'number':
+            array = np.load(os.path.join(preview_path, f'{i}.npy'), mmap_mode='r')[offset:end]
+            columns.append([None if np.isnan(n) else int(n) if n.is_integer() else float(n) for n in array])
+        else:
+            offsets = np.load(os.path.join(preview_path, f'{i}.offsets.npy'), mmap_mode='r')[offset:end + 1]
+            data = np.load(os.path.join(preview_path, f'{i}.data.npy'), mmap_mode='r')
+            start = int(offsets[0]) if len(offsets) else 0
+            chunk = bytes(data[start:int(offsets[-1])]) if len(offsets) else b''
+            columns.append([chunk[a - start:b - start].decode('utf-8')
+                            for a, b in zip(offsets[:-1].tolist(), offsets[1:].tolist())])
+    return [list(row) for row in zip(*columns)] if columns else []
+
+# ---- PDF pages ----
+# Each PDF is indexed once: page count, page sizes and the text of every
+# page go to pdf.json and pdf_text.txt in its cache entry, so the viewer and
+# per-page text never reopen the file. Single pages are cut out as small
+# PDFs of their own; PyPDF2 follows the cross-reference table and reads only
+# the objects those pages use, so page 1 of a 40 MB scan costs about the
+# size of that page, and cut pages are cached as well.
+
+def build_pdf_index(path, sha256):
+    reader = PyPDF2.PdfReader(path)
+    if reader.is_encrypted:
+        reader.decrypt('')
+    limit = app.config['PDF_MAX_PAGE_TEXT']
+    pages, offsets, texts = [], [0], []
+    for page in reader.pages:
+        box = page.mediabox
+        pages.append({'width': float(box.width), 'height': float(box.height)})
+        try:
+            text = ' '.join((page.extract_text() or '').split())[:limit]
+        except Exception:
+            text = ''
+        texts.append(text.encode('utf-8'))
+        offsets.append(offsets[-1] + len(texts[-1]))
+    
+    def write_text(tmp_path):
+        with open(tmp_path, 'wb') as f:
+            f.write(b''.join(texts))
+    
+    def write_index(tmp_path):
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'page_count': len(pages), 'pages': pages, 'text_offsets': offsets}, f)
+    
+    # The index is written last: once it exists, so does the text
+    write_cache_entry(sha256, 'pdf_text.txt', write_text)
+    write_cache_entry(sha256, 'pdf.json', write_index)
+
+def ensure_pdf_index(path, sha256):
+    if not os.path.exists(os.path.join(file_cache_dir(sha256), 'pdf.json')):
+        build_pdf_index(path, sha256)
+
+def cached_pdf_index(file_row):
+    if not file_row['name'].lower().endswith('.pdf') or not file_row['sha256']:
+        return False
+    return True if os.path.exists(os.path.join(file_cache_dir(file_row['sha256']), 'pdf.json')) else None
+
+def check_pdf(filename):
+    if not filename.lower().endswith('.pdf'):
+        raise ValueError('File không phải PDF')
+    if PyPDF2 is None:
+        raise ValueError('Máy chủ chưa cài thư viện để xem trước file này')
+
+def load_pdf_index(folder_name, filename):
+    # (pdf.json, content hash) of a stored PDF
+    check_pdf(filename)
+    path, sha256 = cached_file_source(folder_name, filename, 'pdf.json')
+    index_path = os.path.join(file_cache_dir(sha256), 'pdf.json')
+    if path is not None:
+        check_job_pending(folder_name, filename, 'pdf_index')
+        build_pdf_index(path, sha256)
+    with open(index_path, encoding='utf-8') as f:
+        return json.load(f), sha256
+
+def read_pdf_text(sha256, index, first, last):
+    offsets = index['text_offsets']
+    with open(os.path.join(file_cache_dir(sha256), 'pdf_text.txt'), 'rb') as f:
+        f.seek(offsets[first - 1])
+        data = f.read(offsets[last] - offsets[first - 1])
+    base = offsets[first - 1]
+    return [data[offsets[n - 1] - base:offsets[n] - base].decode('utf-8') for n in range(first, last + 1)]
+
+def write_pdf_pages(path, first, last, out):
+    reader = PyPDF2.PdfReader(path)
+    if reader.is_encrypted:
+        reader.decrypt('')
+    if last > len(reader.pages):
+        raise ValueError('Trang không tồn tại')
+    writer = PyPDF2.PdfWriter()
+    for n in range(first - 1, last):
+        writer.add_page(reader.pages[n])
+    writer.write(out)
+
+def pdf_page_range(args, page_count=None):
+    # ?first=&last= (1-based, inclusive); last defaults to first
+    first = args.get('first', 1, type=int)
+    last = args.get('last', first, type=int)
+    if first < 1 or last < first or (page_count is not None and last > page_count):
+        raise ValueError('Trang không tồn tại')
+    return first, last
+
+# ---- ZIP members ----
+# The central directory of an uploaded ZIP is parsed once into zip.json in
+# its cache entry: name, sizes, compression, CRC and the offset of each
+# member's local header. Listing reads only that; extracting one member
+# seeks straight to its data in the stored file and inflates it while it
+# is sent, whatever the size of the rest of the archive.
+
+ZIP_METHODS = {zipfile.ZIP_STORED: 'stored', zipfile.ZIP_DEFLATED: 'deflated',
+               zipfile.ZIP_BZIP2: 'bzip2', zipfile.ZIP_LZMA: 'lzma'}
+
+def build_zip_index(path, sha256):
+    with zipfile.ZipFile(path) as archive:
+        members = [{
+            'name': info.filename,
+            'size': info.file_size,
+            'compressed_size': info.compress_size,
+            'method': ZIP_METHODS.get(info.compress_type, str(info.compress_type)),
+            'modified': '%04d-%02d-%02d %02d:%02d:%02d' % info.date_time,
+            'crc': info.CRC,
+            'encrypted': bool(info.flag_bits & 0x1),
+            'is_dir': info.is_dir(),
+            'offset': info.header_offset
+        } for info in archive.infolist()]
+    
+    def write_index(tmp_path):
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'members': members}, f, ensure_ascii=False)
+    
+    write_cache_entry(sha256, 'zip.json', write_index)
+
+def ensure_zip_index(path, sha256):
+    if not os.path.exists(os.path.join(file_cache_dir(sha256), 'zip.json')):
+        build_zip_index(path, sha256)
+
+def cached_zip_index(file_row):
+    if not file_row['name'].lower().endswith('.zip') or not file_row['sha256']:
+        return False
+    return True if os.path.exists(os.path.join(file_cache_dir(file_row['sha256']), 'zip.json')) else None
+
+@lru_cache(maxsize=16)
+def read_zip_index(sha256):
+    # Archives of DICOM exports hold many thousands of members; keep the most
+    # recently browsed ones parsed, with a by-name lookup
+    with open(os.path.join(file_cache_dir(sha256), 'zip.json'), encoding='utf-8') as f:
+        members = json.load(f)['members']
+    return members, {m['name']: m for m in members}
+
+def load_zip_index(folder_name, filename):
+    # (members, members by name, content hash) of a stored ZIP
+    if not filename.lower().endswith('.zip'):
+        raise ValueError('File không phải ZIP')
+    path, sha256 = cached_file_source(folder_name, filename, 'zip.json')
+    if path is not None:
+        check_job_pending(folder_name, filename, 'zip_index')
+        build_zip_index(path, sha256)
+    return (*read_zip_index(sha256), sha256)
+
+def zip_member_decompressor(member):
+    if member['encrypted']:
+        raise ValueError('File trong ZIP được đặt mật khẩu')
+    if member['method'] == 'stored':
+        return None
+    if member['method'] == 'deflated':
+        return zlib.decompressobj(-zlib.MAX_WBITS)
+    if member['method'] == 'bzip2':
+        return bz2.BZ2Decompressor()
+    if member['method'] == 'lzma':
+        # zipfile's own decoder: ZIP stores LZMA with a header of its own
+        return zipfile.LZMADecompressor()
+    raise ValueError(f"Không hỗ trợ kiểu nén {member['method']}")
+
+def seek_zip_member_data(f, member):
+    # Skip the member's local header (its name and extra field lengths may
+    # differ from the central directory); returns the data offset
+    f.seek(member['offset'])
+    header = f.read(30)
+    signature, *_, name_length, extra_length = struct.unpack('<4s2B4HL2L2H', header)
+    if signature != b'PK\x03\x04':
+        raise zipfile.BadZipFile('Bad local file header')
+    return f.seek(name_length + extra_length, os.SEEK_CUR)
+
+def iter_zip_member(path, member, decompressor):
+    # Inflate the member's data in chunks
+    buffer_size = app.config['UPLOAD_STREAM_BUFFER']
+    with open(path, 'rb') as f:
+        seek_zip_member_data(f, member)
+        
+        remaining, crc = member['compressed_size'], 0
+        while remaining > 0:
+            data = f.read(min(buffer_size, remaining))
+            if not data:
+                raise zipfile.BadZipFile('Truncated member')
+            remaining -= len(data)
+            if decompressor is not None:
+                data = decompressor.decompress(data)
+            crc = zlib.crc32(data, crc)
+            yield data
+        if decompressor is not None and hasattr(decompressor, 'flush'):
+            data = decompressor.flush()
+            crc = zlib.crc32(data, crc)
+            yield data
+    # Headers are already sent; failing here makes the server drop the
+    # connection so the client sees a broken download, not a bad file
+    if crc != member['crc']:
+        raise zipfile.BadZipFile(f"Bad CRC-32 for {member['name']}")
+
+# ---- Thumbnails ----
+# jpg/png uploads get JPEG thumbnails in a few fixed sizes (longest edge in
+# pixels), made by a background job. They are named by content hash, so
+# their URLs never change meaning and browsers may keep them for a year.
+# The cache is bounded by THUMBNAIL_CACHE_BYTES: file mtimes serve as the
+# LRU clock (refreshed when a thumbnail is served) and the evictor thread
+# drops the oldest beyond the budget; an evicted thumbnail is made again on
+# its next request.
+
+THUMBNAIL_SIZES = {'small': 96, 'medium': 480, 'large': 1280}
+THUMBNAIL_EXTENSIONS = {'jpg', 'jpeg', 'png'}
+
+def thumbnail_path(sha256, size):
+    return os.path.join(THUMBNAIL_FOLDER, sha256[:2], f'{sha256}-{size}.jpg')
+
+def thumbnail_url(file_row):
+    if (Image is None or not file_row['sha256']
+            or file_row['name'].rsplit('.', 1)[-1].lower() not in THUMBNAIL_EXTENSIONS):
+        return None
+    return f"/thumbnails/{file_row['sha256']}/small.jpg"
+
+def make_thumbnails(path, sha256, sizes=THUMBNAIL_SIZES):
+    missing = [size for size in sizes if not os.path.exists(thumbnail_path(sha256, size))]
+    if not missing:
+        return
+    with Image.open(path) as image:
+        # JPEG can decode at 1/2, 1/4 or 1/8 scale, much faster than full size
+        edge = max(THUMBNAIL_SIZES[size] for size in missing)
+        image.draft('RGB', (edge, edge))
+        image = ImageOps.exif_transpose(image)
+        if image.mode.startswith('I'):
+            # 16-bit greyscale (common from ultrasound consoles) scaled to 8 bits
+            image = image.point(lambda v: v * (1 / 256)).convert('L')
+        elif image.mode in ('RGBA', 'LA', 'P'):
+            image = image.convert('RGBA')
+            background = Image.new('RGB', image.size, 'white')
+            background.paste(image, mask=image.getchannel('A'))
+            image = background
+        elif image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        # Largest first, each made from the previous one
+        for size in sorted(missing, key=lambda size: -THUMBNAIL_SIZES[size]):
+            edge = THUMBNAIL_SIZES[size]
+            image.thumbnail((edge, edge), Image.LANCZOS)
+            path_out = thumbnail_path(sha256, size)
+            os.makedirs(os.path.dirname(path_out), exist_ok=True)
+            tmp_path = f'{path_out}.{uuid.uuid4().hex}.tmp'
+            image.save(tmp_path, 'JPEG', quality=app.config['THUMBNAIL_QUALITY'], optimize=True)
+            os.replace(tmp_path, path_out)
+
+def make_upload_thumbnails(path, sha256):
+    # A file that isn't really an image won't become one on retry
+    try:
+        make_thumbnails(path, sha256)
+    except (Image.UnidentifiedImageError, Image.DecompressionBombError):
+        pass
+
+def cached_thumbnails(file_row):
+    if thumbnail_url(file_row) is None:
+        return False
+    exists = all(os.path.exists(thumbnail_path(file_row['sha256'], size)) for size in THUMBNAIL_SIZES)
+    return True if exists else None
+
+def evict_thumbnails(limit):
+    entries, total = [], 0
+    for root, _, names in os.walk(THUMBNAIL_FOLDER):
+        for name in names:
+            try:
+                st = os.stat(os.path.join(root, name))
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, os.path.join(root, name)))
+            total += st.st_size
+    if total <= limit:
+        return 0
+    # Evict down to 90% so the next few thumbnails don't trigger another pass
+    removed = 0
+    for _, size, path in sorted(entries):
+        if total <= limit * 0.9:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        removed += 1
+    return removed
+
+def _thumbnail_evictor_loop():
+    while True:
+        time.sleep(app.config['THUMBNAIL_EVICT_INTERVAL'])
+        try:
+            evict_thumbnails(app.config['THUMBNAIL_CACHE_BYTES'])
+        except OSError:
+            pass
+
+# ---- Image optimisation ----
+# Ultrasound consoles save screenshots as barely compressed PNGs, often RGB
+# or RGBA when every pixel is grey and opaque. A job rewrites each PNG upload
+# losslessly: the smallest colour type that holds every pixel exactly (an
+# opaque alpha channel dropped, greyscale, or a palette of at most 256
+# colours), maximum zlib effort, and the metadata chunks carried over. The
+# copy is decoded again and compared with the original pixel for pixel; it
+# replaces the stored file only if it is identical and enough smaller.
+# PNGs Pillow can't round-trip exactly (16-bit colour, animated) are left
+# alone. Files keep their name and type, so nothing changes for users.
+
+OPTIMIZE_EXTENSIONS = {'png'}
+# Chunks copied verbatim; Pillow writes the palette, transparency, ICC
+# profile, resolution and EXIF itself
+PNG_KEPT_CHUNKS = {b'cHRM', b'cICP', b'gAMA', b'sRGB', b'tIME', b'tEXt', b'zTXt', b'iTXt'}
+
+def png_chunks(path):
+    # (type, data) of every chunk but the image data, or None if not a PNG
+    chunks = []
+    with open(path, 'rb') as f:
+        if f.read(8) != b'\x89PNG\r\n\x1a\n':
+            return None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                break
+            length, chunk_type = struct.unpack('>L4s', header)
+            if chunk_type == b'IDAT':
+                f.seek(length + 4, os.SEEK_CUR)
+                continue
+            chunks.append((chunk_type, f.read(length)))
+            f.seek(4, os.SEEK_CUR)
+            if chunk_type == b'IEND':
+                break
+    return chunks
+
+def reduce_png_mode(image):
+    # The image in the smallest mode that holds all its pixels exactly
+    if image.mode not in ('RGB', 'RGBA', 'LA') or 'transparency' in image.info:
+        return image
+    if image.mode in ('RGBA', 'LA') and image.getchannel('A').getextrema() == (255, 255):
+        image = image.convert(image.mode[:-1])
+    if image.mode == 'RGB':
+        red, green, blue = image.split()
+        if ImageChops.difference(red, green).getbbox() is None and ImageChops.difference(red, blue).getbbox() is None:
+            return red
+        colors = image.getcolors(256)
+        if colors:
+            palette = Image.new('P', (1, 1))
+            palette.putpalette([value for _, color in colors for value in color])
+            return image.quantize(palette=palette, dither=Image.Dither.NONE)
+    return image
+
+def same_pixels(a, b):
+    if a.mode == 'P' or b.mode == 'P':
+        a, b = a.convert('RGBA'), b.convert('RGBA')
+    elif a.mode != b.mode:
+        b = b.convert(a.mode)
+    return a.size == b.size and a.tobytes() == b.tobytes()
+
+def optimize_png(path, sha256):
+    # Runs in a worker. Writes the optimised copy next to the blob store and
+    # returns {'path', 'sha256', 'size'}, or None if it isn't worth keeping.
+    chunks = png_chunks(path)
+    if not chunks or chunks[0][0] != b'IHDR':
+        return None
+    bit_depth, color_type = chunks[0][1][8], chunks[0][1][9]
+    if any(chunk_type == b'acTL' for chunk_type, _ in chunks) or (bit_depth == 16 and color_type != 0):
+        return None
+    pnginfo = PngImagePlugin.PngInfo()
+    for chunk_type, data in chunks:
+        # Private chunks (lower-case second letter) may hold vendor data
+        if chunk_type in PNG_KEPT_CHUNKS or chunk_type[1:2].islower():
+            pnginfo.add(chunk_type, data)
+    
+    os.makedirs(BLOB_FOLDER, exist_ok=True)
+    tmp_path = os.path.abspath(os.path.join(BLOB_FOLDER, f'.optimize-{uuid.uuid4().hex}.png'))
+    worth_it = False
+    try:
+        with Image.open(path) as original:
+            original.load()
+            reduce_png_mode(original).save(
+                tmp_path, 'PNG', optimize=True, pnginfo=pnginfo, icc_profile=original.info.get('icc_profile'),
+                dpi=original.info.get('dpi'), exif=original.info.get('exif'))
+            with Image.open(tmp_path) as optimized:
+                worth_it = same_pixels(original, optimized) and (
+                    os.path.getsize(tmp_path) <= os.path.getsize(path) * (1 - app.config['IMAGE_OPTIMIZE_MIN_SAVING']))
+    except (Image.UnidentifiedImageError, Image.DecompressionBombError):
+        # Not really an image; it won't become one on retry
+        pass
+    finally:
+        if not worth_it and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    if not worth_it:
+        return None
+    return {'path': tmp_path, 'sha256': hash_file(tmp_path), 'size': os.path.getsize(tmp_path)}
+
+def cached_optimized_image(file_row):
+    # The same upload optimised before: share its optimised blob
+    if not file_row['sha256']:
+        return None
+    row = get_db().execute('SELECT sha256, size FROM files WHERE original_sha256 = ? LIMIT 1',
+                           (file_row['sha256'],)).fetchone()
+    return {'path': None, 'sha256': row['sha256'], 'size': row['size']} if row else None
+
+def apply_optimized_image(conn, file_row, result):
+    # Point the file at its optimised copy unless it was replaced meanwhile,
+    # and return the blobs no longer referenced. The file on disk is swapped
+    # by finalize_optimized_image once this is committed.
+    if result and result['path'] is None and conn.execute(
+            'SELECT 1 FROM blobs WHERE sha256 = ?', (result['sha256'],)).fetchone() is None:
+        result = None
+    row = conn.execute('SELECT id, size, sha256 FROM files WHERE folder = ? AND name = ?',
+                       (file_row['folder'], file_row['name'])).fetchone()
+    if not result or row is None or not row['sha256'] or row['sha256'] != file_row['sha256']:
+        return []
+    
+    keep = bool(app.config['IMAGE_KEEP_ORIGINALS'])
+    freed = [] if keep else release_blobs(conn, file_row['folder'], file_row['name'])
+    conn.execute('''
+        UPDATE files SET sha256 = ?, size = ?, original_size = ?, original_sha256 = ?, original_kept = ?
+        WHERE id = ?
+    ''', (result['sha256'], result['size'], row['size'], row['sha256'], int(keep), row['id']))
+    add_blob_ref(conn, result['sha256'], result['size'])
+    bump_version(conn, file_row['folder'])
+    return freed
+
+def finalize_optimized_image(file_row, result):
+    # After apply_optimized_image's batch: swap the stored file only if the
+    # metadata now describes the optimised copy (not rolled back, not deleted
+    # or replaced meanwhile), otherwise drop the copy
+    if not result:
+        return
+    row = get_db().execute('SELECT sha256, original_sha256 FROM files WHERE folder = ? AND name = ?',
+                           (file_row['folder'], file_row['name'])).fetchone()
+    dest_path = os.path.join(app.config['BASE_UPLOAD_FOLDER'], file_row['folder'], file_row['name'])
+    if (row and row['sha256'] == result['sha256'] and row['original_sha256'] == file_row['sha256']
+            and os.path.exists(dest_path)):
+        link_blob(result['sha256'], dest_path, result['path'])
+        # The pixels are unchanged, and so are the thumbnails
+        for size in THUMBNAIL_SIZES:
+            try:
+                os.link(thumbnail_path(file_row['sha256'], size), thumbnail_path(result['sha256'], size))
+            except OSError:
+                pass
+    elif result['path'] and os.path.exists(result['path']):
+        os.remove(result['path'])
+
+# ---- Background jobs ----
+# Processing after an upload (text extraction, ...) runs off the request path.
+# insert_file queues the jobs in the same transaction that stores the file, so
+# they survive a restart. Each web process runs a dispatcher thread that
+# leases due jobs, runs them in a process pool and writes the results back
+# through the writer thread. Leases are renewed while jobs run; a job whose
+# owner died is taken over once its lease expires.
+#
+# A job kind has `run(path, sha256)`, executed in a worker process
+# (module-level, so it can be pickled), optionally `apply(conn, file_row,
+# result)`, executed as a mutation (it may return blobs it freed, which are
+# then deleted), optionally `finalize(file_row, result)`, called once that
+# batch committed or failed, for file changes that must not run inside the
+# transaction, and optionally `cached(file_row)`, which returns the result
+# without a worker when it is already known, else None.
+
+JOB_KINDS = {
+    'index_text': {'run': read_file_text, 'apply': apply_file_text, 'cached': cached_file_text},
+    'table_preview': {'run': ensure_table_preview, 'cached': cached_table_preview},
+    'pdf_index': {'run': ensure_pdf_index, 'cached': cached_pdf_index},
+    'zip_index': {'run': ensure_zip_index, 'cached': cached_zip_index},
+    'thumbnails': {'run': make_upload_thumbnails, 'cached': cached_thumbnails},
+    'optimize_image': {'run': optimize_png, 'apply': apply_optimized_image, 'finalize': finalize_optimized_image,
+                       'cached': cached_optimized_image}
+}
+
+def file_jobs(filename):
+    # Kinds of job to run for a newly stored file
+    kinds = ['index_text']
+    if np is not None and filename.rsplit('.', 1)[-1].lower() in PREVIEW_EXTENSIONS:
+        kinds.append('table_preview')
+    if PyPDF2 is not None and filename.lower().endswith('.pdf'):
+        kinds.append('pdf_index')
+    if filename.lower().endswith('.zip'):
+        kinds.append('zip_index')
+    if Image is not None and filename.rsplit('.', 1)[-1].lower() in THUMBNAIL_EXTENSIONS:
+        kinds.append('thumbnails')
+    if (Image is not None and app.config['IMAGE_OPTIMIZE']
+            and filename.rsplit('.', 1)[-1].lower() in OPTIMIZE_EXTENSIONS):
+        kinds.append('optimize_image')
+    return kinds
+
+def run_job(kind, path, sha256):
+    return JOB_KINDS[kind]['run'](path, sha256)
+
+_jobs_wakeup = threading.Event()
+_jobs_lock = threading.Lock()
+_jobs_pid = None
+
+def _fail_job_quietly(job, owner, error):
+    # Called from the dispatcher, which must survive anything a job does;
+    # if even this fails, the lease expires and the job is claimed again
+    try:
+        run_write(fail_job, job['id'], owner, f'{type(error).__name__}: {error}',
+                  app.config['JOBS_MAX_ATTEMPTS'], app.config['JOBS_RETRY_DELAY'])
+    except Exception:
+        pass
+
+def _finish_job_result(job, owner, file_row, result):
+    kind = JOB_KINDS[job['kind']]
+    try:
+        freed = run_write(finish_job, job['id'], owner, kind.get('apply'), file_row, result)
+    finally:
+        if 'finalize' in kind:
+            kind['finalize'](file_row, result)
+    remove_blob_files(freed)
+
+def _job_dispatcher_loop():
+    owner = f'{os.getpid()}-{uuid.uuid4().hex[:8]}'
+    workers = app.config['JOBS_WORKERS']
+    lease = app.config['JOBS_LEASE']
+    pool = None
+    running = {}
+    last_renewal = time.monotonic()
+    while True:
+        claimed = []
+        if len(running) < workers:
+            try:
+                claimed = run_write(claim_jobs, owner, workers - len(running), lease)
+            except Exception:
+                pass
+        for job in claimed:
+            try:
+                file_row = get_db().execute('SELECT folder, name, sha256 FROM files WHERE id = ?',
+                                            (job['file_id'],)).fetchone()
+                kind = JOB_KINDS.get(job['kind'])
+                if file_row is None or kind is None:
+                    run_write(fail_job, job['id'], owner, f"Unknown job kind {job['kind']}", 0, 0)
+                    continue
+                cached = kind['cached'](file_row) if 'cached' in kind else None
+                if cached is not None:
+                    _finish_job_result(job, owner, file_row, cached)
+                    continue
+                if pool is None:
+                    # spawn: forking a process that runs threads is unsafe
+                    pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+                path = os.path.abspath(os.path.join(app.config['BASE_UPLOAD_FOLDER'], file_row['folder'], file_row['name']))
+                try:
+                    running[pool.submit(run_job, job['kind'], path, file_row['sha256'])] = (job, file_row)
+                except Exception:
+                    pool.shutdown(wait=False)
+                    pool = None
+                    raise
+            except Exception as e:
+                _fail_job_quietly(job, owner, e)
+        
+        if running:
+            done, _ = wait(running, timeout=app.config['JOBS_POLL_INTERVAL'], return_when=FIRST_COMPLETED)
+        else:
+            _jobs_wakeup.wait(app.config['JOBS_POLL_INTERVAL'])
+            _jobs_wakeup.clear()
+            done = ()
+        
+        for future in done:
+            job, file_row = running.pop(future)
+            try:
+                result = future.result()
+            except Exception as e:
+                if isinstance(e, BrokenProcessPool) and pool is not None:
+                    # A worker died; the pool is unusable and is rebuilt
+                    pool.shutdown(wait=False)
+                    pool = None
+                _fail_job_quietly(job, owner, e)
+                continue
+            try:
+                _finish_job_result(job, owner, file_row, result)
+            except Exception as e:
+                # apply failed: its savepoint was rolled back, so retry the job
+                _fail_job_quietly(job, owner, e)
+        
+        if running and time.monotonic() - last_renewal >= lease / 3:
+            try:
+                run_write(renew_job_leases, owner, [job['id'] for job, _ in running.values()], lease)
+            except Exception:
+                # Renewed on the next pass; jobs whose lease runs out meanwhile
+                # are taken over and their results here are ignored
+                pass
+            last_renewal = time.monotonic()
+
+def start_job_dispatcher():
+    # Started by the first request, so CLI commands and the pool's worker
+    # processes (which import this module) don't dispatch jobs themselves.
+    global _jobs_pid
+    if _jobs_pid == os.getpid():
+        return
+    with _jobs_lock:
+        if _jobs_pid == os.getpid():
+            return
+        threading.Thread(target=_job_dispatcher_loop, name='job-dispatcher', daemon=True).start()
+        if Image is not None:
+            threading.Thread(target=_thumbnail_evictor_loop, name='thumbnail-evictor', daemon=True).start()
+        if app.config['TIERING_INTERVAL']:
+            threading.Thread(target=_tiering_loop, name='cold-storage', daemon=True).start()
+        _jobs_pid = os.getpid()
+
+def job_row_to_dict(row):
+    return {
+        'id': row['id'],
+        'kind': row['kind'],
+        'folder': row['folder'],
+        'name': row['name'],
+        'status': row['status'],
+        'attempts': row['attempts'],
+        'error': row['error'],
+        'created_at': row['created_at'],
+        'updated_at': row['updated_at']
+    }
+
+# ---- Streamed ZIP downloads ----
+
+class ZipChunkStream:
+    # Write-only, non-seekable sink for zipfile. zipfile then writes data
+    # descriptors instead of seeking back, so the archive can be sent as it
+    # is produced and only the bytes written since the last pop() are held.
+    def __init__(self):
+        self.chunks = []
+        self.offset = 0
+    
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.offset += len(data)
+        return len(data)
+    
+    def tell(self):
+        return self.offset
+    
+    def flush(self):
+        pass
+    
+    def pop(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+class StoredZipMember(io.RawIOBase):
+    # Seekable read-only view of a stored (uncompressed) ZIP member, so
+    # Range requests can seek straight to the wanted bytes
+    def __init__(self, path, member):
+        self.file = open(path, 'rb')
+        try:
+            self.start = seek_zip_member_data(self.file, member)
+        except Exception:
+            self.file.close()
+            raise
+        self.size = member['size']
+        self.position = 0
+    
+    def readable(self):
+        return True
+    
+    def seekable(self):
+        return True
+    
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self.position = max(0, offset)
+        return self.position
+    
+    def tell(self):
+        return self.position
+    
+    def readinto(self, buffer):
+        n = max(0, min(len(buffer), self.size - self.position))
+        if n == 0:
+            return 0
+        self.file.seek(self.start + self.position)
+        n = self.file.readinto(memoryview(buffer)[:n])
+        self.position += n
+        return n
+    
+    def close(self):
+        self.file.close()
+        super().close()
+
+def iter_zip(entries):
+    # entries: (name inside the archive, path on disk, member of an exam
+    # group archive or None for a loose file). Yields the archive.
+    stream = ZipChunkStream()
+    with zipfile.ZipFile(stream, 'w', allowZip64=True) as zf:
+        for arcname, path, member in entries:
+            if member is None:
+                zinfo = zipfile.ZipInfo.from_file(path, arcname)
+            else:
+                zinfo = zipfile.ZipInfo(arcname, zip_date_time(member['upload_time']))
+                # Lets zipfile switch to zip64 for members of 4 GiB or more
+                zinfo.file_size = member['size']
+            ext = arcname.rsplit('.', 1)[-1].lower()
+            zinfo.compress_type = zipfile.ZIP_STORED if ext in ZIP_STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+            with zf.open(zinfo, 'w') as dst:
+                for buf in iter_stored_file(path, member):
+                    dst.write(buf)
+                    data = stream.pop()
+                    if data:
+                        yield data
+            data = stream.pop()
+            if data:
+                yield data
+    yield stream.pop()
+
+def zip_response(folder_name, names=None):
+    conn = get_db()
+    rows = conn.execute('SELECT name FROM files WHERE folder = ? ORDER BY id', (folder_name,)).fetchall()
+    archived = archived_files(conn, folder_name)
+    folder_path = os.path.join(app.config['BASE_UPLOAD_FOLDER'], folder_name)
+    wanted = set(names) if names is not None else None
+    entries = [
+        (row['name'], *archived[row['name']]) if row['name'] in archived
+        else (row['name'], os.path.join(folder_path, row['name']), None)
+        for row in rows
+        if (wanted is None or row['name'] in wanted)
+        and (row['name'] in archived or os.path.isfile(os.path.join(folder_path, row['name'])))
+    ]
+    response = Response(iter_zip(entries), mimetype='application/zip')
+    response.headers.set('Content-Disposition', 'attachment', filename=f'{folder_name}.zip')
+    return response
+
+# ---- Cold storage ----
+# Exam groups nobody has added to for TIERING_COLD_AFTER days are packed into
+# a single ZIP inside their folder (formats that are already compressed are
+# stored, the rest deflated), and the loose files and blobs only they used
+# are deleted: one file per group instead of one per upload, for inodes and
+# backups alike. archived_files keeps each file's offset, compressed size,
+# method and CRC in the archive, so reading one seeks straight to its data.
+# The metadata stays as it was; files uploaded to a packed group stay loose
+# until the next pass repacks the group, and deleting or replacing a packed
+# file marks the archive stale so that pass also drops its bytes. Packing runs on a background thread
+# of each web process; when two pack the same group, the version check keeps
+# one archive and the other is dropped.
+
+def zip_date_time(upload_time):
+    try:
+        return datetime.strptime(upload_time, '%Y-%m-%d %H:%M:%S').timetuple()[:6]
+    except ValueError:
+        return (1980, 1, 1, 0, 0, 0)
+
+def archived_files(conn, folder_name, filename=None):
+    # {name: (archive path, member)} for the exam group's packed files
+    query = '''
+        SELECT f.name, f.size, f.upload_time, f.sha256, a.offset, a.compressed_size, a.method, a.crc, g.archive
+        FROM archived_files a JOIN files f ON f.id = a.file_id JOIN exam_groups g ON g.name = f.folder
+        WHERE f.folder = ?
+    '''
+    params = [folder_name]
+    if filename is not None:
+        query += ' AND f.name = ?'
+        params.append(filename)
+    folder_path = os.path.abspath(os.path.join(app.config['BASE_UPLOAD_FOLDER'], folder_name))
+    return {row['name']: (os.path.join(folder_path, row['archive']), {
+        'name': row['name'],
+        'size': row['size'],
+        'upload_time': row['upload_time'],
+        'sha256': row['sha256'],
+        'offset': row['offset'],
+        'compressed_size': row['compressed_size'],
+        'method': row['method'],
+        'crc': row['crc'],
+        'encrypted': False
+    }) for row in conn.execute(query, params)}
+
+def open_archived_content(sha256):
+    # A readable file of content whose blob was dropped when it was packed,
+    # or None if no archive has it
+    conn = get_db()
+    row = conn.execute('''
+        SELECT f.folder, f.name FROM files f JOIN archived_files a ON a.file_id = f.id
+        WHERE f.sha256 = ? LIMIT 1
+    ''', (sha256,)).fetchone()
+    if row is None:
+        return None
+    archive_path, member = archived_files(conn, row['folder'], row['name'])[row['name']]
+    if member['method'] == 'stored':
+        return io.BufferedReader(StoredZipMember(archive_path, member))
+    return io.BytesIO(b''.join(iter_stored_file(archive_path, member)))
+
+def iter_stored_file(path, member=None):
+    # Contents of a loose file, or of a member of an exam group archive
+    if member is not None:
+        yield from iter_zip_member(path, member, zip_member_decompressor(member))
+        return
+    with open(path, 'rb') as f:
+        yield from iter(lambda: f.read(app.config['UPLOAD_STREAM_BUFFER']), b'')
+
+def pack_exam_group(folder_name):
+    # Packs every file of the group (archived ones included, so a repack
+    # also drops deleted files). Returns the number of files packed, or 0 if
+    # the group changed meanwhile or has no files left, in which case only
+    # its old archive is removed.
+    with db_snapshot() as conn:
+        group = conn.execute('SELECT version FROM exam_groups WHERE name = ?', (folder_name,)).fetchone()
+        if group is None:
+            return 0
+        rows = conn.execute('SELECT name, size, upload_time FROM files WHERE folder = ? ORDER BY id',
+                            (folder_name,)).fetchall()
+        archived = archived_files(conn, folder_name)
+    folder_path = os.path.join(app.config['BASE_UPLOAD_FOLDER'], folder_name)
+    if not rows:
+        try:
+            result = run_write(archive_exam_group, folder_name, group['version'], None, [])
+        except VersionConflict:
+            result = None
+        if result and result[1]:
+            try:
+                os.remove(os.path.join(folder_path, result[1]))
+            except FileNotFoundError:
+                pass
+        return 0
+    archive = f'.archive-{uuid.uuid4().hex[:12]}.zip'
+    archive_path = os.path.join(folder_path, archive)
+    
+    tmp_path = f'{archive_path}.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            with zipfile.ZipFile(f, 'w', allowZip64=True) as zf:
+                for row in rows:
+                    source, member = archived.get(row['name'], (os.path.join(folder_path, row['name']), None))
+                    zinfo = zipfile.ZipInfo(row['name'], zip_date_time(row['upload_time']))
+                    ext = row['name'].rsplit('.', 1)[-1].lower()
+                    zinfo.compress_type = zipfile.ZIP_STORED if ext in ZIP_STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+                    with zf.open(zinfo, 'w', force_zip64=row['size'] >= zipfile.ZIP64_LIMIT) as dst:
+                        for buf in iter_stored_file(source, member):
+                            dst.write(buf)
+                members = [(info.filename, info.header_offset, info.compress_size,
+                            ZIP_METHODS[info.compress_type], info.CRC) for info in zf.infolist()]
+            # The loose files are deleted once the metadata points here
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, archive_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    
+    try:
+        result = run_write(archive_exam_group, folder_name, group['version'], archive, members)
+    except VersionConflict:
+        result = None
+    if result is None:
+        os.remove(archive_path)
+        return 0
+    freed, previous = result
+    
+    for row in rows:
+        if row['name'] not in archived:
+            try:
+                os.remove(os.path.join(folder_path, row['name']))
+            except FileNotFoundError:
+                pass
+    # Only the blob files: previews and thumbnails of the content are kept
+    for sha256 in freed:
+        try:
+            os.remove(blob_path(sha256))
+        except FileNotFoundError:
+            pass
+    if previous:
+        try:
+            os.remove(os.path.join(folder_path, previous))
+        except FileNotFoundError:
+            pass
+    return len(members)
+
+def cold_exam_groups():
+    # Groups past the cut-off with loose files or a stale archive, and no
+    # processing left to do
+    cutoff = datetime.now() - timedelta(days=app.config['TIERING_COLD_AFTER'])
+    rows = get_db().execute('''
+        SELECT g.name FROM exam_groups g
+        WHERE g.exam_date < ?
+          AND NOT EXISTS (SELECT 1 FROM files f WHERE f.folder = g.name AND f.upload_time >= ?)
+          AND (g.archive_stale
+               OR EXISTS (SELECT 1 FROM files f WHERE f.folder = g.name
+                          AND NOT EXISTS (SELECT 1 FROM archived_files a WHERE a.file_id = f.id)))
+          AND NOT EXISTS (SELECT 1 FROM jobs j JOIN files f ON f.id = j.file_id
+                          WHERE f.folder = g.name AND j.status IN ('queued', 'running'))
+        ORDER BY g.exam_date
+    ''', (cutoff.strftime('%Y-%m-%d'), cutoff.strftime('%Y-%m-%d %H:%M:%S'))).fetchall()
+    return [row['name'] for row in rows]
+
+def pack_cold_exam_groups():
+    packed = 0
+    for folder_name in cold_exam_groups():
+        try:
+            if pack_exam_group(folder_name):
+                packed += 1
+        except (OSError, zipfile.BadZipFile):
+            # A file missing or damaged on disk; the group stays as it is
+            pass
+    return packed
+
+def _tiering_loop():
+    while True:
+        time.sleep(app.config['TIERING_INTERVAL'])
+        try:
+            pack_cold_exam_groups()
+        except sqlite3.Error:
+            pass
 
 def allowed_file(filename):
     allowed = ['xlsx', 'xls', 'csv', 'doc', 'docx', 'pdf', 'jpg', 'jpeg', 'png', 'zip', 'rar']
@@ -36,16 +2342,7 @@ def format_size(size_bytes):
         i += 1
     return f"{size_bytes:.2f} {units[i]}"
 
-HTML_TEMPLATE = '''
-<!DOCTYPE html>
-<html lang="vi">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/css/all.min.css">
-
-    <title>Quản Lý File Siêu Âm</title>
-    <style>
+PAGE_CSS = '''
         * {
             margin: 0;
             padding: 0;
@@ -132,10 +2429,43 @@ HTML_TEMPLATE = '''
             width: 280px;
             background: #fff;
             border-right: 1px solid #ccc;
+            display: flex;
+            flex-direction: column;
+            overflow: hidden;
+        }
+        
+        .folder-list {
+            flex: 1;
             overflow-y: auto;
         }
         
+        .virtual-spacer {
+            position: relative;
+        }
+        
+        .virtual-row {
+            position: absolute;
+            top: 0;
+            left: 0;
+            right: 0;
+        }
+        
+        .folder-search {
+            padding: 10px;
+            border-bottom: 1px solid #e0e0e0;
+        }
+        
+        .folder-search input {
+            width: 100%;
+            padding: 6px 8px;
+            border: 1px solid #ccc;
+            border-radius: 3px;
+            font-size: 13px;
+        }
+        
         .folder-item {
+            height: 100%;
+            overflow: hidden;
             padding: 12px 15px;
             border-bottom: 1px solid #f0f0f0;
             cursor: pointer;
@@ -160,6 +2490,9 @@ HTML_TEMPLATE = '''
             font-size: 14px;
             color: #333;
             margin-bottom: 3px;
+            white-space: nowrap;
+            overflow: hidden;
+            text-overflow: ellipsis;
         }
         
         .folder-info {
@@ -213,14 +2546,23 @@ HTML_TEMPLATE = '''
             margin-bottom: 10px;
         }
         
-        .file-list {
+        .folder-content {
+            height: 100%;
+            flex-direction: column;
+        }
+        
+        .file-list {
             margin-top: 20px;
+            flex: 1;
+            min-height: 0;
+            overflow-y: auto;
         }
         
         .file-item {
             display: flex;
             justify-content: space-between;
             align-items: center;
+            height: 56px;
             padding: 10px;
             border: 1px solid #e0e0e0;
             border-radius: 3px;
@@ -234,12 +2576,42 @@ HTML_TEMPLATE = '''
         
         .file-info {
             flex: 1;
+            min-width: 0;
+        }
+        
+        .file-thumb {
+            width: 36px;
+            height: 36px;
+            object-fit: cover;
+            border-radius: 3px;
+            margin-right: 10px;
+            cursor: pointer;
+        }
+        
+        .file-select {
+            margin-right: 10px;
+        }
+        
+        .file-sort {
+            padding: 5px 8px;
+            border: 1px solid #ccc;
+            border-radius: 3px;
+            font-size: 13px;
+        }
+        
+        .file-summary {
+            font-size: 12px;
+            color: #666;
+            margin-left: 8px;
         }
         
         .file-name {
             font-weight: 500;
             font-size: 14px;
             color: #333;
+            white-space: nowrap;
+            overflow: hidden;
+            text-overflow: ellipsis;
         }
         
         .file-meta {
@@ -247,6 +2619,9 @@ HTML_TEMPLATE = '''
             color: #666;
             margin-top: 3px;
         }
+        .file-processing {
+            color: #e67e22;
+        }
         
         .file-actions {
             display: flex;
@@ -380,6 +2755,74 @@ HTML_TEMPLATE = '''
             gap: 10px;
         }
         
+        .preview-content {
+            width: 90vw;
+            display: flex;
+            flex-direction: column;
+        }
+        
+        .preview-content .modal-body {
+            flex: 1;
+            overflow: auto;
+            padding: 0;
+        }
+        
+        .preview-table {
+            border-collapse: collapse;
+            font-size: 12px;
+            white-space: nowrap;
+        }
+        
+        .preview-table th,
+        .preview-table td {
+            border: 1px solid #e0e0e0;
+            padding: 4px 8px;
+            max-width: 300px;
+            overflow: hidden;
+            text-overflow: ellipsis;
+        }
+        
+        .preview-table th {
+            position: sticky;
+            top: 0;
+            background: #f3f3f3;
+        }
+        
+        .preview-table .num {
+            text-align: right;
+        }
+        
+        .preview-table .row-no {
+            color: #999;
+            text-align: right;
+        }
+        
+        .preview-image {
+            display: block;
+            max-width: 100%;
+            max-height: 75vh;
+            margin: 0 auto;
+        }
+        
+        .preview-pdf {
+            display: block;
+            width: 100%;
+            height: 75vh;
+            border: 0;
+        }
+        
+        .preview-message {
+            padding: 20px;
+            color: #666;
+        }
+        
+        .preview-info {
+            margin-right: auto;
+            align-self: center;
+            font-size: 12px;
+            color: #666;
+        }
+        
         .content-header {
             margin-bottom: 20px;
             padding-bottom: 10px;
@@ -403,116 +2846,14 @@ HTML_TEMPLATE = '''
             padding: 40px;
             font-size: 14px;
         }
-    </style>
-</head>
-<body>
-    <div class="toolbar">
-        <h1>🗂️ Quản Lý File - Đại ca 99 Bắc Ninh</h1>
+'''
 
-        <button class="btn btn-primary" onclick="openCreateModal()">+ Tạo Đoàn Khám</button>
-    </div>
-    
-    <div class="main-container">
-        <div class="sidebar" id="sidebar">
-            <div class="no-folder">Chưa có đoàn khám nào</div>
-        </div>
-        
-        <div class="content">
-            <div class="empty-state" id="emptyState">
-                <h2>👈 Chọn đoàn khám để xem chi tiết</h2>
-                <p>Hoặc tạo đoàn khám mới để bắt đầu</p>
-            </div>
-            
-            <div id="folderContent" style="display: none;">
-                <div class="content-header">
-                    <h2 id="contentTitle">-</h2>
-                    <p id="contentInfo">-</p>
-                </div>
-                
-                <div>
-                    <button class="btn btn-primary" onclick="openUploadModal()">+ Upload File</button>
-                </div>
-                
-                <div class="file-list" id="fileList"></div>
-            </div>
-        </div>
-    </div>
-    
-    <!-- Modal Tạo/Sửa -->
-    <div class="modal" id="createModal">
-        <div class="modal-content">
-            <div class="modal-header" id="modalTitle">Tạo Đoàn Khám Mới</div>
-            <div class="modal-body">
-                <form id="folderForm">
-                    <input type="hidden" id="editFolderName">
-                    
-                    <div class="form-group">
-                        <label>Tên Công Ty *</label>
-                        <input type="text" id="companyName" required placeholder="Nhập tên công ty">
-                    </div>
-                    
-                    <div class="form-group">
-                        <label>Ngày Khám *</label>
-                        <input type="date" id="examDate" required>
-                    </div>
-                    
-                    <div class="form-group">
-                        <label>Ghi Chú</label>
-                        <textarea id="notes" rows="3" placeholder="Ghi chú..."></textarea>
-                    </div>
-                    
-                    <div class="form-group" id="uploadGroup">
-                        <label>Chọn File (Tùy chọn)</label>
-                        <div class="file-upload-box" id="dropArea">
-                            <div style="font-size: 36px; margin-bottom: 10px;">📁</div>
-                            <div>Kéo thả file hoặc click để chọn</div>
-                            <div style="font-size: 11px; color: #999; margin-top: 5px;">Excel, Word, PDF, Hình ảnh</div>
-                        </div>
-                        <input type="file" id="fileInput" multiple style="display: none;"
-                               accept=".xlsx,.xls,.csv,.doc,.docx,.pdf,.jpg,.jpeg,.png,.zip,.rar">
-                        
-                        <div class="selected-files" id="selectedFiles">
-                            <div id="filesList"></div>
-                        </div>
-                    </div>
-                </form>
-            </div>
-            <div class="modal-footer">
-                <button class="btn" onclick="closeModal()">Hủy</button>
-                <button class="btn btn-primary" onclick="saveFolder()">Lưu</button>
-            </div>
-        </div>
-    </div>
-    
-    <!-- Modal Upload File -->
-    <div class="modal" id="uploadModal">
-        <div class="modal-content">
-            <div class="modal-header">Upload File</div>
-            <div class="modal-body">
-                <div class="file-upload-box" id="uploadDropArea">
-                    <div style="font-size: 36px; margin-bottom: 10px;">📁</div>
-                    <div>Kéo thả file hoặc click để chọn</div>
-                    <div style="font-size: 11px; color: #999; margin-top: 5px;">Excel, Word, PDF, Hình ảnh</div>
-                </div>
-                <input type="file" id="uploadFileInput" multiple style="display: none;"
-                       accept=".xlsx,.xls,.csv,.doc,.docx,.pdf,.jpg,.jpeg,.png,.zip,.rar">
-                
-                <div class="selected-files" id="uploadSelectedFiles">
-                    <div id="uploadFilesList"></div>
-                </div>
-            </div>
-            <div class="modal-footer">
-                <button class="btn" onclick="closeUploadModal()">Hủy</button>
-                <button class="btn btn-primary" onclick="uploadFiles()">Upload</button>
-            </div>
-        </div>
-    </div>
-    
-    <script>
+PAGE_JS = '''
 /* ================== BIẾN TOÀN CỤC ================== */
 let selectedFiles = [];
 let uploadFileList = []; // 🔥 đổi tên (KHÔNG trùng hàm)
 let currentFolder = null;
+let currentFolderEtag = null; // phiên bản đoàn khám đang xem (ETag)
 let isEditMode = false;
 
 /* ================== MODAL CREATE ================== */
@@ -551,6 +2892,21 @@ function closeUploadModal() {
 
 /* ================== DRAG & DROP ================== */
 window.onload = function () {
+    folderList = new VirtualList(document.getElementById('folderList'), {
+        rowHeight: FOLDER_ROW_HEIGHT,
+        key: f => f.name,
+        render: folderItemHtml,
+        emptyHtml: '<div class="no-folder">Chưa có đoàn khám nào</div>',
+        onNearEnd: loadMoreFolders
+    });
+    fileList = new VirtualList(document.getElementById('fileList'), {
+        rowHeight: FILE_ROW_HEIGHT,
+        key: f => f.name,
+        render: f => fileItemHtml(fileFolder, f),
+        emptyHtml: '<div style="padding:20px;color:#999">Chưa có file nào</div>',
+        onNearEnd: loadMoreFiles
+    });
+    startChangeFeed();
     loadFolders();
     document.getElementById('examDate').valueAsDate = new Date();
     setupDragDrop();
@@ -673,9 +3029,14 @@ async function saveFolder() {
         if (isEditMode) {
             const folderName = document.getElementById('editFolderName').value;
 
+            const headers = { 'Content-Type': 'application/json' };
+            if (folderName === currentFolder && currentFolderEtag) {
+                headers['If-Match'] = currentFolderEtag;
+            }
+
             const response = await fetch('/update_folder', {
                 method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
+                headers: headers,
                 body: JSON.stringify({
                     folder_name: folderName,
                     company_name: companyName,
@@ -688,9 +3049,9 @@ async function saveFolder() {
             if (result.success) {
                  showToast('Cập nhật thành công!');
                 closeModal();
-                loadFolders();
-                if (currentFolder === folderName) {
-                    selectFolder(folderName);
+                if (!changeFeedLive) {
+                    loadFolders();
+                    if (currentFolder === folderName) loadFolderContent(folderName);
                 }
             } else {
                 showToast(result.message);
@@ -715,7 +3076,7 @@ async function saveFolder() {
             if (result.success) {
                 showToast('Tạo đoàn khám thành công!');
                 closeModal();
-                loadFolders();
+                if (!changeFeedLive) loadFolders();
             } else {
                 showToast(result.message);
             }
@@ -728,39 +3089,300 @@ async function saveFolder() {
 
 
 /* ================== UPLOAD FILE ================== */
+// Upload từng file theo chunk, nhiều chunk song song, tự thử lại khi rớt mạng.
+// upload_id được lưu trong localStorage để chọn lại cùng file thì upload tiếp.
+const UPLOAD_PARALLEL = 4;
+const UPLOAD_RETRIES = 5;
+// File nhỏ hơn ngưỡng này được băm SHA-256 trước; server đã có thì khỏi gửi.
+const DEDUPE_HASH_MAX = 256 * 1024 * 1024;
+
 async function uploadFiles() {
     if (!uploadFileList.length) {
         showToast('Vui lòng chọn file');
         return;
     }
 
-    const fd = new FormData();
-    fd.append('folder_name', currentFolder);
-    uploadFileList.forEach(f => fd.append('files', f));
+    const folderName = currentFolder;
+    const linked = await linkKnownFiles(folderName, uploadFileList);
+    let uploaded = linked.size;
 
-    const res = await fetch('/upload', {method: 'POST', body: fd});
-    const r = await res.json();
+    for (const file of uploadFileList) {
+        if (linked.has(file)) continue;
+        try {
+            await uploadFileChunked(folderName, file, done => {
+                const percent = file.size ? Math.floor(done * 100 / file.size) : 100;
+                showToast(`Đang upload ${file.name}: ${percent}%`);
+            });
+            uploaded++;
+        } catch (err) {
+            console.error(err);
+            showToast(`Upload ${file.name} thất bại: ${err.message}`);
+        }
+    }
 
-    if (r.success) {
+    if (uploaded) {
+        showToast(`Upload thành công ${uploaded} file`);
         closeUploadModal();
-        loadFiles(currentFolder);
+        if (!changeFeedLive) loadFolderContent(folderName);
+    }
+}
+
+async function sha256Hex(file) {
+    const digest = await crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+    return Array.from(new Uint8Array(digest), b => b.toString(16).padStart(2, '0')).join('');
+}
+
+// Trả về các file server đã có sẵn nội dung (đã được gắn vào đoàn khám)
+async function linkKnownFiles(folderName, files) {
+    // crypto.subtle chỉ có trên HTTPS hoặc localhost
+    if (!window.crypto || !crypto.subtle) return new Set();
+
+    try {
+        const entries = [];
+        for (const file of files) {
+            if (file.size > DEDUPE_HASH_MAX) continue;
+            entries.push({ file, name: file.name, size: file.size, sha256: await sha256Hex(file) });
+        }
+        if (!entries.length) return new Set();
+
+        const res = await fetch('/upload/by_hash', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({
+                folder_name: folderName,
+                files: entries.map(({ name, size, sha256 }) => ({ name, size, sha256 }))
+            })
+        });
+        const data = await res.json();
+        if (!data.success) return new Set();
+        return new Set(data.linked.map(i => entries[i].file));
+    } catch (err) {
+        console.error(err);
+        return new Set();
+    }
+}
+
+async function fetchJsonWithRetry(url, options = {}) {
+    for (let attempt = 0; ; attempt++) {
+        try {
+            const res = await fetch(url, options);
+            // 400 = chunk bị gián đoạn, 5xx = lỗi server: thử lại
+            if (res.status === 400 || res.status >= 500) throw new Error(res.statusText);
+            return {res, data: await res.json()};
+        } catch (err) {
+            if (attempt >= UPLOAD_RETRIES) throw err;
+            await new Promise(r => setTimeout(r, 500 * 2 ** attempt));
+        }
+    }
+}
+
+async function uploadFileChunked(folderName, file, onProgress) {
+    const key = `upload:${folderName}:${file.name}:${file.size}:${file.lastModified}`;
+    let status = null;
+
+    const savedId = localStorage.getItem(key);
+    if (savedId) {
+        const {data} = await fetchJsonWithRetry(`/upload/status/${savedId}`);
+        if (data.success) status = data;
+    }
+
+    if (!status) {
+        const {data} = await fetchJsonWithRetry('/upload/init', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ folder_name: folderName, filename: file.name, size: file.size })
+        });
+        if (!data.success) throw new Error(data.message);
+        status = data;
+        localStorage.setItem(key, status.upload_id);
+    }
+
+    const chunkSize = status.chunk_size;
+    const pending = [];
+    let done = file.size;
+    for (let start = 0; start < file.size; start += chunkSize) {
+        const end = Math.min(start + chunkSize, file.size);
+        if (!status.ranges.some(([s, e]) => s <= start && end <= e)) {
+            pending.push(start);
+            done -= end - start;
+        }
+    }
+    onProgress(done);
+
+    async function worker() {
+        while (pending.length) {
+            const start = pending.shift();
+            const end = Math.min(start + chunkSize, file.size);
+            const {data} = await fetchJsonWithRetry(`/upload/chunk/${status.upload_id}?offset=${start}`, {
+                method: 'PUT',
+                headers: { 'Content-Type': 'application/octet-stream' },
+                body: file.slice(start, end)
+            });
+            if (!data.success) throw new Error(data.message);
+            done += end - start;
+            onProgress(done);
+        }
+    }
+    await Promise.all(Array.from({length: UPLOAD_PARALLEL}, worker));
+
+    const {data} = await fetchJsonWithRetry(`/upload/finalize/${status.upload_id}`, {method: 'POST'});
+    if (!data.success) throw new Error(data.message);
+    localStorage.removeItem(key);
+    return data.file;
+}
+/* ================== VIRTUAL LIST ================== */
+// Chỉ dựng các dòng đang nằm trong vùng nhìn thấy (thêm vài dòng đệm). Dòng
+// cao cố định, được giữ theo key và chỉ vẽ lại khi HTML của nó thay đổi, nên
+// danh sách hàng nghìn mục vẫn nhẹ và không mất vị trí cuộn khi cập nhật.
+const VIRTUAL_OVERSCAN = 8;
+
+class VirtualList {
+    constructor(viewport, {rowHeight, key, render, emptyHtml, onNearEnd}) {
+        this.viewport = viewport;
+        this.rowHeight = rowHeight;
+        this.key = key;
+        this.render = render;
+        this.onNearEnd = onNearEnd;
+        this.items = [];
+        this.rows = new Map();
+        this.frame = null;
+
+        this.empty = document.createElement('div');
+        this.empty.innerHTML = emptyHtml;
+        this.spacer = document.createElement('div');
+        this.spacer.className = 'virtual-spacer';
+        viewport.replaceChildren(this.empty, this.spacer);
+
+        viewport.addEventListener('scroll', () => this.refresh());
+        window.addEventListener('resize', () => this.refresh());
+    }
+
+    setItems(items) {
+        this.items = items;
+        this.refresh();
+    }
+
+    // Gom nhiều lần cập nhật trong cùng một khung hình
+    refresh() {
+        if (this.frame) return;
+        this.frame = requestAnimationFrame(() => {
+            this.frame = null;
+            this.draw();
+        });
+    }
+
+    draw() {
+        const {items, rowHeight, viewport} = this;
+        this.empty.style.display = items.length ? 'none' : 'block';
+        this.spacer.style.height = items.length * rowHeight + 'px';
+
+        const first = Math.max(0, Math.floor(viewport.scrollTop / rowHeight) - VIRTUAL_OVERSCAN);
+        const last = Math.min(items.length,
+            Math.ceil((viewport.scrollTop + viewport.clientHeight) / rowHeight) + VIRTUAL_OVERSCAN);
+
+        const visible = new Set();
+        for (let i = first; i < last; i++) {
+            const key = this.key(items[i]);
+            const html = this.render(items[i]);
+            let row = this.rows.get(key);
+            if (!row) {
+                row = {el: document.createElement('div'), html: null};
+                row.el.className = 'virtual-row';
+                row.el.style.height = rowHeight + 'px';
+                this.spacer.appendChild(row.el);
+                this.rows.set(key, row);
+            }
+            if (row.html !== html) {
+                row.el.innerHTML = html;
+                row.html = html;
+            }
+            row.el.style.transform = `translateY(${i * rowHeight}px)`;
+            visible.add(key);
+        }
+        for (const [key, row] of this.rows) {
+            if (!visible.has(key)) {
+                row.el.remove();
+                this.rows.delete(key);
+            }
+        }
+
+        // Gần cuối danh sách: tải trang tiếp theo
+        if (this.onNearEnd && last >= items.length - VIRTUAL_OVERSCAN) this.onNearEnd();
+    }
+}
+
+/* ================== FOLDER LIST ================== */
+const FOLDER_PAGE = 50;
+const FOLDER_ROW_HEIGHT = 100;
+let folderList = null;
+let folderItems = [];      // các đoàn khám đã tải, theo thứ tự của server
+let folderCursor = null;
+let folderLoading = false;
+let folderGeneration = 0;  // tăng mỗi lần tải lại từ đầu để bỏ qua phản hồi cũ
+let folderSearchTimer = null;
+
+function folderQuery(limit, cursor) {
+    const params = new URLSearchParams({limit});
+    const company = document.getElementById('folderSearch').value.trim();
+    if (company) params.set('company', company);
+    if (cursor) params.set('cursor', cursor);
+    return '/get_folders?' + params;
+}
+
+function searchFolders() {
+    clearTimeout(folderSearchTimer);
+    folderSearchTimer = setTimeout(() => {
+        folderItems = [];
+        folderList.viewport.scrollTop = 0;
         loadFolders();
-    } else  showToast(r.message);
+    }, 300);
 }
+
+// Tải lại từ đầu, giữ nguyên số đoàn khám đã tải (và vị trí cuộn)
 async function loadFolders() {
+    const generation = ++folderGeneration;
+    folderLoading = true;
     try {
-        const res = await fetch('/get_folders');
+        const res = await fetch(folderQuery(Math.max(FOLDER_PAGE, folderItems.length)));
         const data = await res.json();
+        if (!data.success) throw new Error(data.message);
+        if (generation !== folderGeneration) return;
+
+        folderItems = data.folders;
+        folderCursor = data.next_cursor;
+        folderList.setItems(folderItems);
+    } catch (e) {
+        console.error(e);
+        showToast('Không tải được danh sách đoàn khám');
+    } finally {
+        if (generation === folderGeneration) folderLoading = false;
+    }
+}
 
-        const sidebar = document.getElementById('sidebar');
+async function loadMoreFolders() {
+    if (!folderCursor || folderLoading) return;
+    const generation = folderGeneration;
+    folderLoading = true;
+    try {
+        const res = await fetch(folderQuery(FOLDER_PAGE, folderCursor));
+        const data = await res.json();
+        if (!data.success) throw new Error(data.message);
+        if (generation !== folderGeneration) return;
 
-        if (!data.folders || data.folders.length === 0) {
-            sidebar.innerHTML = '<div class="no-folder">Chưa có đoàn khám nào</div>';
-            return;
-        }
+        folderItems = folderItems.concat(data.folders);
+        folderCursor = data.next_cursor;
+        folderList.setItems(folderItems);
+    } catch (e) {
+        console.error(e);
+        showToast('Không tải được danh sách đoàn khám');
+    } finally {
+        if (generation === folderGeneration) folderLoading = false;
+    }
+}
 
-        sidebar.innerHTML = data.folders.map(f => `
-    <div class="folder-item" id="folder_${f.name}">
+function folderItemHtml(f) {
+    return `
+    <div class="folder-item${f.name === currentFolder ? ' selected' : ''}">
         <div onclick="selectFolder('${f.name}')">
             <div class="folder-name">${f.display_name}</div>
             <div class="folder-info">${f.exam_date} • ${f.file_count} file</div>
@@ -773,83 +3395,207 @@ async function loadFolders() {
             </button>
         </div>
     </div>
-`).join('');
-
-    } catch (e) {
-        console.error(e);
-        showToast('Không tải được danh sách đoàn khám');
-    }
+`;
 }
 function selectFolder(folderName) {
-    const item = document.getElementById('folder_' + folderName);
-
     if (currentFolder === folderName) {
         // Nếu click vào folder đang chọn -> bỏ chọn
         currentFolder = null;
-        item.classList.remove('selected');
+        folderList.refresh();
         document.getElementById('folderContent').style.display = 'none';
         document.getElementById('emptyState').style.display = 'block';
         return;
     }
 
-    // Xóa class selected của tất cả folder
-    document.querySelectorAll('.folder-item').forEach(el => {
-        el.classList.remove('selected');
-    });
-
+    // Chỉ hai dòng đổi trạng thái chọn được vẽ lại
     currentFolder = folderName;
-    item.classList.add('selected');
+    folderList.refresh();
 
     loadFolderContent(folderName);
 }
 
 
+// Snapshot đoàn khám (thông tin + trang file đầu), lưu theo URL kèm ETag
+// để lần sau chỉ cần hỏi lại server bằng If-None-Match (304 nếu không đổi)
+const snapshotCache = new Map();
+
 async function loadFolderContent(folderName) {
-    const res = await fetch(`/get_folder_info/${folderName}`);
-    const data = await res.json();
+    const [sort, order] = document.getElementById('fileSort').value.split(':');
+    const url = `/folder_snapshot/${folderName}?` + new URLSearchParams({sort, order, limit: FILE_PAGE});
+    const cached = snapshotCache.get(url);
 
-    if (!data.success) {
+    const headers = {};
+    if (cached) headers['If-None-Match'] = cached.etag;
+    const res = await fetch(url, {headers, cache: 'no-store'});
+
+    let data;
+    if (res.status === 304 && cached) {
+        data = cached.data;
+        // Không có gì thay đổi: giữ nguyên danh sách đang hiển thị (kể cả các trang đã tải thêm)
+        if (fileFolder === folderName && document.getElementById('folderContent').style.display === 'flex') return;
+    } else {
+        data = await res.json();
+        if (data.success) snapshotCache.set(url, {etag: res.headers.get('ETag'), data});
+    }
+
+    if (!data.success) {
          showToast('Không tải được thông tin đoàn khám');
         return;
     }
 
+    // Làm mới đoàn khám đang xem đã cuộn quá trang đầu: lấy luôn phần còn lại
+    // trong một lần để không bị nhảy vị trí cuộn
+    let files = data.files, cursor = data.next_cursor;
+    if (fileFolder === folderName && cursor && fileItems.length > files.length) {
+        try {
+            const more = await fetchFilePage(folderName, cursor, fileItems.length - files.length);
+            files = files.concat(more.files);
+            cursor = more.next_cursor;
+        } catch (e) {
+            console.error(e);
+        }
+    }
+
+    currentFolderEtag = `"${data.info.version}"`;
+
     document.getElementById('emptyState').style.display = 'none';
-    document.getElementById('folderContent').style.display = 'block';
+    document.getElementById('folderContent').style.display = 'flex';
 
     document.getElementById('contentTitle').textContent = data.info.company_name;
     document.getElementById('contentInfo').textContent =
         `Ngày khám: ${data.info.exam_date} • ${data.info.notes || 'Không có ghi chú'}`;
 
-    loadFiles(folderName);
+    showFiles(folderName, files, cursor, data.info);
+    updateFolderCount(folderName, data.info.file_count);
+}
+
+// Cập nhật số file của đoàn khám trên sidebar mà không tải lại cả danh sách
+function updateFolderCount(folderName, fileCount) {
+    const folder = folderItems.find(f => f.name === folderName);
+    if (folder && folder.file_count !== fileCount) {
+        folder.file_count = fileCount;
+        folderList.refresh();
+    }
+}
+
+/* ================== FILE LIST ================== */
+const FILE_PAGE = 100;
+const FILE_ROW_HEIGHT = 64;
+let fileList = null;
+let fileItems = [];
+let fileCursor = null;
+let fileFolder = null;
+let fileLoading = false;
+let fileGeneration = 0;
+const checkedFiles = new Set();  // file đã đánh dấu, giữ lại khi dòng bị dựng lại
+
+function showFiles(folderName, files, cursor, info) {
+    if (fileFolder !== folderName) {
+        checkedFiles.clear();
+        fileList.viewport.scrollTop = 0;
+    }
+    fileFolder = folderName;
+    fileGeneration++;
+    fileLoading = false;
+
+    fileItems = files;
+    fileCursor = cursor;
+    fileList.setItems(fileItems);
+    setFileSummary(info);
+}
+
+function changeFileSort() {
+    fileItems = [];
+    fileList.viewport.scrollTop = 0;
+    loadFolderContent(currentFolder);
 }
 
-async function loadFiles(folderName) {
-    const res = await fetch(`/get_files/${folderName}`);
+async function fetchFilePage(folderName, cursor, limit) {
+    const [sort, order] = document.getElementById('fileSort').value.split(':');
+    const res = await fetch(`/get_files/${folderName}?` + new URLSearchParams({sort, order, limit, cursor}));
     const data = await res.json();
+    if (!data.success) throw new Error(data.message);
+    return data;
+}
 
-    const container = document.getElementById('fileList');
+async function loadMoreFiles() {
+    if (!fileCursor || fileLoading) return;
+    const generation = fileGeneration;
+    fileLoading = true;
+    try {
+        const data = await fetchFilePage(fileFolder, fileCursor, FILE_PAGE);
+        if (generation !== fileGeneration) return;
 
-    if (!data.files || data.files.length === 0) {
-        container.innerHTML = '<div style="padding:20px;color:#999">Chưa có file nào</div>';
-        return;
+        fileItems = fileItems.concat(data.files);
+        fileCursor = data.next_cursor;
+        fileList.setItems(fileItems);
+        setFileSummary(data);
+    } catch (e) {
+        console.error(e);
+        showToast('Không tải được danh sách file');
+    } finally {
+        if (generation === fileGeneration) fileLoading = false;
     }
+}
+
+function setFileSummary(data) {
+    document.getElementById('fileSummary').textContent =
+        data.file_count ? `${data.file_count} file • ${data.total_size}` : '';
+}
 
-    container.innerHTML = data.files.map(f => `
+function toggleFileChecked(el) {
+    if (el.checked) checkedFiles.add(el.value);
+    else checkedFiles.delete(el.value);
+}
+
+function fileItemHtml(folderName, f) {
+    return `
         <div class="file-item">
+            <input type="checkbox" class="file-select" value="${f.name}"
+                ${checkedFiles.has(f.name) ? 'checked' : ''} onchange="toggleFileChecked(this)">
+            ${f.thumbnail ? `<img class="file-thumb" src="${f.thumbnail}" loading="lazy" alt=""
+                onerror="this.remove()" onclick="openPreview('${folderName}', '${f.name}')">` : ''}
             <div class="file-info">
                 <div class="file-name">${f.name}</div>
-                <div class="file-meta">${f.size} • ${f.upload_time}</div>
+                <div class="file-meta">${f.size} • ${f.upload_time}${f.processing ? ' • <span class="file-processing">Đang xử lý…</span>' : ''}</div>
             </div>
             <div class="file-actions">
+                ${canPreview(f.name) || f.thumbnail ? `<button class="btn" onclick="openPreview('${folderName}', '${f.name}')">Xem</button>` : ''}
                 <button class="btn" onclick="downloadFile('${folderName}', '${f.name}')">Tải</button>
                 <button class="btn" onclick="deleteFile('${folderName}', '${f.name}')">Xóa</button>
             </div>
         </div>
-    `).join('');
+    `;
 }
 function downloadFile(folderName, filename) {
     window.location.href = `/download/${folderName}/${filename}`;
 }
+function downloadFolder() {
+    if (!currentFolder) return;
+    window.location.href = `/download_folder/${currentFolder}`;
+}
+function downloadSelected() {
+    const names = Array.from(checkedFiles);
+    if (!names.length) {
+        showToast('Vui lòng chọn file');
+        return;
+    }
+
+    // POST qua form ẩn để trình duyệt tự tải file ZIP, không giới hạn độ dài URL
+    const form = document.createElement('form');
+    form.method = 'POST';
+    form.action = `/download_selected/${currentFolder}`;
+    names.forEach(name => {
+        const input = document.createElement('input');
+        input.type = 'hidden';
+        input.name = 'files';
+        input.value = name;
+        form.appendChild(input);
+    });
+    document.body.appendChild(form);
+    form.submit();
+    form.remove();
+}
 async function deleteFile(folderName, filename) {
     if (!confirm(`Xóa file "${filename}"?`)) return;
 
@@ -861,8 +3607,7 @@ async function deleteFile(folderName, filename) {
 
         if (result.success) {
             showToast('Xóa thành công!');
-            loadFiles(folderName);
-            loadFolders();
+            if (!changeFeedLive) loadFolderContent(folderName);
         } else {
              showToast(result.message || 'Xóa thất bại');
         }
@@ -872,6 +3617,160 @@ async function deleteFile(folderName, filename) {
     }
 }
 
+/* ================== PREVIEW ================== */
+const PREVIEW_PAGE = 100;
+let previewFile = null;
+
+function canPreview(filename) {
+    return /\.(xlsx|csv|pdf|zip)$/i.test(filename);
+}
+
+function escapeHtml(text) {
+    return String(text ?? '').replace(/[&<>"']/g, c =>
+        ({'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;'})[c]);
+}
+
+function openPreview(folderName, filename) {
+    previewFile = {folder: folderName, name: filename};
+    document.getElementById('previewTitle').textContent = filename;
+    document.getElementById('previewInfo').textContent = '';
+    document.getElementById('previewBody').innerHTML = '<div class="preview-message">Đang tải...</div>';
+    document.getElementById('previewModal').classList.add('show');
+    if (/\.pdf$/i.test(filename)) loadPdfPage(1);
+    else if (/\.zip$/i.test(filename)) loadZipPage(0);
+    else if (/\.(jpe?g|png)$/i.test(filename)) showPreviewImage(filename);
+    else loadPreviewPage(0);
+}
+
+function closePreview() {
+    previewFile = null;
+    document.getElementById('previewModal').classList.remove('show');
+}
+
+async function loadPreviewPage(offset) {
+    const file = previewFile;
+    if (!file) return;
+    const body = document.getElementById('previewBody');
+    try {
+        const res = await fetch(`/preview/${file.folder}/${file.name}?offset=${offset}&limit=${PREVIEW_PAGE}`);
+        const data = await res.json();
+        if (file !== previewFile) return;
+
+        if (!data.success) {
+            body.innerHTML = `<div class="preview-message">${escapeHtml(data.message)}</div>`;
+            // File vừa upload, server đang chuyển đổi: hỏi lại sau ít giây
+            if (data.processing) setTimeout(() => loadPreviewPage(offset), 2000);
+            return;
+        }
+
+        const head = data.columns.map(c =>
+            `<th class="${c.type === 'number' ? 'num' : ''}">${escapeHtml(c.name)}</th>`).join('');
+        const rows = data.rows.map((row, i) => '<tr><td class="row-no">' + (offset + i + 1) + '</td>' +
+            row.map((v, j) =>
+                `<td class="${data.columns[j].type === 'number' ? 'num' : ''}">${escapeHtml(v)}</td>`).join('') +
+            '</tr>').join('');
+        body.innerHTML = `<table class="preview-table"><thead><tr><th></th>${head}</tr></thead><tbody>${rows}</tbody></table>`;
+        body.scrollTop = 0;
+
+        const total = data.total_rows + (data.truncated ? '+' : '');
+        document.getElementById('previewInfo').textContent = data.rows.length
+            ? `Dòng ${offset + 1}–${offset + data.rows.length} / ${total}` : `0 / ${total} dòng`;
+        const prev = document.getElementById('previewPrev');
+        const next = document.getElementById('previewNext');
+        prev.disabled = offset === 0;
+        prev.onclick = () => loadPreviewPage(Math.max(0, offset - PREVIEW_PAGE));
+        next.disabled = data.next_offset === null;
+        next.onclick = () => loadPreviewPage(data.next_offset);
+    } catch (err) {
+        console.error(err);
+        showToast('Không tải được bản xem trước');
+    }
+}
+
+// Ảnh: xem bản thu nhỏ cỡ lớn thay vì tải ảnh gốc
+function showPreviewImage(filename) {
+    const item = fileItems.find(x => x.name === filename);
+    if (!item || !item.thumbnail) return;
+    document.getElementById('previewBody').innerHTML =
+        `<img class="preview-image" src="${item.thumbnail.replace('/small.jpg', '/large.jpg')}" alt="">`;
+    document.getElementById('previewPrev').disabled = true;
+    document.getElementById('previewNext').disabled = true;
+}
+
+// PDF: xem từng trang, server chỉ gửi trang đang xem chứ không gửi cả file
+async function loadPdfPage(page) {
+    const file = previewFile;
+    if (!file) return;
+    const body = document.getElementById('previewBody');
+    try {
+        if (!file.pageCount) {
+            const res = await fetch(`/pdf/${file.folder}/${file.name}`);
+            const data = await res.json();
+            if (file !== previewFile) return;
+            if (!data.success) {
+                body.innerHTML = `<div class="preview-message">${escapeHtml(data.message)}</div>`;
+                if (data.processing) setTimeout(() => loadPdfPage(page), 2000);
+                return;
+            }
+            file.pageCount = data.page_count;
+        }
+
+        body.innerHTML = `<iframe class="preview-pdf" src="/pdf/${file.folder}/${file.name}/pages?first=${page}"></iframe>`;
+        document.getElementById('previewInfo').textContent = `Trang ${page} / ${file.pageCount}`;
+        const prev = document.getElementById('previewPrev');
+        const next = document.getElementById('previewNext');
+        prev.disabled = page <= 1;
+        prev.onclick = () => loadPdfPage(page - 1);
+        next.disabled = page >= file.pageCount;
+        next.onclick = () => loadPdfPage(page + 1);
+    } catch (err) {
+        console.error(err);
+        showToast('Không tải được bản xem trước');
+    }
+}
+
+// ZIP: liệt kê file bên trong, tải riêng từng file mà không tải cả ZIP
+const ZIP_PAGE = 500;
+
+async function loadZipPage(offset) {
+    const file = previewFile;
+    if (!file) return;
+    const body = document.getElementById('previewBody');
+    try {
+        const res = await fetch(`/zip/${file.folder}/${file.name}?offset=${offset}&limit=${ZIP_PAGE}`);
+        const data = await res.json();
+        if (file !== previewFile) return;
+
+        if (!data.success) {
+            body.innerHTML = `<div class="preview-message">${escapeHtml(data.message)}</div>`;
+            if (data.processing) setTimeout(() => loadZipPage(offset), 2000);
+            return;
+        }
+
+        const rows = data.members.map(m => {
+            const url = `/zip/${file.folder}/${file.name}/member?` + new URLSearchParams({name: m.name});
+            const link = m.is_dir ? '' : `<a href="${escapeHtml(url)}">Tải</a>`;
+            return `<tr><td>${escapeHtml(m.name)}</td><td class="num">${formatSize(m.size)}</td>` +
+                `<td class="num">${formatSize(m.compressed_size)}</td><td>${m.modified}</td><td>${link}</td></tr>`;
+        }).join('');
+        body.innerHTML = '<table class="preview-table"><thead><tr><th>Tên</th><th class="num">Dung lượng</th>' +
+            `<th class="num">Đã nén</th><th>Ngày sửa</th><th></th></tr></thead><tbody>${rows}</tbody></table>`;
+        body.scrollTop = 0;
+
+        document.getElementById('previewInfo').textContent = data.members.length
+            ? `${offset + 1}–${offset + data.members.length} / ${data.total} file` : '0 file';
+        const prev = document.getElementById('previewPrev');
+        const next = document.getElementById('previewNext');
+        prev.disabled = offset === 0;
+        prev.onclick = () => loadZipPage(Math.max(0, offset - ZIP_PAGE));
+        next.disabled = data.next_offset === null;
+        next.onclick = () => loadZipPage(data.next_offset);
+    } catch (err) {
+        console.error(err);
+        showToast('Không tải được bản xem trước');
+    }
+}
+
 function showToast(message, duration = 3000) {
     const toast = document.getElementById('toast');
     toast.textContent = message;
@@ -900,7 +3799,7 @@ async function deleteFolder(folderName) {
                 document.getElementById('emptyState').style.display = 'block';
             }
 
-            loadFolders();
+            if (!changeFeedLive) loadFolders();
         } else {
             showToast(result.message || 'Xóa thất bại');
         }
@@ -909,24 +3808,386 @@ async function deleteFolder(folderName) {
         showToast('Lỗi khi xóa đoàn khám');
     }
 }
-</script>
 
-</script>
+/* ================== CHANGE FEED ================== */
+// Server đẩy từng thay đổi (SSE); áp dụng trực tiếp vào danh sách đang hiển thị
+// thay vì tải lại. EventSource tự kết nối lại và gửi Last-Event-ID để nhận tiếp.
+let changeFeedLive = false;
+let folderContentTimer = null;
+
+function startChangeFeed() {
+    if (!window.EventSource) return;
+    const source = new EventSource('/changes');
+    source.onopen = () => { changeFeedLive = true; };
+    source.onerror = () => { changeFeedLive = false; };
+
+    // Server đã xóa các thay đổi cũ hơn vị trí của trình duyệt: tải lại hết
+    source.addEventListener('reset', () => {
+        loadFolders();
+        if (currentFolder) loadFolderContent(currentFolder);
+    });
+    source.addEventListener('folder_created', e => applyFolderChange(JSON.parse(e.data)));
+    source.addEventListener('folder_updated', e => applyFolderChange(JSON.parse(e.data)));
+    source.addEventListener('folder_deleted', e => applyFolderDeleted(JSON.parse(e.data)));
+    source.addEventListener('file_added', e => applyFileChange(JSON.parse(e.data), true));
+    source.addEventListener('file_removed', e => applyFileChange(JSON.parse(e.data), false));
+    source.addEventListener('file_processed', e => applyFileProcessed(JSON.parse(e.data)));
+}
+
+function applyFolderChange(f) {
+    // Lọc theo tên công ty do server làm, nên khi đang tìm kiếm thì hỏi lại server
+    if (document.getElementById('folderSearch').value.trim()) {
+        searchFolders();
+        return;
+    }
+
+    const old = folderItems.findIndex(x => x.name === f.folder);
+    if (old >= 0) folderItems.splice(old, 1);
+
+    // Danh sách sắp xếp theo ngày khám rồi tên, giảm dần
+    let at = folderItems.findIndex(x =>
+        x.exam_date < f.exam_date || (x.exam_date === f.exam_date && x.name < f.folder));
+    // Nằm sau trang cuối đã tải: cuộn xuống sẽ tải về
+    if (at < 0 && !folderCursor) at = folderItems.length;
+    if (at >= 0) {
+        folderItems.splice(at, 0, {
+            name: f.folder,
+            display_name: f.company_name || f.folder,
+            exam_date: f.exam_date,
+            notes: f.notes,
+            file_count: f.file_count
+        });
+    }
+    folderList.setItems(folderItems);
+
+    if (f.folder === currentFolder && old >= 0) reloadFolderContent();
+}
+
+function applyFolderDeleted(f) {
+    folderItems = folderItems.filter(x => x.name !== f.folder);
+    folderList.setItems(folderItems);
+
+    if (currentFolder === f.folder) {
+        currentFolder = null;
+        document.getElementById('folderContent').style.display = 'none';
+        document.getElementById('emptyState').style.display = 'block';
+    }
+}
+
+function applyFileChange(f, added) {
+    updateFolderCount(f.folder, f.file_count);
+    if (f.folder !== currentFolder || f.folder !== fileFolder) return;
+
+    fileItems = fileItems.filter(x => x.name !== f.name);
+    if (!added) checkedFiles.delete(f.name);
+    setFileSummary({file_count: f.file_count, total_size: formatSize(f.total_bytes)});
+
+    if (added) {
+        // Chỉ chèn tại chỗ khi biết chắc vị trí (theo thứ tự upload); còn lại tải lại
+        const sort = document.getElementById('fileSort').value;
+        // File mới luôn có việc xử lý nền; sự kiện file_processed sẽ cập nhật lại
+        const item = {name: f.name, size: formatSize(f.size), upload_time: f.upload_time,
+                      description: f.description, processing: true};
+        if (sort === 'upload_time:desc') fileItems.unshift(item);
+        else if (sort === 'upload_time:asc' && !fileCursor) fileItems.push(item);
+        else reloadFolderContent();
+    }
+    fileList.setItems(fileItems);
+}
+
+function applyFileProcessed(f) {
+    if (f.folder !== currentFolder || f.folder !== fileFolder) return;
+    const item = fileItems.find(x => x.name === f.name);
+    if (!item) return;
+    item.processing = f.processing;
+    // Ảnh vừa upload: ảnh thu nhỏ đã sẵn sàng, tải lại để lấy địa chỉ
+    if (!f.processing && !item.thumbnail && /\.(jpe?g|png)$/i.test(item.name)) reloadFolderContent();
+    fileList.setItems(fileItems);
+}
+
+// Gom nhiều thay đổi liên tiếp (vd. upload nhiều file) thành một lần tải lại
+function reloadFolderContent() {
+    clearTimeout(folderContentTimer);
+    folderContentTimer = setTimeout(() => {
+        if (currentFolder) loadFolderContent(currentFolder);
+    }, 300);
+}
+'''
+
+HTML_TEMPLATE = '''
+<!DOCTYPE html>
+<html lang="vi">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/css/all.min.css">
+
+    <title>Quản Lý File Siêu Âm</title>
+    <link rel="stylesheet" href="{{ css_url }}">
+</head>
+<body>
+    <div class="toolbar">
+        <h1>🗂️ Quản Lý File - Đại ca 99 Bắc Ninh</h1>
+
+        <button class="btn btn-primary" onclick="openCreateModal()">+ Tạo Đoàn Khám</button>
+    </div>
+    
+    <div class="main-container">
+        <div class="sidebar" id="sidebar">
+            <div class="folder-search">
+                <input type="text" id="folderSearch" placeholder="🔍 Tìm theo tên công ty..." oninput="searchFolders()">
+            </div>
+            <div class="folder-list" id="folderList"></div>
+        </div>
+        
+        <div class="content">
+            <div class="empty-state" id="emptyState">
+                <h2>👈 Chọn đoàn khám để xem chi tiết</h2>
+                <p>Hoặc tạo đoàn khám mới để bắt đầu</p>
+            </div>
+            
+            <div class="folder-content" id="folderContent" style="display: none;">
+                <div class="content-header">
+                    <h2 id="contentTitle">-</h2>
+                    <p id="contentInfo">-</p>
+                </div>
+                
+                <div>
+                    <button class="btn btn-primary" onclick="openUploadModal()">+ Upload File</button>
+                    <button class="btn" onclick="downloadFolder()">Tải tất cả (ZIP)</button>
+                    <button class="btn" onclick="downloadSelected()">Tải file đã chọn</button>
+                    <select id="fileSort" class="file-sort" onchange="changeFileSort()">
+                        <option value="upload_time:asc">Thứ tự upload</option>
+                        <option value="upload_time:desc">Mới nhất trước</option>
+                        <option value="name:asc">Tên A → Z</option>
+                        <option value="name:desc">Tên Z → A</option>
+                        <option value="size:desc">Lớn nhất trước</option>
+                        <option value="size:asc">Nhỏ nhất trước</option>
+                    </select>
+                    <span class="file-summary" id="fileSummary"></span>
+                </div>
+                
+                <div class="file-list" id="fileList"></div>
+            </div>
+        </div>
+    </div>
+    
+    <!-- Modal Tạo/Sửa -->
+    <div class="modal" id="createModal">
+        <div class="modal-content">
+            <div class="modal-header" id="modalTitle">Tạo Đoàn Khám Mới</div>
+            <div class="modal-body">
+                <form id="folderForm">
+                    <input type="hidden" id="editFolderName">
+                    
+                    <div class="form-group">
+                        <label>Tên Công Ty *</label>
+                        <input type="text" id="companyName" required placeholder="Nhập tên công ty">
+                    </div>
+                    
+                    <div class="form-group">
+                        <label>Ngày Khám *</label>
+                        <input type="date" id="examDate" required>
+                    </div>
+                    
+                    <div class="form-group">
+                        <label>Ghi Chú</label>
+                        <textarea id="notes" rows="3" placeholder="Ghi chú..."></textarea>
+                    </div>
+                    
+                    <div class="form-group" id="uploadGroup">
+                        <label>Chọn File (Tùy chọn)</label>
+                        <div class="file-upload-box" id="dropArea">
+                            <div style="font-size: 36px; margin-bottom: 10px;">📁</div>
+                            <div>Kéo thả file hoặc click để chọn</div>
+                            <div style="font-size: 11px; color: #999; margin-top: 5px;">Excel, Word, PDF, Hình ảnh</div>
+                        </div>
+                        <input type="file" id="fileInput" multiple style="display: none;"
+                               accept=".xlsx,.xls,.csv,.doc,.docx,.pdf,.jpg,.jpeg,.png,.zip,.rar">
+                        
+                        <div class="selected-files" id="selectedFiles">
+                            <div id="filesList"></div>
+                        </div>
+                    </div>
+                </form>
+            </div>
+            <div class="modal-footer">
+                <button class="btn" onclick="closeModal()">Hủy</button>
+                <button class="btn btn-primary" onclick="saveFolder()">Lưu</button>
+            </div>
+        </div>
+    </div>
+    
+    <!-- Modal Upload File -->
+    <div class="modal" id="uploadModal">
+        <div class="modal-content">
+            <div class="modal-header">Upload File</div>
+            <div class="modal-body">
+                <div class="file-upload-box" id="uploadDropArea">
+                    <div style="font-size: 36px; margin-bottom: 10px;">📁</div>
+                    <div>Kéo thả file hoặc click để chọn</div>
+                    <div style="font-size: 11px; color: #999; margin-top: 5px;">Excel, Word, PDF, Hình ảnh</div>
+                </div>
+                <input type="file" id="uploadFileInput" multiple style="display: none;"
+                       accept=".xlsx,.xls,.csv,.doc,.docx,.pdf,.jpg,.jpeg,.png,.zip,.rar">
+                
+                <div class="selected-files" id="uploadSelectedFiles">
+                    <div id="uploadFilesList"></div>
+                </div>
+            </div>
+            <div class="modal-footer">
+                <button class="btn" onclick="closeUploadModal()">Hủy</button>
+                <button class="btn btn-primary" onclick="uploadFiles()">Upload</button>
+            </div>
+        </div>
+    </div>
+    
+    <!-- Modal xem trước file (bảng tính, PDF, ZIP, ảnh) -->
+    <div class="modal" id="previewModal">
+        <div class="modal-content preview-content">
+            <div class="modal-header" id="previewTitle"></div>
+            <div class="modal-body" id="previewBody"></div>
+            <div class="modal-footer">
+                <span class="preview-info" id="previewInfo"></span>
+                <button class="btn" id="previewPrev">Trước</button>
+                <button class="btn" id="previewNext">Sau</button>
+                <button class="btn" onclick="closePreview()">Đóng</button>
+            </div>
+        </div>
+    </div>
+    
+    <script src="{{ js_url }}"></script>
+
 <div id="toast"></div>
 </body>
 </html>
 '''
 
+# ---- Static assets ----
+# The page is rendered once at startup. CSS and JS are served from
+# content-fingerprinted URLs that browsers may cache forever; every variant
+# is compressed up front. Repeat visits revalidate only the small HTML page.
+
+STATIC_ASSET_MAX_AGE = 365 * 24 * 3600
+
+def build_static_asset(text, mimetype):
+    body = text.encode('utf-8')
+    asset = {
+        'mimetype': mimetype,
+        'digest': hashlib.sha256(body).hexdigest(),
+        'identity': body,
+        'gzip': gzip.compress(body, 9, mtime=0)
+    }
+    if brotli is not None:
+        asset['br'] = brotli.compress(body, quality=11)
+    return asset
+
+def build_static_assets():
+    assets = {}
+    urls = {}
+    for key, text, ext, mimetype in (('css_url', PAGE_CSS, 'css', 'text/css'),
+                                     ('js_url', PAGE_JS, 'js', 'text/javascript')):
+        asset = build_static_asset(text, mimetype)
+        name = f"app.{asset['digest'][:12]}.{ext}"
+        assets[name] = asset
+        urls[key] = '/assets/' + name
+    page = build_static_asset(app.jinja_env.from_string(HTML_TEMPLATE).render(**urls), 'text/html')
+    return page, assets
+
+def static_asset_response(asset, cache_control):
+    encoding = request.accept_encodings.best_match([e for e in ('br', 'gzip') if e in asset],
+                                                   default='identity')
+    response = Response(asset[encoding], mimetype=asset['mimetype'])
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = cache_control
+    response.set_etag(asset['digest'][:32] + ('' if encoding == 'identity' else '-' + encoding))
+    return response.make_conditional(request)
+
+PAGE, STATIC_ASSETS = build_static_assets()
+
+# ---- JSON response compression ----
+
+# File downloads are sent as stored; most are already compressed formats
+COMPRESS_EXCLUDED_ENDPOINTS = {'download_file', 'download_folder', 'download_selected', 'zip_member'}
+COMPRESS_ENCODINGS = ('br', 'gzip')
+
+def strip_etag_encoding(etag):
+    # Compressed bodies carry their ETag with the content-coding appended (a
+    # strong validator names one exact body); the routes compare the base
+    for encoding in COMPRESS_ENCODINGS:
+        if etag.endswith(f'-{encoding}'):
+            return etag[:-len(encoding) - 1]
+    return etag
+
+def etag_matches(etags, etag):
+    # etag is in If-None-Match/If-Match, for any content-coding of the body
+    return etag in etags or any(strip_etag_encoding(tag) == etag for tag in etags.as_set())
+
+@app.after_request
+def compress_json_response(response):
+    etag, weak = response.get_etag()
+    if response.status_code == 304 and etag and request.endpoint not in COMPRESS_EXCLUDED_ENDPOINTS:
+        # Answer with the ETag of the variant the client holds
+        for tag in request.if_none_match.as_set():
+            if strip_etag_encoding(tag) == etag:
+                response.set_etag(tag, weak)
+                break
+        return response
+    if (response.mimetype != 'application/json'
+            or request.endpoint in COMPRESS_EXCLUDED_ENDPOINTS
+            or response.status_code in (204, 304)
+            or response.is_streamed or response.direct_passthrough
+            or 'Content-Encoding' in response.headers):
+        return response
+    
+    response.vary.add('Accept-Encoding')
+    size = response.content_length or 0
+    if not app.config['COMPRESS_MIN_SIZE'] <= size <= app.config['COMPRESS_MAX_SIZE']:
+        return response
+    
+    encodings = [e for e in COMPRESS_ENCODINGS if e != 'br' or brotli is not None]
+    encoding = request.accept_encodings.best_match(encodings)
+    if encoding is None:
+        return response
+    
+    if encoding == 'br':
+        body = brotli.compress(response.get_data(), quality=app.config['COMPRESS_BROTLI_QUALITY'])
+    else:
+        body = gzip.compress(response.get_data(), app.config['COMPRESS_GZIP_LEVEL'], mtime=0)
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    if etag:
+        response.set_etag(f'{etag}-{encoding}', weak)
+    return response
+
+@app.before_request
+def start_background_jobs():
+    start_job_dispatcher()
+
 @app.route('/')
 def index():
-    return render_template_string(HTML_TEMPLATE)
+    return static_asset_response(PAGE, 'no-cache')
+
+@app.route('/assets/<name>')
+def static_asset(name):
+    asset = STATIC_ASSETS.get(name)
+    if asset is None:
+        return jsonify({'success': False, 'message': 'File không tồn tại'}), 404
+    return static_asset_response(asset, f'public, max-age={STATIC_ASSET_MAX_AGE}, immutable')
 
 @app.route('/create_folder', methods=['POST'])
 def create_folder():
+    parts = []
     try:
-        company_name = request.form.get('company_name', '').strip()
-        exam_date = request.form.get('exam_date', '').strip()
-        notes = request.form.get('notes', '').strip()
+        # The folder doesn't exist yet while the body streams in, so files are
+        # staged in the upload root (same filesystem) and renamed afterwards.
+        form, parts = stream_multipart_form(lambda form: app.config['BASE_UPLOAD_FOLDER'])
+        
+        company_name = form.get('company_name', '').strip()
+        exam_date = form.get('exam_date', '').strip()
+        notes = form.get('notes', '').strip()
         
         if not company_name or not exam_date:
             return jsonify({'success': False, 'message': 'Vui lòng nhập đầy đủ thông tin'})
@@ -940,72 +4201,123 @@ def create_folder():
         
         os.makedirs(folder_path)
         
-        metadata = load_metadata()
-        metadata[folder_name] = {
-            'company_name': company_name,
-            'exam_date': exam_date,
-            'notes': notes,
-            'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-            'files': []
-        }
-        
-        # Upload files if any
-        files = request.files.getlist('files')
-        if files and files[0].filename != '':
-            for file in files:
-                if file and allowed_file(file.filename):
-                    filename = secure_filename(file.filename)
+        linked, new_blobs = [], []
+        try:
+            remove_blob_files(run_write(create_exam_group, folder_name, company_name, exam_date, notes, []))
+            
+            # Upload files if any
+            files = [p for p in parts if p['field'] == 'files' and allowed_file(p['filename'])]
+            if files:
+                names = run_write(allocate_filenames, folder_name, [secure_filename(p['filename']) for p in files])
+                uploaded_files = []
+                for part, filename in zip(files, names):
                     file_path = os.path.join(folder_path, filename)
-                    file.save(file_path)
-                    
-                    file_size = os.path.getsize(file_path)
-                    file_info = {
-                        'name': filename,
-                        'size': file_size,
-                        'upload_time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                        'description': ''
-                    }
-                    metadata[folder_name]['files'].append(file_info)
-        
-        save_metadata(metadata)
+                    if link_blob(part['sha256'], file_path, part['temp_path']):
+                        new_blobs.append(part['sha256'])
+                    linked.append(file_path)
+                    uploaded_files.append(streamed_file_info(part, filename))
+                remove_blob_files(run_write(insert_files, folder_name, uploaded_files))
+        except Exception:
+            # Leave nothing half-created behind, so the request can be retried
+            try:
+                remove_blob_files(run_write(delete_exam_group, folder_name))
+            except Exception:
+                pass
+            discard_linked_files(linked, new_blobs)
+            shutil.rmtree(folder_path, ignore_errors=True)
+            raise
         
         return jsonify({'success': True, 'folder_name': folder_name})
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
+    finally:
+        discard_streamed_files(parts)
+
+def encode_cursor(*values):
+    return base64.urlsafe_b64encode(json.dumps(values, ensure_ascii=False).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    return json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
 
 @app.route('/get_folders')
 def get_folders():
+    # Newest exam date first, one page at a time. ?cursor= continues after the
+    # last row of the previous page (keyset pagination on the
+    # (exam_date, name) index). Optional filters: ?company= (substring),
+    # ?company_prefix=, ?date_from=, ?date_to=. Company filters ignore case
+    # and diacritics.
     try:
-        metadata = load_metadata()
+        limit = request.args.get('limit', app.config['FOLDERS_PAGE_SIZE'], type=int)
+        limit = max(1, min(limit, app.config['FOLDERS_PAGE_MAX']))
+        
+        where, params = [], []
+        
+        company = fold_text(request.args.get('company', '').strip())
+        if company:
+            where.append('instr(g.search_name, ?) > 0')
+            params.append(company)
+        
+        company_prefix = fold_text(request.args.get('company_prefix', '').strip())
+        if company_prefix:
+            where.append('g.search_name >= ? AND g.search_name < ?')
+            params += [company_prefix, company_prefix + '\U0010ffff']
+        
+        if request.args.get('date_from'):
+            where.append('g.exam_date >= ?')
+            params.append(request.args['date_from'])
+        
+        if request.args.get('date_to'):
+            where.append('g.exam_date <= ?')
+            params.append(request.args['date_to'])
+        
+        # ?storage=hot|cold: loose files, or packed into an archive
+        if request.args.get('storage') in ('hot', 'cold'):
+            where.append(f"g.archive IS {'NOT ' if request.args['storage'] == 'cold' else ''}NULL")
+        
+        if request.args.get('cursor'):
+            last_date, last_name = decode_cursor(request.args['cursor'])
+            where.append('(g.exam_date, g.name) < (?, ?)')
+            params += [last_date, last_name]
+        
+        rows = get_db().execute(f'''
+            SELECT g.name, g.company_name, g.exam_date, g.notes, g.file_count, g.total_bytes, g.archive, g.archived_at
+            FROM exam_groups g
+            WHERE {' AND '.join(where) or '1'}
+            ORDER BY g.exam_date DESC, g.name DESC
+            LIMIT ?
+        ''', params + [limit + 1]).fetchall()
+        
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1]['exam_date'], rows[-1]['name'])
+        
         folders = []
         
-        for folder_name, info in metadata.items():
-            folder_path = os.path.join(app.config['BASE_UPLOAD_FOLDER'], folder_name)
-            if os.path.exists(folder_path):
-                files = info.get('files', [])
-                file_count = len(files)
-                total_size = sum(f.get('size', 0) for f in files)
-                
-                folders.append({
-                    'name': folder_name,
-                    'display_name': info.get('company_name', folder_name),
-                    'exam_date': info.get('exam_date', ''),
-                    'notes': info.get('notes', ''),
-                    'file_count': file_count,
-                    'total_size': format_size(total_size)
-                })
+        for row in rows:
+            folders.append({
+                'name': row['name'],
+                'display_name': row['company_name'] or row['name'],
+                'exam_date': row['exam_date'],
+                'notes': row['notes'],
+                'file_count': row['file_count'],
+                'total_size': format_size(row['total_bytes']),
+                'storage': 'cold' if row['archive'] else 'hot',
+                'archived_at': row['archived_at']
+            })
         
-        folders.sort(key=lambda x: x.get('exam_date', ''), reverse=True)
-        return jsonify({'success': True, 'folders': folders})
+        return jsonify({'success': True, 'folders': folders, 'next_cursor': next_cursor})
     except Exception as e:
         return jsonify({'success': False, 'message': str(e), 'folders': []})
 
 @app.route('/get_folder_info/<folder_name>')
 def get_folder_info(folder_name):
     try:
-        metadata = load_metadata()
-        info = metadata.get(folder_name, {})
-        return jsonify({'success': True, 'info': info})
+        info = get_exam_group(folder_name) or {}
+        response = jsonify({'success': True, 'info': info})
+        if info:
+            response.set_etag(str(info['version']))
+        return response
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
 
@@ -1015,18 +4327,27 @@ def update_folder():
         data = request.json
         folder_name = data.get('folder_name')
         
-        metadata = load_metadata()
-        
-        if folder_name not in metadata:
-            return jsonify({'success': False, 'message': 'Đoàn khám không tồn tại'})
+        fields = (data.get('company_name', ''), data.get('exam_date', ''), data.get('notes', ''))
         
-        metadata[folder_name]['company_name'] = data.get('company_name', '')
-        metadata[folder_name]['exam_date'] = data.get('exam_date', '')
-        metadata[folder_name]['notes'] = data.get('notes', '')
+        if request.if_match and not request.if_match.star_tag:
+            # Client edited a specific version: apply only if it is still current
+            expected = next(iter(request.if_match.as_set()), None)
+            expected = expected and strip_etag_encoding(expected)
+            expected_version = int(expected) if expected and expected.isdigit() else -1
+            version = run_write(update_exam_group, folder_name, *fields, expected_version=expected_version)
+        else:
+            version = run_write_cas(folder_name, update_exam_group, *fields)
         
-        save_metadata(metadata)
+        if version is None:
+            return jsonify({'success': False, 'message': 'Đoàn khám không tồn tại'})
         
-        return jsonify({'success': True})
+        response = jsonify({'success': True})
+        response.set_etag(str(version))
+        return response
+    except VersionConflict as e:
+        response = jsonify({'success': False, 'message': str(e)})
+        response.set_etag(str(e.current_version))
+        return response, 412
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
 
@@ -1035,96 +4356,341 @@ def delete_folder(folder_name):
     try:
         folder_path = os.path.join(app.config['BASE_UPLOAD_FOLDER'], folder_name)
         
-        if not os.path.exists(folder_path):
+        # The metadata decides: the blob store and caches live next to the
+        # exam-group folders and must never be taken for one
+        if get_group_version(folder_name) is None:
             return jsonify({'success': False, 'message': 'Đoàn khám không tồn tại'})
         
-        import shutil
-        shutil.rmtree(folder_path)
+        shutil.rmtree(folder_path, ignore_errors=True)
         
-        metadata = load_metadata()
-        if folder_name in metadata:
-            del metadata[folder_name]
-            save_metadata(metadata)
+        remove_blob_files(run_write(delete_exam_group, folder_name))
         
         return jsonify({'success': True})
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
 
+FILE_SORT_COLUMNS = {'name', 'size', 'upload_time'}
+
+def file_page_args(args):
+    # ?sort=name|size|upload_time (default upload_time, i.e. upload order),
+    # ?order=asc|desc, ?limit=
+    sort = args.get('sort', 'upload_time')
+    if sort not in FILE_SORT_COLUMNS:
+        raise ValueError('Kiểu sắp xếp không hợp lệ')
+    order = 'desc' if args.get('order') == 'desc' else 'asc'
+    limit = args.get('limit', app.config['FILES_PAGE_SIZE'], type=int)
+    return sort, order, max(1, min(limit, app.config['FILES_PAGE_MAX']))
+
+def query_file_page(conn, folder_name, sort, order, limit, cursor=None):
+    # One page of files; the cursor continues after the last row of the
+    # previous page, ties are broken by file id.
+    where, params = 'folder = ?', [folder_name]
+    if cursor:
+        last_value, last_id = decode_cursor(cursor)
+        where += f" AND ({sort}, id) {'<' if order == 'desc' else '>'} (?, ?)"
+        params += [last_value, last_id]
+    
+    rows = conn.execute(
+        f'''
+            SELECT *, EXISTS (
+                SELECT 1 FROM jobs j WHERE j.file_id = files.id AND j.status IN ('queued', 'running')
+            ) AS processing
+            FROM files WHERE {where} ORDER BY {sort} {order}, id {order} LIMIT ?
+        ''',
+        params + [limit + 1]
+    ).fetchall()
+    
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1][sort], rows[-1]['id'])
+    
+    file_list = []
+    for row in rows:
+        file_list.append({
+            'name': row['name'],
+            'size': format_size(row['size']),
+            'upload_time': row['upload_time'],
+            'description': row['description'],
+            'processing': bool(row['processing']),
+            'thumbnail': thumbnail_url(row),
+            'original_size': format_size(row['original_size']) if row['original_size'] is not None else None
+        })
+    return file_list, next_cursor
+
 @app.route('/get_files/<folder_name>')
 def get_files(folder_name):
     try:
-        metadata = load_metadata()
-        folder_info = metadata.get(folder_name, {})
-        files = folder_info.get('files', [])
-        
-        file_list = []
-        for f in files:
-            file_list.append({
-                'name': f.get('name', ''),
-                'size': format_size(f.get('size', 0)),
-                'upload_time': f.get('upload_time', ''),
-                'description': f.get('description', '')
-            })
+        sort, order, limit = file_page_args(request.args)
+        
+        with db_snapshot() as conn:
+            group = conn.execute('SELECT file_count, total_bytes FROM exam_groups WHERE name = ?',
+                                 (folder_name,)).fetchone()
+            if group is None:
+                return jsonify({'success': False, 'message': 'Đoàn khám không tồn tại', 'files': []})
+            file_list, next_cursor = query_file_page(conn, folder_name, sort, order, limit,
+                                                     request.args.get('cursor'))
         
         return jsonify({
             'success': True,
-            'files': file_list
+            'files': file_list,
+            'next_cursor': next_cursor,
+            'file_count': group['file_count'],
+            'total_size': format_size(group['total_bytes'])
         })
     except Exception as e:
         return jsonify({'success': False, 'message': str(e), 'files': []})
 
+@app.route('/folder_snapshot/<folder_name>')
+def folder_snapshot(folder_name):
+    # Group info, totals and the first page of files in one response. Every
+    # change to the group or its files bumps its version, so the version, the
+    # number of files still being processed and the page parameters make a
+    # strong ETag and unchanged groups revalidate with a 304 without listing
+    # the files.
+    try:
+        sort, order, limit = file_page_args(request.args)
+        
+        with db_snapshot() as conn:
+            group = conn.execute('SELECT * FROM exam_groups WHERE name = ?', (folder_name,)).fetchone()
+            if group is None:
+                return jsonify({'success': False, 'message': 'Đoàn khám không tồn tại'})
+            
+            pending = conn.execute('''
+                SELECT COUNT(*) FROM jobs j JOIN files f ON f.id = j.file_id
+                WHERE f.folder = ? AND j.status IN ('queued', 'running')
+            ''', (folder_name,)).fetchone()[0]
+            etag = f"{group['version']}-{pending}-{sort}-{order}-{limit}"
+            if etag_matches(request.if_none_match, etag):
+                response = Response(status=304)
+            else:
+                file_list, next_cursor = query_file_page(conn, folder_name, sort, order, limit)
+                response = jsonify({
+                    'success': True,
+                    'info': {
+                        'company_name': group['company_name'],
+                        'exam_date': group['exam_date'],
+                        'notes': group['notes'],
+                        'created_at': group['created_at'],
+                        'version': group['version'],
+                        'file_count': group['file_count'],
+                        'total_size': format_size(group['total_bytes'])
+                    },
+                    'files': file_list,
+                    'next_cursor': next_cursor
+                })
+        
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)})
+
+SEARCH_SNIPPET_BEFORE = 60
+SEARCH_SNIPPET_LENGTH = 200
+
+@app.route('/search')
+def search():
+    # Full-text search over file names and document contents, ignoring case
+    # and Vietnamese diacritics. ?q= (words, the last may be partial),
+    # optional ?folder= and ?limit=. Hits are ranked by BM25, with file-name
+    # matches weighted above body matches.
+    try:
+        tokens = search_tokens(request.args.get('q', ''))
+        if not tokens:
+            return jsonify({'success': True, 'results': [], 'folders': []})
+        
+        limit = request.args.get('limit', app.config['SEARCH_RESULTS'], type=int)
+        limit = max(1, min(limit, app.config['SEARCH_RESULTS_MAX']))
+        
+        folder_filter, params = '', [search_match_expression(tokens)]
+        if request.args.get('folder'):
+            folder_filter = 'AND f.folder = ?'
+            params.append(request.args['folder'])
+        
+        # Snippet around the first token found in the body
+        position = 'COALESCE(' + ', '.join(['NULLIF(instr(t.body, ?), 0)'] * len(tokens)) + ', 0)'
+        rows = get_db().execute(f'''
+            WITH hits AS (
+                SELECT file_search.rowid AS file_id, bm25(file_search, 10.0, 1.0) AS score
+                FROM file_search JOIN files f ON f.id = file_search.rowid
+                WHERE file_search MATCH ? {folder_filter}
+                ORDER BY score
+                LIMIT ?
+            ), positioned AS (
+                SELECT h.file_id, h.score, {position} AS pos FROM hits h JOIN file_text t ON t.file_id = h.file_id
+            )
+            SELECT p.score, p.pos, f.folder, f.name, f.size, f.upload_time, g.company_name, g.exam_date,
+                   CASE WHEN p.pos > 0 THEN substr(t.text, max(p.pos - ?, 1), ?) ELSE '' END AS snippet
+            FROM positioned p
+            JOIN file_text t ON t.file_id = p.file_id
+            JOIN files f ON f.id = p.file_id
+            JOIN exam_groups g ON g.name = f.folder
+            ORDER BY p.score
+        ''', params + [limit] + tokens + [SEARCH_SNIPPET_BEFORE, SEARCH_SNIPPET_LENGTH]).fetchall()
+        
+        results = []
+        folders = {}
+        for row in rows:
+            snippet, highlights = search_snippet(row['snippet'], row['pos'] - SEARCH_SNIPPET_BEFORE, tokens)
+            results.append({
+                'folder': row['folder'],
+                'company_name': row['company_name'],
+                'exam_date': row['exam_date'],
+                'name': row['name'],
+                'size': format_size(row['size']),
+                'upload_time': row['upload_time'],
+                'snippet': snippet,
+                'highlights': highlights,
+                'score': round(-row['score'], 3)
+            })
+            folder = folders.setdefault(row['folder'], {
+                'name': row['folder'],
+                'company_name': row['company_name'],
+                'exam_date': row['exam_date'],
+                'hits': 0
+            })
+            folder['hits'] += 1
+        
+        return jsonify({'success': True, 'results': results, 'folders': list(folders.values())})
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e), 'results': []})
+
+def last_change_seq(conn):
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'changes'").fetchone()
+    return row['seq'] if row else 0
+
+def iter_changes(since):
+    # Server-sent events, one per row of the changes table, with the sequence
+    # number as the event id so EventSource resumes via Last-Event-ID. A
+    # client whose position has already been pruned gets a 'reset' event and
+    # should reload everything. The stream ends after CHANGES_STREAM_MAX_AGE
+    # so it doesn't hold a worker for good; EventSource reconnects by itself.
+    conn = get_db()
+    deadline = time.monotonic() + app.config['CHANGES_STREAM_MAX_AGE']
+    yield 'retry: 3000\n\n'
+    
+    last_seq = last_change_seq(conn)
+    if since is None or since > last_seq:
+        since = last_seq
+    elif since < last_seq:
+        oldest = conn.execute('SELECT MIN(seq) FROM changes').fetchone()[0]
+        if oldest is None or oldest > since + 1:
+            yield f'id: {last_seq}\nevent: reset\ndata: {{}}\n\n'
+            since = last_seq
+    # An id without data sets the browser's Last-Event-ID without an event,
+    # so changes made while it reconnects aren't missed
+    yield f'id: {since}\n\n'
+    
+    last_sent = time.monotonic()
+    while time.monotonic() < deadline:
+        rows = conn.execute('SELECT seq, kind, data FROM changes WHERE seq > ? ORDER BY seq LIMIT 500',
+                            (since,)).fetchall()
+        for row in rows:
+            yield f"id: {row['seq']}\nevent: {row['kind']}\ndata: {row['data']}\n\n"
+            since = row['seq']
+        if rows:
+            last_sent = time.monotonic()
+            continue
+        
+        if time.monotonic() - last_sent >= app.config['CHANGES_HEARTBEAT']:
+            yield ': ping\n\n'
+            last_sent = time.monotonic()
+        with _changes_cond:
+            _changes_cond.wait(max(0, min(app.config['CHANGES_POLL_INTERVAL'], deadline - time.monotonic())))
+
+@app.route('/changes')
+def changes():
+    # Each open stream holds a worker thread for up to CHANGES_STREAM_MAX_AGE;
+    # gunicorn.conf.py runs threaded workers so that streams don't starve
+    # other requests.
+    since = request.headers.get('Last-Event-ID', request.args.get('since'))
+    since = int(since) if since and since.isdigit() else None
+    response = Response(iter_changes(since), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/jobs')
+def list_jobs():
+    # Background jobs of an exam group (?folder=), optionally of one file
+    # (&name=) or in one state (&status=queued|running|done|failed)
+    try:
+        where, params = ['f.folder = ?'], [request.args.get('folder', '')]
+        if request.args.get('name'):
+            where.append('f.name = ?')
+            params.append(request.args['name'])
+        if request.args.get('status'):
+            where.append('j.status = ?')
+            params.append(request.args['status'])
+        rows = get_db().execute(f'''
+            SELECT j.*, f.folder, f.name FROM jobs j JOIN files f ON f.id = j.file_id
+            WHERE {' AND '.join(where)} ORDER BY j.id DESC LIMIT 500
+        ''', params).fetchall()
+        return jsonify({'success': True, 'jobs': [job_row_to_dict(row) for row in rows]})
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)})
+
+@app.route('/jobs/<int:job_id>')
+def get_job(job_id):
+    try:
+        row = get_db().execute('''
+            SELECT j.*, f.folder, f.name FROM jobs j JOIN files f ON f.id = j.file_id WHERE j.id = ?
+        ''', (job_id,)).fetchone()
+        if row is None:
+            return jsonify({'success': False, 'message': 'Job không tồn tại'})
+        return jsonify({'success': True, 'job': job_row_to_dict(row)})
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)})
+
+def upload_staging_dir(form):
+    # Stage straight into the target exam group when folder_name was sent
+    # before the files (as the UI does), otherwise in the upload root.
+    folder_name = secure_filename(form.get('folder_name', ''))
+    folder_path = os.path.join(app.config['BASE_UPLOAD_FOLDER'], folder_name)
+    if folder_name and os.path.isdir(folder_path):
+        return folder_path
+    return app.config['BASE_UPLOAD_FOLDER']
+
 @app.route('/upload', methods=['POST'])
 def upload_file():
+    parts = []
     try:
-        folder_name = request.form.get('folder_name')
+        form, parts = stream_multipart_form(upload_staging_dir)
+        folder_name = form.get('folder_name')
         
         if not folder_name:
             return jsonify({'success': False, 'message': 'Chưa chọn đoàn khám'})
         
-        files = request.files.getlist('files')
+        files = [p for p in parts if p['field'] == 'files']
         
-        if not files or files[0].filename == '':
+        if not files or files[0]['filename'] == '':
             return jsonify({'success': False, 'message': 'Chưa chọn file'})
         
         folder_path = os.path.join(app.config['BASE_UPLOAD_FOLDER'], folder_name)
         
-        if not os.path.exists(folder_path):
+        if not os.path.exists(folder_path) or get_db().execute(
+                'SELECT 1 FROM exam_groups WHERE name = ?', (folder_name,)).fetchone() is None:
             return jsonify({'success': False, 'message': 'Đoàn khám không tồn tại'})
         
-        metadata = load_metadata()
-        folder_info = metadata.get(folder_name, {})
+        uploaded_files = []
+        files = [p for p in files if allowed_file(p['filename'])]
+        names = run_write(allocate_filenames, folder_name, [secure_filename(p['filename']) for p in files])
         
-        uploaded_count = 0
-        
-        for file in files:
-            if file and allowed_file(file.filename):
-                filename = secure_filename(file.filename)
-                
-                base_name, ext = os.path.splitext(filename)
-                counter = 1
-                while os.path.exists(os.path.join(folder_path, filename)):
-                    filename = f"{base_name}_{counter}{ext}"
-                    counter += 1
-                
+        linked, new_blobs = [], []
+        try:
+            for part, filename in zip(files, names):
                 file_path = os.path.join(folder_path, filename)
-                file.save(file_path)
-                
-                file_size = os.path.getsize(file_path)
-                file_info = {
-                    'name': filename,
-                    'size': file_size,
-                    'upload_time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                    'description': ''
-                }
-                
-                if 'files' not in folder_info:
-                    folder_info['files'] = []
-                
-                folder_info['files'].append(file_info)
-                uploaded_count += 1
-        
-        metadata[folder_name] = folder_info
-        save_metadata(metadata)
+                if link_blob(part['sha256'], file_path, part['temp_path']):
+                    new_blobs.append(part['sha256'])
+                linked.append(file_path)
+                uploaded_files.append(streamed_file_info(part, filename))
+            
+            remove_blob_files(run_write(insert_files, folder_name, uploaded_files))
+        except Exception:
+            discard_linked_files(linked, new_blobs)
+            raise
+        uploaded_count = len(uploaded_files)
         
         return jsonify({
             'success': True,
@@ -1133,16 +4699,542 @@ def upload_file():
         })
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
+    finally:
+        discard_streamed_files(parts)
+
+@app.route('/upload/by_hash', methods=['POST'])
+def upload_by_hash():
+    # "Do you already have these bytes?" The browser sends name, size and
+    # SHA-256 per file; every file whose blob is already stored is linked into
+    # the exam group right away and only the rest need to be uploaded. Images
+    # stored optimised are found by the hash of the original the client has,
+    # and linked to the optimised blob.
+    try:
+        data = request.json
+        folder_name = data.get('folder_name')
+        
+        if not folder_name:
+            return jsonify({'success': False, 'message': 'Chưa chọn đoàn khám'})
+        
+        folder_path = os.path.join(app.config['BASE_UPLOAD_FOLDER'], folder_name)
+        
+        if not os.path.exists(folder_path) or get_group_version(folder_name) is None:
+            return jsonify({'success': False, 'message': 'Đoàn khám không tồn tại'})
+        
+        known = []
+        conn = get_db()
+        
+        for index, entry in enumerate(data.get('files', [])):
+            sha256 = str(entry.get('sha256', '')).lower()
+            name = entry.get('name', '')
+            if not re.fullmatch(r'[0-9a-f]{64}', sha256) or not allowed_file(name):
+                continue
+            
+            blob = conn.execute('SELECT size FROM blobs WHERE sha256 = ?', (sha256,)).fetchone()
+            if blob is not None and blob['size'] == entry.get('size', blob['size']):
+                known.append((index, sha256, secure_filename(name), blob['size'], None))
+                continue
+            optimized = conn.execute('''
+                SELECT f.sha256, f.size, f.original_size FROM files f JOIN blobs b ON b.sha256 = f.sha256
+                WHERE f.original_sha256 = ? LIMIT 1
+            ''', (sha256,)).fetchone()
+            if optimized is not None and optimized['original_size'] == entry.get('size', optimized['original_size']):
+                known.append((index, optimized['sha256'], secure_filename(name), optimized['size'],
+                              {'original_size': optimized['original_size'], 'original_sha256': sha256}))
+        
+        linked = []
+        uploaded_files = []
+        names = run_write(allocate_filenames, folder_name, [k[2] for k in known]) if known else []
+        
+        linked_paths = []
+        try:
+            for (index, sha256, _, size, original), filename in zip(known, names):
+                file_path = os.path.join(folder_path, filename)
+                try:
+                    link_blob(sha256, file_path)
+                except FileNotFoundError:
+                    continue
+                linked_paths.append(file_path)
+                
+                uploaded_files.append({
+                    'name': filename,
+                    'size': size,
+                    'upload_time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                    'description': '',
+                    'sha256': sha256,
+                    **(original or {})
+                })
+                linked.append(index)
+            
+            remove_blob_files(run_write(insert_files, folder_name, uploaded_files))
+        except Exception:
+            discard_linked_files(linked_paths, [])
+            raise
+        
+        return jsonify({'success': True, 'linked': linked, 'files': uploaded_files})
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)})
+
+@app.route('/upload/init', methods=['POST'])
+def upload_init():
+    try:
+        data = request.json
+        folder_name = data.get('folder_name')
+        filename = data.get('filename', '')
+        size = int(data.get('size', -1))
+        
+        if not folder_name:
+            return jsonify({'success': False, 'message': 'Chưa chọn đoàn khám'})
+        
+        if not allowed_file(filename) or size < 0:
+            return jsonify({'success': False, 'message': 'File không hợp lệ'})
+        
+        if size > app.config['UPLOAD_MAX_SIZE']:
+            return jsonify({'success': False,
+                            'message': f"File vượt quá dung lượng tối đa {format_size(app.config['UPLOAD_MAX_SIZE'])}"})
+        
+        folder_path = os.path.join(app.config['BASE_UPLOAD_FOLDER'], folder_name)
+        
+        if not os.path.exists(folder_path) or get_group_version(folder_name) is None:
+            return jsonify({'success': False, 'message': 'Đoàn khám không tồn tại'})
+        
+        expire_stale_uploads()
+        
+        upload_id = uuid.uuid4().hex
+        run_write(create_upload, upload_id, folder_name, secure_filename(filename), size)
+        upload = get_upload(upload_id)
+        
+        # Chunks are written in place at their offsets, so the staging file
+        # is created at its final size up front.
+        with open(upload_staging_path(upload), 'wb') as f:
+            f.truncate(size)
+        
+        return jsonify({'success': True, **upload_status(upload)})
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)})
+
+@app.route('/upload/chunk/<upload_id>', methods=['PUT'])
+def upload_chunk(upload_id):
+    try:
+        upload = get_upload(upload_id)
+        
+        if upload is None:
+            return jsonify({'success': False, 'message': 'Phiên upload không tồn tại'}), 404
+        
+        start = request.args.get('offset', type=int)
+        length = request.content_length
+        
+        if start is None or length is None or start < 0 or start + length > upload['size']:
+            return jsonify({'success': False, 'message': 'Vị trí chunk không hợp lệ'}), 416
+        
+        written = 0
+        with open(upload_staging_path(upload), 'r+b') as f:
+            f.seek(start)
+            while written < length:
+                buf = request.stream.read(min(1024 * 1024, length - written))
+                if not buf:
+                    break
+                f.write(buf)
+                written += len(buf)
+        
+        # A chunk only counts once it arrived completely; a dropped
+        # connection leaves it unrecorded so the client sends it again.
+        if written != length:
+            return jsonify({'success': False, 'message': 'Chunk bị gián đoạn'}), 400
+        
+        run_write(record_upload_chunk, upload_id, start, length)
+        
+        return jsonify({'success': True, **upload_status(upload)})
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)})
+
+@app.route('/upload/status/<upload_id>')
+def upload_get_status(upload_id):
+    try:
+        upload = get_upload(upload_id)
+        
+        if upload is None:
+            return jsonify({'success': False, 'message': 'Phiên upload không tồn tại'}), 404
+        
+        return jsonify({'success': True, **upload_status(upload)})
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)})
+
+@app.route('/upload/finalize/<upload_id>', methods=['POST'])
+def upload_finalize(upload_id):
+    try:
+        upload = get_upload(upload_id)
+        
+        if upload is None:
+            return jsonify({'success': False, 'message': 'Phiên upload không tồn tại'}), 404
+        
+        status = upload_status(upload)
+        if status['received'] != upload['size'] or status['offset'] != upload['size']:
+            return jsonify({'success': False, 'message': 'Chưa nhận đủ dữ liệu', **status}), 409
+        
+        # Chunks arrive out of order, so the digest is taken once at the end
+        staging_path = upload_staging_path(upload)
+        sha256 = hash_file(staging_path)
+        
+        folder_path = os.path.join(app.config['BASE_UPLOAD_FOLDER'], upload['folder'])
+        filename = run_write(allocate_filenames, upload['folder'], [upload['name']])[0]
+        file_path = os.path.join(folder_path, filename)
+        new_blobs = [sha256] if link_blob(sha256, file_path, staging_path) else []
+        
+        file_info = {
+            'name': filename,
+            'size': upload['size'],
+            'upload_time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'description': '',
+            'sha256': sha256
+        }
+        
+        try:
+            remove_blob_files(run_write(complete_upload, upload_id, upload['folder'], file_info))
+        except Exception:
+            discard_linked_files([file_path], new_blobs)
+            raise
+        
+        return jsonify({'success': True, 'file': file_info})
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)})
+
+@app.route('/upload/cancel/<upload_id>', methods=['DELETE'])
+def upload_cancel(upload_id):
+    try:
+        upload = get_upload(upload_id)
+        
+        if upload is None:
+            return jsonify({'success': False, 'message': 'Phiên upload không tồn tại'}), 404
+        
+        try:
+            os.remove(upload_staging_path(upload))
+        except FileNotFoundError:
+            pass
+        run_write(delete_uploads, [upload_id])
+        
+        return jsonify({'success': True})
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)})
 
 @app.route('/download/<folder_name>/<filename>')
 def download_file(folder_name, filename):
     try:
-        file_path = os.path.join(app.config['BASE_UPLOAD_FOLDER'], folder_name, filename)
+        file_path = os.path.abspath(os.path.join(app.config['BASE_UPLOAD_FOLDER'], folder_name, filename))
+        row = get_db().execute('SELECT sha256, original_sha256, original_kept FROM files WHERE folder = ? AND name = ?',
+                               (folder_name, filename)).fetchone()
+        sha256 = row['sha256'] if row else None
+        location = f'{folder_name}/{filename}'
+        if request.args.get('original'):
+            # The bytes as uploaded, for images optimised with IMAGE_KEEP_ORIGINALS
+            if not row or not row['original_kept']:
+                return jsonify({'success': False, 'message': 'Không lưu bản gốc của file này'})
+            sha256 = row['original_sha256']
+            file_path = os.path.abspath(blob_path(sha256))
+            location = os.path.relpath(file_path, os.path.abspath(app.config['BASE_UPLOAD_FOLDER'])).replace(os.sep, '/')
+        elif row:
+            archived = archived_files(get_db(), folder_name, filename)
+            if archived:
+                # Packed into the exam group's archive: read from its offset
+                # there. Stored members seek for Range requests; deflated
+                # ones are inflated and the bytes before the range skipped.
+                archive_path, member = archived[filename]
+                if member['method'] == 'stored':
+                    body = werkzeug.wsgi.wrap_file(request.environ, StoredZipMember(archive_path, member))
+                else:
+                    body = iter_stored_file(archive_path, member)
+                response = app.response_class(
+                    body, mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+                    direct_passthrough=True)
+                response.headers.set('Content-Disposition', 'attachment', filename=filename)
+                response.content_length = member['size']
+                response.set_etag(sha256 or f"{member['crc']:x}-{member['size']:x}")
+                try:
+                    response.make_conditional(request, accept_ranges=True, complete_length=member['size'])
+                except RequestedRangeNotSatisfiable:
+                    response.close()
+                    raise
+                return response
         
         if not os.path.exists(file_path):
             return jsonify({'success': False, 'message': 'File không tồn tại'})
         
-        return send_file(file_path, as_attachment=True, download_name=filename)
+        # Strong validator: the content hash when we have it, else size+mtime
+        st = os.stat(file_path)
+        etag = sha256 or f'{st.st_size:x}-{st.st_mtime_ns:x}'
+        offload = app.config['DOWNLOAD_OFFLOAD']
+        
+        if offload == 'x-accel-redirect':
+            # nginx serves the body (including Range requests); we only answer
+            # conditionals and hand over the internal location.
+            response = app.response_class(mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+            response.headers.set('Content-Disposition', 'attachment', filename=filename)
+            response.set_etag(etag)
+            response.last_modified = st.st_mtime
+            response.make_conditional(request)
+            if response.status_code == 200:
+                response.headers['X-Accel-Redirect'] = app.config['DOWNLOAD_ACCEL_PREFIX'] + url_quote(location)
+            return response
+        
+        # Handles Range/206, If-Range, If-None-Match and If-Modified-Since
+        return werkzeug.utils.send_file(
+            file_path, request.environ, as_attachment=True, download_name=filename,
+            etag=etag, last_modified=st.st_mtime, conditional=True,
+            use_x_sendfile=offload == 'x-sendfile', response_class=app.response_class
+        )
+    except RequestedRangeNotSatisfiable:
+        # A 416 with Content-Range, not the usual JSON error
+        raise
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)})
+
+@app.route('/preview/<folder_name>/<filename>')
+def preview_table(folder_name, filename):
+    # Rows ?offset= to offset+limit of the first sheet of an xlsx/csv file,
+    # without downloading it. The content hash makes a strong ETag.
+    try:
+        offset = max(0, request.args.get('offset', 0, type=int))
+        limit = request.args.get('limit', app.config['PREVIEW_PAGE_SIZE'], type=int)
+        limit = max(1, min(limit, app.config['PREVIEW_PAGE_MAX']))
+        preview_path, meta, sha256 = load_table_preview(folder_name, filename)
+        
+        etag = f'{sha256}-{offset}-{limit}'
+        if etag_matches(request.if_none_match, etag):
+            response = Response(status=304)
+        else:
+            rows = read_table_rows(preview_path, meta, offset, limit)
+            end = offset + len(rows)
+            response = jsonify({
+                'success': True,
+                'columns': [{'name': c['name'], 'type': c['type']} for c in meta['columns']],
+                'total_rows': meta['total_rows'],
+                'truncated': meta['truncated'],
+                'offset': offset,
+                'rows': rows,
+                'next_offset': end if end < meta['total_rows'] else None
+            })
+        
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    except PreviewNotReady as e:
+        return jsonify({'success': False, 'processing': True, 'message': str(e)})
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)})
+
+@app.route('/preview/<folder_name>/<filename>/stats')
+def preview_table_stats(folder_name, filename):
+    # Per column: non-empty and empty cells; min/max/mean/sum for numbers,
+    # distinct values and the most frequent ones for text
+    try:
+        _, meta, sha256 = load_table_preview(folder_name, filename)
+        if etag_matches(request.if_none_match, sha256):
+            response = Response(status=304)
+        else:
+            response = jsonify({'success': True, 'total_rows': meta['total_rows'],
+                                'truncated': meta['truncated'], 'columns': meta['columns']})
+        response.set_etag(sha256)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    except PreviewNotReady as e:
+        return jsonify({'success': False, 'processing': True, 'message': str(e)})
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)})
+
+@app.route('/pdf/<folder_name>/<filename>')
+def pdf_info(folder_name, filename):
+    # Page count and page sizes (points) of a stored PDF
+    try:
+        index, sha256 = load_pdf_index(folder_name, filename)
+        return jsonify({'success': True, 'page_count': index['page_count'], 'pages': index['pages']})
+    except PreviewNotReady as e:
+        return jsonify({'success': False, 'processing': True, 'message': str(e)})
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)})
+
+@app.route('/pdf/<folder_name>/<filename>/text')
+def pdf_text(folder_name, filename):
+    # Extracted text of pages ?first= to ?last= (all pages by default)
+    try:
+        index, sha256 = load_pdf_index(folder_name, filename)
+        if 'first' in request.args:
+            first, last = pdf_page_range(request.args, index['page_count'])
+        else:
+            first, last = 1, index['page_count']
+        if index['page_count'] == 0:
+            return jsonify({'success': True, 'pages': []})
+        texts = read_pdf_text(sha256, index, first, last)
+        return jsonify({'success': True, 'pages': [
+            {'page': first + i, 'text': text} for i, text in enumerate(texts)
+        ]})
+    except PreviewNotReady as e:
+        return jsonify({'success': False, 'processing': True, 'message': str(e)})
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)})
+
+@app.route('/pdf/<folder_name>/<filename>/pages')
+def pdf_pages(folder_name, filename):
+    # Pages ?first= to ?last= of a stored PDF as a PDF of their own, shown
+    # inline. Doesn't wait for the index; single pages are cached.
+    try:
+        check_pdf(filename)
+        first, last = pdf_page_range(request.args)
+        if last - first + 1 > app.config['PDF_PAGES_MAX']:
+            raise ValueError(f"Tối đa {app.config['PDF_PAGES_MAX']} trang mỗi lần")
+        path, sha256 = cached_file_source(folder_name, filename, f'page-{first}.pdf' if first == last else None)
+        
+        stem = filename.rsplit('.', 1)[0]
+        download_name = f'{stem}_trang_{first}.pdf' if first == last else f'{stem}_trang_{first}-{last}.pdf'
+        if first == last:
+            def write_page(tmp_path):
+                with open(tmp_path, 'wb') as f:
+                    write_pdf_pages(path, first, last, f)
+            
+            page_path = os.path.abspath(os.path.join(file_cache_dir(sha256), f'page-{first}.pdf'))
+            if path is not None:
+                write_cache_entry(sha256, f'page-{first}.pdf', write_page)
+            body = page_path
+        else:
+            body = io.BytesIO()
+            write_pdf_pages(path, first, last, body)
+            body.seek(0)
+        
+        response = send_file(body, mimetype='application/pdf', download_name=download_name,
+                             etag=f'{sha256}-{first}-{last}', conditional=True)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)})
+
+@app.route('/zip/<folder_name>/<filename>')
+def zip_members(folder_name, filename):
+    # Members of a stored ZIP in archive order, ?prefix= to list one folder
+    # of it, paged with ?offset=&limit=
+    try:
+        members, _, sha256 = load_zip_index(folder_name, filename)
+        prefix = request.args.get('prefix', '')
+        if prefix:
+            members = [m for m in members if m['name'].startswith(prefix)]
+        offset = max(0, request.args.get('offset', 0, type=int))
+        limit = request.args.get('limit', app.config['ZIP_PAGE_SIZE'], type=int)
+        limit = max(1, min(limit, app.config['ZIP_PAGE_MAX']))
+        
+        page = members[offset:offset + limit]
+        return jsonify({
+            'success': True,
+            'total': len(members),
+            'members': [{key: m[key] for key in ('name', 'size', 'compressed_size', 'method',
+                                                  'modified', 'encrypted', 'is_dir')} for m in page],
+            'next_offset': offset + limit if offset + limit < len(members) else None
+        })
+    except PreviewNotReady as e:
+        return jsonify({'success': False, 'processing': True, 'message': str(e)})
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)})
+
+@app.route('/zip/<folder_name>/<filename>/member')
+def zip_member(folder_name, filename):
+    # One member (?name=) of a stored ZIP, decompressed while it is sent
+    try:
+        _, by_name, sha256 = load_zip_index(folder_name, filename)
+        member = by_name.get(request.args.get('name', ''))
+        if member is None or member['is_dir']:
+            return jsonify({'success': False, 'message': 'File không có trong ZIP'})
+        decompressor = zip_member_decompressor(member)
+        path = stored_file_path(folder_name, filename)
+        
+        member_name = member['name'].rsplit('/', 1)[-1]
+        response = Response(iter_zip_member(path, member, decompressor),
+                            mimetype=mimetypes.guess_type(member_name)[0] or 'application/octet-stream')
+        response.headers.set('Content-Disposition', 'attachment', filename=member_name)
+        response.content_length = member['size']
+        response.set_etag(f"{sha256}-{member['offset']}")
+        response.make_conditional(request)
+        return response
+    except PreviewNotReady as e:
+        return jsonify({'success': False, 'processing': True, 'message': str(e)})
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)})
+
+@app.route('/thumbnails/<sha256>/<size>.jpg')
+def get_thumbnail(sha256, size):
+    # Thumbnails are named by content hash, so they can be cached forever
+    try:
+        if Image is None or size not in THUMBNAIL_SIZES or not re.fullmatch(r'[0-9a-f]{64}', sha256):
+            return jsonify({'success': False, 'message': 'Ảnh không tồn tại'}), 404
+        path = os.path.abspath(thumbnail_path(sha256, size))
+        if not os.path.exists(path):
+            if os.path.exists(blob_path(sha256)):
+                make_thumbnails(blob_path(sha256), sha256, [size])
+            else:
+                # Packed images have no blob; evicted thumbnails are made
+                # again from the archive
+                source = open_archived_content(sha256)
+                if source is None:
+                    return jsonify({'success': False, 'message': 'Ảnh không tồn tại'}), 404
+                with source:
+                    make_thumbnails(source, sha256, [size])
+        elif time.time() - os.path.getmtime(path) > app.config['THUMBNAIL_TOUCH_INTERVAL']:
+            os.utime(path)
+        
+        response = send_file(path, mimetype='image/jpeg', etag=f'{sha256}-{size}',
+                             max_age=STATIC_ASSET_MAX_AGE, conditional=True)
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)}), 404
+
+@app.route('/storage_stats')
+def storage_stats():
+    # Space saved by image optimisation, over all files or one exam group
+    # (?folder=). Kept originals count against the saving.
+    try:
+        where, params = 'original_size IS NOT NULL', []
+        if request.args.get('folder'):
+            where += ' AND folder = ?'
+            params.append(request.args['folder'])
+        row = get_db().execute(f'''
+            SELECT COUNT(*) AS files, COALESCE(SUM(original_size), 0) AS original_bytes,
+                   COALESCE(SUM(size), 0) AS stored_bytes,
+                   COALESCE(SUM(CASE WHEN original_kept THEN original_size ELSE 0 END), 0) AS kept_bytes
+            FROM files WHERE {where}
+        ''', params).fetchone()
+        saved = row['original_bytes'] - row['stored_bytes'] - row['kept_bytes']
+        return jsonify({
+            'success': True,
+            'optimized_files': row['files'],
+            'original_bytes': row['original_bytes'],
+            'stored_bytes': row['stored_bytes'],
+            'kept_original_bytes': row['kept_bytes'],
+            'saved_bytes': saved,
+            'saved': format_size(max(saved, 0)),
+            'saved_percent': round(100 * saved / row['original_bytes'], 1) if row['original_bytes'] else 0
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)})
+
+@app.route('/download_folder/<folder_name>')
+def download_folder(folder_name):
+    try:
+        if get_group_version(folder_name) is None:
+            return jsonify({'success': False, 'message': 'Đoàn khám không tồn tại'})
+        
+        return zip_response(folder_name)
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)})
+
+@app.route('/download_selected/<folder_name>', methods=['GET', 'POST'])
+def download_selected(folder_name):
+    try:
+        if get_group_version(folder_name) is None:
+            return jsonify({'success': False, 'message': 'Đoàn khám không tồn tại'})
+        
+        names = request.values.getlist('files')
+        if not names:
+            return jsonify({'success': False, 'message': 'Chưa chọn file'})
+        
+        return zip_response(folder_name, names)
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
 
@@ -1151,22 +5243,74 @@ def delete_file(folder_name, filename):
     try:
         file_path = os.path.join(app.config['BASE_UPLOAD_FOLDER'], folder_name, filename)
         
-        if not os.path.exists(file_path):
+        if get_db().execute('SELECT 1 FROM files WHERE folder = ? AND name = ?',
+                            (folder_name, filename)).fetchone() is None:
             return jsonify({'success': False, 'message': 'File không tồn tại'})
         
-        os.remove(file_path)
+        # Packed files stay in the archive until the group is repacked
+        if os.path.exists(file_path):
+            os.remove(file_path)
         
-        metadata = load_metadata()
-        folder_info = metadata.get(folder_name, {})
-        
-        if 'files' in folder_info:
-            folder_info['files'] = [f for f in folder_info['files'] if f.get('name') != filename]
-            metadata[folder_name] = folder_info
-            save_metadata(metadata)
+        remove_blob_files(run_write(remove_file, folder_name, filename))
         
         return jsonify({'success': True, 'message': 'Xóa file thành công'})
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
 
+@app.cli.command('adopt-blobs')
+def adopt_blobs_command():
+    """Move files stored before the blob store existed into it."""
+    rows = get_db().execute('SELECT folder, name FROM files WHERE sha256 IS NULL').fetchall()
+    adopted = 0
+    for row in rows:
+        file_path = os.path.join(app.config['BASE_UPLOAD_FOLDER'], row['folder'], row['name'])
+        if not os.path.isfile(file_path):
+            continue
+        sha256 = hash_file(file_path)
+        staging_path = f"{file_path}.{uuid.uuid4().hex}.adopt"
+        os.replace(file_path, staging_path)
+        size = os.path.getsize(staging_path)
+        link_blob(sha256, file_path, staging_path)
+        run_write(adopt_file_blob, row['folder'], row['name'], sha256, size)
+        adopted += 1
+    print(f'Adopted {adopted} file(s) into {BLOB_FOLDER}')
+
+@app.cli.command('index-files')
+def index_files_command():
+    """Queue files stored before the search index existed for indexing."""
+    rows = get_db().execute('''
+        SELECT f.id FROM files f
+        WHERE NOT EXISTS (SELECT 1 FROM file_text t WHERE t.file_id = f.id)
+          AND NOT EXISTS (SELECT 1 FROM archived_files a WHERE a.file_id = f.id)
+          AND NOT EXISTS (SELECT 1 FROM jobs j WHERE j.file_id = f.id AND j.kind = 'index_text'
+                          AND j.status IN ('queued', 'running'))
+    ''').fetchall()
+    for row in rows:
+        run_write(enqueue_file_jobs, row['id'], ['index_text'])
+    print(f'Queued {len(rows)} file(s) for indexing by the running server')
+
+@app.cli.command('optimize-images')
+def optimize_images_command():
+    """Queue images stored before optimisation was enabled for optimising."""
+    if Image is None:
+        print('Pillow is not installed')
+        return
+    rows = get_db().execute('''
+        SELECT f.id, f.name FROM files f
+        WHERE f.original_size IS NULL AND f.sha256 IS NOT NULL
+          AND NOT EXISTS (SELECT 1 FROM archived_files a WHERE a.file_id = f.id)
+          AND NOT EXISTS (SELECT 1 FROM jobs j WHERE j.file_id = f.id AND j.kind = 'optimize_image'
+                          AND j.status IN ('queued', 'running'))
+    ''').fetchall()
+    rows = [row for row in rows if row['name'].rsplit('.', 1)[-1].lower() in OPTIMIZE_EXTENSIONS]
+    for row in rows:
+        run_write(enqueue_file_jobs, row['id'], ['optimize_image'])
+    print(f'Queued {len(rows)} image(s) for optimising by the running server')
+
+@app.cli.command('pack-folders')
+def pack_folders_command():
+    """Pack cold exam groups into archives now, without waiting for the server."""
+    print(f'Packed {pack_cold_exam_groups()} exam group(s)')
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
@@ -0,0 +1,11 @@
+# gunicorn reads this file from the working directory: `gunicorn app:app`.
+# Threaded workers: every open /changes stream (up to CHANGES_STREAM_MAX_AGE)
+# and every download in progress holds a thread, where a sync worker would
+# hold the whole process and stop answering other requests.
+bind = '0.0.0.0:5000'
+workers = 2
+worker_class = 'gthread'
+threads = 32
+# Seconds a worker may go without heartbeat before it is restarted; with
+# gthread, long responses don't count against it
+timeout = 30
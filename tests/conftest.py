@@ -0,0 +1,61 @@
+import atexit
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+
+import pytest
+
+# app.py resolves clinic_uploads/ against the working directory when it is
+# imported, so the tests run in a scratch directory of their own
+TEST_ROOT = tempfile.mkdtemp(prefix='clinic-tests-')
+os.chdir(TEST_ROOT)
+# At exit rather than at session end: job worker processes that are still
+# starting up chdir into it
+atexit.register(shutil.rmtree, TEST_ROOT, ignore_errors=True)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as clinic_app
+
+
+@pytest.fixture
+def client():
+    return clinic_app.app.test_client()
+
+
+@pytest.fixture
+def folder(client):
+    # A fresh exam group per test; they share one metadata.db
+    response = client.post('/create_folder', data={
+        'company_name': f'Cty {uuid.uuid4().hex[:8]}',
+        'exam_date': '2026-01-01'
+    })
+    assert response.json['success'], response.json
+    return response.json['folder_name']
+
+
+def _wait_for(condition, timeout=60):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.02)
+
+
+@pytest.fixture
+def wait_for():
+    return _wait_for
+
+
+@pytest.fixture
+def upload(client, folder):
+    # upload({'name': bytes, ...}) into the test's exam group; returns the JSON
+    def upload(files):
+        response = client.post('/upload', data={
+            'folder_name': folder,
+            'files': [(io.BytesIO(data), name) for name, data in files.items()]
+        }, content_type='multipart/form-data')
+        return response.json
+    return upload
@@ -0,0 +1,34 @@
+import hashlib
+import io
+import os
+import uuid
+
+from app import app, blob_path, get_db
+
+
+def test_identical_uploads_share_one_blob(client, folder, upload):
+    data = os.urandom(50000)
+    sha256 = hashlib.sha256(data).hexdigest()
+    assert upload({'a.pdf': data})['success']
+    other = client.post('/create_folder', data={
+        'company_name': f'Cty {uuid.uuid4().hex[:8]}',
+        'exam_date': '2026-01-01',
+        'files': [(io.BytesIO(data), 'b.pdf')]
+    }, content_type='multipart/form-data').json['folder_name']
+    assert get_db().execute('SELECT refcount FROM blobs WHERE sha256 = ?', (sha256,)).fetchone()[0] == 2
+    
+    assert client.delete(f'/delete_folder/{other}').json['success']
+    assert get_db().execute('SELECT refcount FROM blobs WHERE sha256 = ?', (sha256,)).fetchone()[0] == 1
+    assert os.path.exists(blob_path(sha256))
+    assert client.get(f'/download/{folder}/a.pdf').data == data
+
+
+def test_delete_folder_refuses_the_blob_store(client, folder, upload):
+    data = os.urandom(1000)
+    assert upload({'a.pdf': data})['success']
+    blobs = os.path.join(app.config['BASE_UPLOAD_FOLDER'], '.blobs')
+    
+    assert not client.delete('/delete_folder/.blobs').json['success']
+    assert not client.delete(f'/delete/{folder}/..').json['success']
+    assert os.path.isdir(blobs)
+    assert os.path.exists(blob_path(hashlib.sha256(data).hexdigest()))
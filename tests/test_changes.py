@@ -0,0 +1,56 @@
+import json
+import uuid
+
+import pytest
+
+import app as clinic_app
+from app import app, get_db, run_write
+
+
+@pytest.fixture(autouse=True)
+def short_streams(monkeypatch):
+    monkeypatch.setitem(app.config, 'CHANGES_STREAM_MAX_AGE', 0.5)
+    monkeypatch.setitem(app.config, 'CHANGES_HEARTBEAT', 0.1)
+    monkeypatch.setitem(app.config, 'CHANGES_POLL_INTERVAL', 0.05)
+
+
+def read_events(client, last_event_id):
+    # The stream ends after CHANGES_STREAM_MAX_AGE; returns its blocks as
+    # dicts of field -> value (comments under ':')
+    response = client.get('/changes', headers={'Last-Event-ID': str(last_event_id)})
+    assert response.mimetype == 'text/event-stream'
+    events = []
+    for block in response.get_data(as_text=True).split('\n\n'):
+        if block:
+            events.append(dict(line.split(': ', 1) if not line.startswith(':') else (':', line[2:])
+                               for line in block.split('\n')))
+    return events
+
+
+def test_stream_resumes_after_last_event_id(client):
+    since = clinic_app.last_change_seq(get_db())
+    company = f'Cty {uuid.uuid4().hex[:8]}'
+    folder = client.post('/create_folder', data={'company_name': company, 'exam_date': '2026-01-01'}).json['folder_name']
+    
+    events = read_events(client, since)
+    created = [e for e in events if e.get('event') == 'folder_created' and json.loads(e['data'])['folder'] == folder]
+    assert len(created) == 1
+    assert json.loads(created[0]['data'])['company_name'] == company
+    assert all(int(e['id']) > since for e in events if 'event' in e)
+    # Idle streams are kept alive
+    assert {':': 'ping'} in events
+    
+    # Resuming from the last id sent replays nothing
+    last_id = [e['id'] for e in events if 'id' in e][-1]
+    assert not [e for e in read_events(client, last_id) if 'event' in e]
+
+
+def test_pruned_position_gets_a_reset(client, folder):
+    last_seq = clinic_app.last_change_seq(get_db())
+    
+    def prune(conn):
+        conn.execute('DELETE FROM changes WHERE seq < ?', (last_seq,))
+    
+    run_write(prune)
+    events = read_events(client, last_seq - 2)
+    assert events[1] == {'id': str(last_seq), 'event': 'reset', 'data': '{}'}
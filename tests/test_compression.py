@@ -0,0 +1,41 @@
+import gzip
+import json
+
+import brotli
+import pytest
+
+from app import app
+
+
+@pytest.fixture(autouse=True)
+def compress_everything(monkeypatch):
+    monkeypatch.setitem(app.config, 'COMPRESS_MIN_SIZE', 0)
+
+
+def test_each_encoding_has_its_own_etag(client, folder):
+    url = f'/folder_snapshot/{folder}'
+    variants = {}
+    for encoding, decompress in (('br', brotli.decompress), ('gzip', gzip.decompress), ('identity', bytes)):
+        response = client.get(url, headers={'Accept-Encoding': encoding})
+        assert response.status_code == 200
+        assert response.headers.get('Content-Encoding', 'identity') == encoding
+        assert 'Accept-Encoding' in response.vary
+        variants[encoding] = (response.get_etag()[0], json.loads(decompress(response.data)))
+    
+    base = variants['identity'][0]
+    assert variants['gzip'][0] == f'{base}-gzip' and variants['br'][0] == f'{base}-br'
+    assert variants['gzip'][1] == variants['br'][1] == variants['identity'][1]
+    
+    # Revalidating a compressed copy keeps the ETag the client holds
+    response = client.get(url, headers={'Accept-Encoding': 'gzip', 'If-None-Match': f'"{base}-gzip"'})
+    assert response.status_code == 304 and response.get_etag()[0] == f'{base}-gzip'
+    assert client.get(url, headers={'Accept-Encoding': 'gzip', 'If-None-Match': '"0-gzip"'}).status_code == 200
+
+
+def test_if_match_accepts_a_compressed_etag(client, folder):
+    etag = client.get(f'/get_folder_info/{folder}', headers={'Accept-Encoding': 'gzip'}).headers['ETag']
+    assert etag.endswith('-gzip"')
+    update = {'folder_name': folder, 'company_name': 'Cty moi', 'exam_date': '2026-01-02', 'notes': ''}
+    
+    assert client.post('/update_folder', json=update, headers={'If-Match': etag}).json['success']
+    assert client.post('/update_folder', json=update, headers={'If-Match': etag}).status_code == 412
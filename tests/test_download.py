@@ -0,0 +1,37 @@
+import hashlib
+import os
+
+import pytest
+
+import app as clinic_app
+
+
+@pytest.mark.parametrize('name,packed', [('a.pdf', False), ('a.pdf', True), ('a.zip', True)])
+def test_range_and_conditional_download(client, folder, upload, name, packed):
+    # In the archive .pdf is deflated and .zip stored as it is
+    data = os.urandom(100000)
+    assert upload({name: data})['success']
+    if packed:
+        assert clinic_app.pack_exam_group(folder) == 1
+    url = f'/download/{folder}/{name}'
+    etag = hashlib.sha256(data).hexdigest()
+    
+    response = client.get(url)
+    assert response.status_code == 200 and response.data == data
+    assert response.headers['ETag'] == f'"{etag}"'
+    assert response.headers['Accept-Ranges'] == 'bytes'
+    
+    response = client.get(url, headers={'Range': 'bytes=1000-1999'})
+    assert response.status_code == 206 and response.data == data[1000:2000]
+    assert response.headers['Content-Range'] == f'bytes 1000-1999/{len(data)}'
+    
+    response = client.get(url, headers={'Range': f'bytes={len(data) + 10}-'})
+    assert response.status_code == 416
+    
+    assert client.get(url, headers={'If-None-Match': f'"{etag}"'}).status_code == 304
+    
+    # If-Range with a validator of other content gets the whole file
+    response = client.get(url, headers={'Range': 'bytes=0-9', 'If-Range': f'"{etag}"'})
+    assert response.status_code == 206 and response.data == data[:10]
+    response = client.get(url, headers={'Range': 'bytes=0-9', 'If-Range': '"other"'})
+    assert response.status_code == 200 and response.data == data
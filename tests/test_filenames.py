@@ -0,0 +1,37 @@
+import threading
+
+import app as clinic_app
+from app import run_write
+
+
+def test_concurrent_allocate_filenames_never_repeats(folder):
+    names, lock = [], threading.Lock()
+    
+    def allocate():
+        for _ in range(5):
+            allocated = run_write(clinic_app.allocate_filenames, folder, ['scan.jpg', 'scan.jpg'])
+            with lock:
+                names.extend(allocated)
+    
+    threads = [threading.Thread(target=allocate) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+    
+    assert len(names) == 80
+    assert len(set(names)) == len(names)
+    assert 'scan.jpg' in names
+
+
+def test_literal_suffixed_name_is_not_handed_out_again(folder):
+    # No files are inserted in between, as with uploads still in progress
+    assert run_write(clinic_app.allocate_filenames, folder, ['x_1.jpg']) == ['x_1.jpg']
+    assert run_write(clinic_app.allocate_filenames, folder, ['x.jpg', 'x.jpg']) == ['x.jpg', 'x_2.jpg']
+    assert run_write(clinic_app.allocate_filenames, folder, ['x_1.jpg']) == ['x_1_1.jpg']
+
+
+def test_names_are_released_with_the_folder(client, folder):
+    assert run_write(clinic_app.allocate_filenames, folder, ['a.pdf']) == ['a.pdf']
+    assert client.delete(f'/delete_folder/{folder}').json['success']
+    assert clinic_app.get_db().execute('SELECT 1 FROM allocated_names WHERE folder = ?', (folder,)).fetchone() is None
@@ -0,0 +1,54 @@
+import threading
+import uuid
+
+import app as clinic_app
+from app import get_db, run_write
+
+
+def put_meta(conn, key):
+    conn.execute('INSERT INTO meta (key, value) VALUES (?, ?)', (key, 'x'))
+
+
+def put_meta_then_fail(conn, key):
+    put_meta(conn, key)
+    raise ValueError('boom')
+
+
+def test_failing_mutation_only_rolls_back_itself(wait_for):
+    # Hold the writer so the next mutations queue up and commit as one batch
+    held, release = threading.Event(), threading.Event()
+    
+    def hold_writer(conn):
+        held.set()
+        release.wait(10)
+    
+    holder = threading.Thread(target=run_write, args=(hold_writer,))
+    holder.start()
+    assert held.wait(10)
+    
+    keys = {name: f'test-{name}-{uuid.uuid4().hex}' for name in ('before', 'failing', 'after')}
+    mutations = {'before': put_meta, 'failing': put_meta_then_fail, 'after': put_meta}
+    results = {}
+    
+    def call(name):
+        try:
+            results[name] = run_write(mutations[name], keys[name])
+        except Exception as e:
+            results[name] = e
+    
+    # Background jobs of earlier tests may queue writes of their own
+    queued = clinic_app._write_queue.qsize()
+    callers = []
+    for name in ('before', 'failing', 'after'):
+        callers.append(threading.Thread(target=call, args=(name,)))
+        callers[-1].start()
+        wait_for(lambda: clinic_app._write_queue.qsize() >= queued + len(callers), timeout=10)
+    release.set()
+    for thread in [holder, *callers]:
+        thread.join(10)
+    
+    assert results['before'] is None and results['after'] is None
+    assert isinstance(results['failing'], ValueError)
+    stored = {row['key'] for row in get_db().execute('SELECT key FROM meta WHERE key LIKE ?', ('test-%',))}
+    assert keys['before'] in stored and keys['after'] in stored
+    assert keys['failing'] not in stored
@@ -0,0 +1,38 @@
+import hashlib
+import io
+
+from PIL import Image
+
+from app import get_db
+
+
+def uncompressed_png():
+    out = io.BytesIO()
+    Image.new('RGB', (400, 300), (200, 220, 240)).save(out, 'PNG', compress_level=0)
+    return out.getvalue()
+
+
+def test_reupload_of_optimized_png_is_linked_by_original_hash(client, folder, upload, wait_for):
+    data = uncompressed_png()
+    original = hashlib.sha256(data).hexdigest()
+    assert upload({'scan.png': data})['success']
+    
+    def stored(name):
+        return get_db().execute('SELECT * FROM files WHERE folder = ? AND name = ?', (folder, name)).fetchone()
+    
+    wait_for(lambda: stored('scan.png')['original_sha256'] == original)
+    optimized = stored('scan.png')
+    assert optimized['size'] < len(data) and not optimized['original_kept']
+    
+    response = client.post('/upload/by_hash', json={
+        'folder_name': folder,
+        'files': [{'name': 'scan.png', 'size': len(data), 'sha256': original},
+                  {'name': 'other.png', 'size': len(data) + 1, 'sha256': original}]
+    }).json
+    assert response['linked'] == [0]
+    copy = stored(response['files'][0]['name'])
+    assert (copy['sha256'], copy['size']) == (optimized['sha256'], optimized['size'])
+    assert (copy['original_sha256'], copy['original_size']) == (original, len(data))
+    assert client.get(f"/download/{folder}/{copy['name']}").data == client.get(f'/download/{folder}/scan.png').data
+    assert get_db().execute("SELECT 1 FROM jobs WHERE file_id = ? AND kind = 'optimize_image'",
+                            (copy['id'],)).fetchone() is None
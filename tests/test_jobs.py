@@ -0,0 +1,22 @@
+import app as clinic_app
+from app import app, get_db, run_write
+
+
+def test_failed_job_is_retried_then_marked_failed(folder, monkeypatch, wait_for):
+    monkeypatch.setitem(app.config, 'JOBS_RETRY_DELAY', 0)
+    monkeypatch.setitem(app.config, 'JOBS_POLL_INTERVAL', 0.05)
+    # Metadata for a file that isn't on disk: reading it fails on every attempt
+    run_write(clinic_app.insert_files, folder, [
+        {'name': 'missing.docx', 'size': 1, 'upload_time': '2026-01-01 08:00:00'}
+    ])
+    clinic_app.start_job_dispatcher()
+    
+    def job():
+        return get_db().execute('''
+            SELECT j.status, j.attempts, j.error FROM jobs j JOIN files f ON f.id = j.file_id
+            WHERE f.folder = ? AND f.name = 'missing.docx' AND j.kind = 'index_text'
+        ''', (folder,)).fetchone()
+    
+    wait_for(lambda: job()['status'] == 'failed')
+    assert job()['attempts'] == app.config['JOBS_MAX_ATTEMPTS']
+    assert job()['error'].startswith('FileNotFoundError')
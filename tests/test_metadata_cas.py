@@ -0,0 +1,39 @@
+import threading
+
+from app import app
+
+
+def test_update_folder_with_stale_if_match_returns_412(client, folder):
+    etag = client.get(f'/get_folder_info/{folder}').headers['ETag']
+    fields = {'folder_name': folder, 'company_name': 'Cty', 'exam_date': '2026-01-01'}
+    
+    first = client.post('/update_folder', json={**fields, 'notes': 'first'}, headers={'If-Match': etag})
+    assert first.status_code == 200 and first.json['success']
+    
+    stale = client.post('/update_folder', json={**fields, 'notes': 'second'}, headers={'If-Match': etag})
+    assert stale.status_code == 412
+    assert stale.headers['ETag'] == first.headers['ETag']
+    assert client.get(f'/get_folder_info/{folder}').json['info']['notes'] == 'first'
+
+
+def test_concurrent_updates_without_if_match_all_apply(client, folder):
+    # run_write_cas re-reads the version and retries instead of failing; with
+    # fewer writers than METADATA_CAS_RETRIES none can run out of attempts
+    version = int(client.get(f'/get_folder_info/{folder}').headers['ETag'].strip('"'))
+    statuses = []
+    
+    def update(n):
+        with app.test_client() as c:
+            statuses.append(c.post('/update_folder', json={
+                'folder_name': folder, 'company_name': 'Cty', 'exam_date': '2026-01-01', 'notes': str(n)
+            }).status_code)
+    
+    threads = [threading.Thread(target=update, args=(n,)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+    
+    assert statuses == [200] * 4
+    info = client.get(f'/get_folder_info/{folder}').json['info']
+    assert info['version'] == version + 4
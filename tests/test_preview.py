@@ -0,0 +1,46 @@
+import io
+
+import openpyxl
+import pytest
+
+
+def table_bytes(name, rows):
+    if name.endswith('.csv'):
+        return '\n'.join(';'.join(str(v) for v in row) for row in rows).encode('utf-8')
+    workbook = openpyxl.Workbook()
+    for row in rows:
+        workbook.active.append(row)
+    out = io.BytesIO()
+    workbook.save(out)
+    return out.getvalue()
+
+
+@pytest.mark.parametrize('name', ['bang.csv', 'bang.xlsx'])
+def test_preview_windows(client, folder, upload, wait_for, name):
+    rows = [[i, f'Bệnh nhân {i}', i * 1.5] for i in range(250)]
+    assert upload({name: table_bytes(name, [['stt', 'ho_ten', 'diem'], *rows])})['success']
+    url = f'/preview/{folder}/{name}'
+    wait_for(lambda: not client.get(url).json.get('processing'))
+    
+    page = client.get(url, query_string={'offset': 0, 'limit': 100}).json
+    assert page['success'], page
+    assert [c['name'] for c in page['columns']] == ['stt', 'ho_ten', 'diem']
+    assert [c['type'] for c in page['columns']] == ['number', 'text', 'number']
+    assert page['total_rows'] == 250
+    assert page['rows'] == rows[:100] and page['next_offset'] == 100
+    
+    page = client.get(url, query_string={'offset': 200, 'limit': 100}).json
+    assert page['rows'] == rows[200:] and page['next_offset'] is None
+    assert client.get(url, query_string={'offset': 900}).json['rows'] == []
+    
+    # Each window has its own ETag
+    response = client.get(url, query_string={'offset': 10, 'limit': 5})
+    assert response.json['rows'] == rows[10:15]
+    etag = response.headers['ETag']
+    assert client.get(url, query_string={'offset': 10, 'limit': 5}, headers={'If-None-Match': etag}).status_code == 304
+    assert client.get(url, query_string={'offset': 15, 'limit': 5}, headers={'If-None-Match': etag}).status_code == 200
+
+
+def test_preview_of_other_formats_is_refused(client, folder, upload):
+    assert upload({'a.pdf': b'%PDF-1.4'})['success']
+    assert not client.get(f'/preview/{folder}/a.pdf').json['success']
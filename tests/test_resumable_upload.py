@@ -0,0 +1,61 @@
+import os
+
+import app as clinic_app
+from app import app, run_write
+
+
+def init_upload(client, folder, size, filename='scan.zip'):
+    return client.post('/upload/init', json={'folder_name': folder, 'filename': filename, 'size': size}).json
+
+
+def test_chunks_in_any_order_then_finalize(client, folder):
+    data = os.urandom(1000)
+    upload_id = init_upload(client, folder, len(data))['upload_id']
+    
+    for start in (600, 200, 800):
+        assert client.put(f'/upload/chunk/{upload_id}?offset={start}', data=data[start:start + 200]).json['success']
+    status = client.get(f'/upload/status/{upload_id}').json
+    assert status['ranges'] == [[200, 400], [600, 1000]]
+    assert status['offset'] == 0 and status['received'] == 600
+    
+    # Resume: the client sends what the status says is missing
+    response = client.post(f'/upload/finalize/{upload_id}')
+    assert response.status_code == 409
+    client.put(f'/upload/chunk/{upload_id}?offset=0', data=data[:200])
+    client.put(f'/upload/chunk/{upload_id}?offset=400', data=data[400:600])
+    
+    result = client.post(f'/upload/finalize/{upload_id}').json
+    assert result['success'] and result['file']['name'] == 'scan.zip'
+    assert client.get(f'/download/{folder}/scan.zip').data == data
+    assert client.get(f'/upload/status/{upload_id}').status_code == 404
+
+
+def test_chunk_outside_the_announced_size_is_rejected(client, folder):
+    upload_id = init_upload(client, folder, 100)['upload_id']
+    assert client.put(f'/upload/chunk/{upload_id}?offset=90', data=b'x' * 20).status_code == 416
+    assert client.get(f'/upload/status/{upload_id}').json['received'] == 0
+
+
+def test_init_rejects_sizes_over_the_limit(client, folder, monkeypatch):
+    monkeypatch.setitem(app.config, 'UPLOAD_MAX_SIZE', 1000)
+    assert init_upload(client, folder, 1000)['success']
+    response = init_upload(client, folder, 1001)
+    assert not response['success'] and 'upload_id' not in response
+
+
+def test_uploads_expire_after_the_last_chunk_not_init(client, folder):
+    upload_id = init_upload(client, folder, 200)['upload_id']
+    ttl = app.config['UPLOAD_STAGING_TTL']
+    
+    def age(conn, seconds, column):
+        conn.execute(f'UPDATE uploads SET {column} = {column} - ? WHERE id = ?', (seconds, upload_id))
+    
+    run_write(age, 2 * ttl, 'created_at')
+    run_write(age, 2 * ttl, 'updated_at')
+    client.put(f'/upload/chunk/{upload_id}?offset=0', data=b'x' * 100)
+    clinic_app.expire_stale_uploads()
+    assert client.get(f'/upload/status/{upload_id}').json['received'] == 100
+    
+    run_write(age, 2 * ttl, 'updated_at')
+    clinic_app.expire_stale_uploads()
+    assert client.get(f'/upload/status/{upload_id}').status_code == 404
@@ -0,0 +1,29 @@
+from app import app, extract_text, fold_text
+
+
+def search(client, q, folder):
+    return client.get('/search', query_string={'q': q, 'folder': folder}).json
+
+
+def test_search_ignores_case_and_diacritics(client, folder, upload, wait_for):
+    body = 'STT;Họ tên;Kết luận\n1;Nguyễn Văn Đức;Đủ sức khỏe làm việc\n'
+    assert upload({'ket_qua.csv': body.encode('utf-8')})['success']
+    wait_for(lambda: search(client, 'nguyen', folder)['results'])
+    
+    for q in ('nguyen van duc', 'NGUYỄN đức', 'suc kho'):
+        results = search(client, q, folder)['results']
+        assert [r['name'] for r in results] == ['ket_qua.csv'], q
+        snippet, highlights = results[0]['snippet'], results[0]['highlights']
+        assert 'Nguyễn Văn Đức' in snippet
+        assert {fold_text(snippet[a:b]) for a, b in highlights} <= set(fold_text(q).split())
+    
+    assert search(client, 'nguyen tran', folder)['results'] == []
+    assert [r['name'] for r in search(client, 'ket', folder)['results']] == ['ket_qua.csv']
+
+
+def test_capped_csv_is_still_read_as_utf8(tmp_path, monkeypatch):
+    # The 4 * SEARCH_MAX_TEXT bytes read end in the middle of an "ễ"
+    monkeypatch.setitem(app.config, 'SEARCH_MAX_TEXT', 10)
+    path = tmp_path / 'a.csv'
+    path.write_bytes(('ễ' * 20).encode('utf-8'))
+    assert extract_text(str(path)) == 'ễ' * 10
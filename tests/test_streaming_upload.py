@@ -0,0 +1,75 @@
+import hashlib
+import io
+import os
+import sqlite3
+import uuid
+
+import pytest
+
+import app as clinic_app
+from app import app, get_db
+
+
+def folder_files(folder):
+    return sorted(name for name in os.listdir(os.path.join(app.config['BASE_UPLOAD_FOLDER'], folder))
+                  if not name.startswith('.'))
+
+
+def test_upload_stores_content_and_hash(client, folder, upload):
+    data = os.urandom(300000)
+    assert upload({'a.pdf': data})['success']
+    row = get_db().execute('SELECT size, sha256 FROM files WHERE folder = ?', (folder,)).fetchone()
+    assert (row['size'], row['sha256']) == (len(data), hashlib.sha256(data).hexdigest())
+    assert client.get(f'/download/{folder}/a.pdf').data == data
+
+
+@pytest.fixture
+def failing_link_blob(monkeypatch):
+    # link_blob that fails on its second call
+    calls = []
+    real = clinic_app.link_blob
+    
+    def link_blob(*args):
+        calls.append(args)
+        if len(calls) == 2:
+            raise OSError('disk full')
+        return real(*args)
+    
+    monkeypatch.setattr(clinic_app, 'link_blob', link_blob)
+
+
+@pytest.fixture
+def failing_insert_files(monkeypatch):
+    def insert_files(conn, folder_name, files, expected_version=None):
+        raise sqlite3.OperationalError('database is locked')
+    
+    monkeypatch.setattr(clinic_app, 'insert_files', insert_files)
+
+
+@pytest.mark.parametrize('failure', ['failing_link_blob', 'failing_insert_files'])
+def test_failed_upload_leaves_no_files_or_blobs(folder, upload, request, failure):
+    request.getfixturevalue(failure)
+    files = {'a.pdf': os.urandom(1000), 'b.pdf': os.urandom(1000)}
+    
+    assert not upload(files)['success']
+    assert folder_files(folder) == []
+    assert get_db().execute('SELECT COUNT(*) FROM files WHERE folder = ?', (folder,)).fetchone()[0] == 0
+    for data in files.values():
+        assert not os.path.exists(clinic_app.blob_path(hashlib.sha256(data).hexdigest()))
+
+
+def test_failed_create_folder_can_be_retried(client, failing_insert_files, monkeypatch):
+    form = {'company_name': f'Cty {uuid.uuid4().hex[:8]}', 'exam_date': '2026-01-01'}
+    data = os.urandom(1000)
+    
+    def create():
+        return client.post('/create_folder', data={**form, 'files': [(io.BytesIO(data), 'a.pdf')]},
+                           content_type='multipart/form-data').json
+    
+    assert not create()['success']
+    assert not os.path.exists(clinic_app.blob_path(hashlib.sha256(data).hexdigest()))
+    
+    monkeypatch.undo()
+    response = create()
+    assert response['success']
+    assert folder_files(response['folder_name']) == ['a.pdf']
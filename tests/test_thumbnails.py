@@ -0,0 +1,32 @@
+import hashlib
+import io
+import os
+
+from PIL import Image
+
+import app as clinic_app
+
+
+def test_evicted_thumbnail_of_packed_image_is_made_again(client, folder, upload, wait_for):
+    out = io.BytesIO()
+    Image.new('RGB', (800, 600), (30, 120, 200)).save(out, 'JPEG')
+    sha256 = hashlib.sha256(out.getvalue()).hexdigest()
+    assert upload({'scan.jpg': out.getvalue()})['success']
+    small = clinic_app.thumbnail_path(sha256, 'small')
+    wait_for(lambda: os.path.exists(small))
+    
+    assert clinic_app.pack_exam_group(folder) == 1
+    assert not os.path.exists(clinic_app.blob_path(sha256))
+    # As the cache evictor does
+    os.remove(small)
+    
+    url = client.get(f'/get_files/{folder}').json['files'][0]['thumbnail']
+    response = client.get(url)
+    assert response.status_code == 200 and response.mimetype == 'image/jpeg'
+    with Image.open(io.BytesIO(response.data)) as thumbnail:
+        assert max(thumbnail.size) == clinic_app.THUMBNAIL_SIZES['small']
+    assert os.path.exists(small)
+
+
+def test_thumbnail_of_unknown_content_is_404(client):
+    assert client.get(f"/thumbnails/{'0' * 64}/small.jpg").status_code == 404
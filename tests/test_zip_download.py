@@ -0,0 +1,33 @@
+import io
+import os
+import zipfile
+
+import app as clinic_app
+
+
+def read_zip(response):
+    assert response.status_code == 200 and response.mimetype == 'application/zip'
+    with zipfile.ZipFile(io.BytesIO(response.data)) as zf:
+        assert zf.testzip() is None
+        return {info.filename: zf.read(info) for info in zf.infolist()}
+
+
+def test_folder_zip_streams_loose_and_packed_files(client, folder, upload):
+    files = {'a.pdf': os.urandom(70000), 'b.zip': os.urandom(30000)}
+    assert upload(files)['success']
+    assert clinic_app.pack_exam_group(folder) == 2
+    # Uploaded after packing, so it stays loose
+    files['c.pdf'] = b'%PDF-1.4 ' * 5000
+    assert upload({'c.pdf': files['c.pdf']})['success']
+    
+    response = client.get(f'/download_folder/{folder}')
+    assert response.is_streamed
+    assert read_zip(response) == files
+    
+    response = client.post(f'/download_selected/{folder}', data={'files': ['b.zip', 'c.pdf', 'missing.pdf']})
+    assert read_zip(response) == {name: files[name] for name in ('b.zip', 'c.pdf')}
+
+
+def test_zip_of_unknown_folder_is_refused(client):
+    assert not client.get('/download_folder/.blobs').json['success']
+    assert not client.get('/download_selected/.blobs?files=x').json['success']